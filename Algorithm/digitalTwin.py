@@ -0,0 +1,231 @@
+"""
+Digital twin for evaluating the routing policy over time, without the DB, the GUI or the C22-SIM sockets.
+
+Each simulated day:
+1. moloks fill up as in Simulation.simulate_horizon (send_freq readings pr. molok)
+2. at the end of the day, moloks are selected and planned with MasterPlanner like the GUI does. Selection is either
+the static filter (fillpct at or above waste_limit) or, with horizon_hours, the predictive MolokSelector
+3. the moloks on the routes are emptied before the next day starts
+
+With warm_start, each day is planned from the routes of the most similar previous day (see warmStart), like the GUI
+does with the plan history in the DB.
+
+Overflow events, distance driven, trucks used and planner latency are logged pr. day. Seeds are run in parallel
+worker processes, so planner changes can be compared on many fleets at once.
+"""
+
+import os
+import sys
+import time
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Append the Server/ folder to the sys.path in order to grab Simulation.py
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Server"))
+from Simulation import Simulation
+from routePlanner import MasterPlanner
+from molokSelection import MolokSelector
+from warmStart import warm_start_routes
+
+DEPOT_POS = (57.0257998, 9.9194714)                 # default depot of MasterPlanner
+
+
+class DigitalTwin:
+
+    def __init__(self, num_moloks: int = 200, days: int = 14, send_freq: int = 24, waste_limit: float = 80,
+                 num_trucks: int = 10, time_limit_seconds: int = 5, num_attempts: int = 3, first_solution_strategy: str = "1",
+                 local_search_strategy: str = "3", truck_range: int = 100, truck_capacity: int = 3000,
+                 molok_capacity: int = 500, tte_molok: int = 5, center_coordinates: tuple = (57.01466, 9.987159),
+                 scale: float = 0.01, horizon_hours: float = None, detour_meters: float = None,
+                 detour_fill: float = 60, post_optimize: bool = False, warm_start: bool = False,
+                 warm_start_similarity: float = 0.5) -> None:
+        """
+        Inputs:
+        ---
+        - num_moloks: moloks in each simulated fleet. Positions and initial fillpcts are drawn like DataStorage does
+        - days: number of days to simulate pr. seed
+        - send_freq: readings pr. molok pr. day
+        - waste_limit: fillpct a molok must have to be planned. With horizon_hours, the predicted fillpct at the end
+        of the horizon instead, like the filter in the GUI
+        - num_trucks ... local_search_strategy, post_optimize: passed to MasterPlanner. Defaults are smaller than in
+        the GUI, so a day is planned in seconds
+        - truck_range, truck_capacity, molok_capacity, tte_molok: passed to MasterPlanner, same defaults as the GUI
+        - horizon_hours, detour_meters, detour_fill: passed to MolokSelector. None horizon_hours uses the static filter
+        - warm_start: plan each day from the routes of the previous day with the most moloks in common, if at least
+        'warm_start_similarity' of the moloks (Jaccard similarity, as DataStorage.fetch_similar_plan)
+        """
+        self.num_moloks = num_moloks
+        self.days = days
+        self.send_freq = send_freq
+        self.waste_limit = waste_limit
+
+        self.num_trucks = num_trucks
+        self.time_limit = time_limit_seconds
+        self.num_attempts = num_attempts
+        self.first_solution_strat = first_solution_strategy
+        self.local_search_strat = local_search_strategy
+        self.post_optimize = post_optimize
+        self.warm_start = warm_start
+        self.warm_start_similarity = warm_start_similarity
+        self.truck_range = truck_range
+        self.truck_capacity = truck_capacity
+        self.molok_capacity = molok_capacity
+        self.tte_molok = tte_molok
+
+        self.center_coords = center_coordinates
+        self.scale = scale
+
+        self.selector = None
+        if horizon_hours is not None:
+            self.selector = MolokSelector(horizon_hours=horizon_hours, overflow_limit=waste_limit,
+                                          detour_meters=detour_meters, detour_fill=detour_fill)
+
+    def plan_day(self, molok_pos_list: list, fill_pcts: np.ndarray, est_growthrates: np.ndarray, warm_routes: list = None):
+        """
+        Internal method. Plans routes for the given moloks like DisplayRoutes in the GUI does, from 'warm_routes' if given.
+        returns (list of emptied indices into the given moloks, total distance in km, trucks used, planner seconds,
+        routes as lists of indices into the given moloks)
+        """
+        mp = MasterPlanner(600, 2200, molok_pos_list, self.tte_molok, fill_pcts.tolist(), self.molok_capacity,
+                           est_growthrates.tolist(), self.truck_range, self.num_trucks, self.truck_capacity, 600, 1400,
+                           self.time_limit, depot_pos=DEPOT_POS, first_solution_strategy=self.first_solution_strat,
+                           local_search_strategy=self.local_search_strat, num_attempts=self.num_attempts,
+                           post_optimize=self.post_optimize, warm_start_routes=warm_routes)
+
+        start = time.time()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):     # MasterPlanner prints a lot
+            mp.master()
+        latency = time.time() - start
+
+        emptied = [molok_id for molok_id, _ in getattr(mp, "empty_molok_times", [])]   # not set if the last try failed
+        if not emptied:
+            return [], 0.0, 0, latency, []
+
+        routes = mp.current_best["routes"]
+        distances = [route_distances[-1] for route_distances in mp.current_best["truck_distances"]]
+        trucks_used = sum(1 for route in routes if len(route) > 2)
+
+        molok_routes = [[molok for molok in route if molok != "depot"] for route in routes]
+
+        return emptied, sum(distances) / 1000, trucks_used, latency, molok_routes
+
+    def pick_warm_routes(self, previous_plans: list, selected: np.ndarray, molok_pos_list: list, fill_pcts: np.ndarray):
+        """
+        Internal method. Warm start routes for the 'selected' moloks from the previous plan (list of routes of molok
+        indices) with the most moloks in common, or None if none is similar enough
+        """
+        selected_set = set(selected.tolist())
+        best_routes, best_similarity = None, 0
+        for plan in previous_plans:
+            planned = {molok for route in plan for molok in route}
+            similarity = len(planned & selected_set) / len(planned | selected_set)
+            if similarity > best_similarity:
+                best_routes, best_similarity = plan, similarity
+
+        if best_routes is None or best_similarity < self.warm_start_similarity:
+            return None
+
+        demands = np.round(fill_pcts[selected] / 100 * self.molok_capacity)
+        return warm_start_routes(best_routes, selected.tolist(), [molok_pos_list[i] for i in selected], DEPOT_POS,
+                                 demands, self.truck_capacity, self.num_trucks)
+
+    def run(self, seed: int) -> dict:
+        """
+        Simulates self.days days of a fleet generated from 'seed'.
+        returns dictionary of arrays with one entry pr. day: 'overflows' (moloks crossing 100 %), 'overfilled' (moloks
+        at or above 100 % when planning), 'planned', 'emptied', 'distance_km', 'trucks_used' and 'planner_seconds'
+        """
+        rng = np.random.default_rng(seed)
+        lats = rng.normal(self.center_coords[0], self.scale / 2, self.num_moloks)
+        lons = rng.normal(self.center_coords[1], self.scale, self.num_moloks)
+        molok_pos_list = list(zip(lats.tolist(), lons.tolist()))
+        fill_pcts = 20 * rng.random(self.num_moloks)
+
+        # growth from 0 of every molok, one day pr. chunk. The twin adds the increments to its own fillpcts, so
+        # emptying doesn't have to go through the simulation
+        growth_chunks = Simulation(start_listen=False).simulate_horizon(seed, np.zeros(self.num_moloks), self.send_freq,
+                                                                        np.zeros(self.num_moloks), self.days,
+                                                                        chunk_rounds=self.send_freq)
+        log = {key: [] for key in ("overflows", "overfilled", "planned", "emptied", "distance_km", "trucks_used", "planner_seconds")}
+        last_growth = np.zeros(self.num_moloks)
+        previous_plans = []                                             # routes of each day as lists of molok indices
+
+        for cum_growth, _, _ in growth_chunks:
+            day_growth = cum_growth - np.concatenate(([last_growth], cum_growth[:-1]))     # growth pr. reading
+            last_growth = cum_growth[-1]
+            readings = fill_pcts + np.cumsum(day_growth, axis=0)        # (send_freq, moloks) fillpcts through the day
+
+            log["overflows"].append(int(np.sum((fill_pcts < 100) & (readings.max(axis=0) >= 100))))
+            est_growthrates = np.maximum(readings[-1] - fill_pcts, 1e-6) / 86400   # observed growth of the day pr. second
+            fill_pcts = readings[-1]
+            log["overfilled"].append(int(np.sum(fill_pcts >= 100)))
+
+            if self.selector is None:
+                selected = np.flatnonzero(fill_pcts >= self.waste_limit)
+            else:
+                selected = self.selector.select(fill_pcts, est_growthrates, molok_pos_list)["selected"]
+            log["planned"].append(len(selected))
+            if len(selected):
+                warm_routes = None
+                if self.warm_start:
+                    warm_routes = self.pick_warm_routes(previous_plans, selected, molok_pos_list, fill_pcts)
+
+                emptied, distance, trucks_used, latency, routes = self.plan_day([molok_pos_list[i] for i in selected],
+                                                                                fill_pcts[selected], est_growthrates[selected],
+                                                                                warm_routes)
+                fill_pcts[selected[emptied]] = 0                        # emptied before the next day starts
+                if routes:
+                    previous_plans.append([selected[route].tolist() for route in routes])
+            else:
+                emptied, distance, trucks_used, latency = [], 0.0, 0, 0.0
+
+            log["emptied"].append(len(emptied))
+            log["distance_km"].append(distance)
+            log["trucks_used"].append(trucks_used)
+            log["planner_seconds"].append(latency)
+
+        return {key: np.array(values) for key, values in log.items()}
+
+    def run_seeds(self, seeds: list, processes: int = None) -> dict:
+        """runs 'run' for each seed in parallel worker processes. returns dictionary with seed as key and its log as value"""
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return dict(zip(seeds, executor.map(self.run, seeds)))
+
+
+def summarize(results: dict) -> str:
+    """returns a summary of the logs from DigitalTwin.run_seeds, averaged over seeds"""
+    logs = list(results.values())
+    days = len(logs[0]["overflows"])
+
+    def avg(key, reduce=np.sum):
+        return np.mean([reduce(log[key]) for log in logs])
+
+    summary = f"{len(logs)} seeds x {days} days  \n"
+    summary += f"Overflow events pr. seed: {avg('overflows')}  \n"
+    summary += f"Moloks emptied pr. seed: {avg('emptied')}  \n"
+    summary += f"Distance driven pr. day: {avg('distance_km', np.mean)} km  \n"
+    summary += f"Trucks used pr. day: {avg('trucks_used', np.mean)}  \n"
+    summary += f"Planner latency pr. day: {avg('planner_seconds', np.mean)} s (max {avg('planner_seconds', np.max)} s)  \n"
+
+    return summary
+
+
+if __name__ == "__main__":
+    policies = {"waste limit 80 %": DigitalTwin(num_moloks=100, days=7, num_trucks=8, time_limit_seconds=3),
+                "predicted overflow": DigitalTwin(num_moloks=100, days=7, num_trucks=8, time_limit_seconds=3,
+                                                  waste_limit=100, horizon_hours=24, detour_meters=150),
+                "predicted overflow, warm start": DigitalTwin(num_moloks=100, days=7, num_trucks=8, time_limit_seconds=3,
+                                                              waste_limit=100, horizon_hours=24, detour_meters=150,
+                                                              warm_start=True)}
+
+    for name, twin in policies.items():
+        start = time.time()
+        results = twin.run_seeds(seeds=list(range(8)))
+        print(f"___{name}___")
+        print(f"Simulated {len(results)} fleets in {time.time() - start} seconds")
+
+        for seed, log in results.items():
+            print(f"seed {seed}: overflows pr. day {log['overflows'].tolist()}, km pr. day {np.round(log['distance_km'], 1).tolist()}")
+        print(summarize(results))
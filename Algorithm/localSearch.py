@@ -0,0 +1,224 @@
+"""
+Local improvement of a finished plan, run on the time left of the planning budget after the solver returns.
+
+Moves:
+- 2-opt: reverses a segment of a route
+- or-opt: moves a segment of 1 - 3 moloks to another place in the same route
+- relocate: moves a molok to another route
+- swap: exchanges two moloks between routes
+
+Each candidate move is scored by the change in cost (total drive time, same as the arc cost of the RoutePlanner) from
+the few matrix entries it touches. Only moves that lower the cost are checked against the time windows, the route time,
+the truck range and the truck capacity, on the changed routes only. The first improving feasible move is applied, and
+passes over all moves are repeated until none improves or the deadline is reached.
+"""
+
+import time
+
+import numpy as np
+
+
+class LocalSearch:
+
+    def __init__(self, evaluator, deadline: float = None, max_segment: int = 3) -> None:
+        """
+        Inputs:
+        ---
+        - evaluator: RouteEvaluator with the matrices, demands, time windows and limits of the plan
+        - deadline: epoch time to stop searching at. None searches until no move improves
+        - max_segment: longest segment moved by or-opt
+        """
+        self.evaluator = evaluator
+        self.deadline = np.inf if deadline is None else deadline
+        self.max_segment = max_segment
+
+        self.time_matrix = evaluator.time_matrix
+        self.times = evaluator.time_matrix.tolist()         # nested lists are faster than arrays for single lookups
+        self.demands = evaluator.demands.tolist()
+
+        num_nodes = len(self.times)
+        self.tw_start = evaluator.tw_start if evaluator.tw_start is not None else np.zeros(num_nodes)
+        self.tw_end = evaluator.tw_end if evaluator.tw_end is not None else np.full(num_nodes, np.inf)
+
+        self.moves = {"2-opt": 0, "or-opt": 0, "relocate": 0, "swap": 0}
+
+    def timed_out(self) -> bool:
+        return time.time() >= self.deadline
+
+    def route_cost(self, route: list) -> int:
+        """Internal method. Drive time of a route framed by depots"""
+        times = self.times
+        return sum(times[route[i]][route[i + 1]] for i in range(len(route) - 1))
+
+    def feasible(self, route: list) -> bool:
+        """Internal method. True if a route framed by depots keeps its time windows, route time, range and capacity"""
+        nodes = np.asarray(route)
+        frm, to = nodes[:-1], nodes[1:]
+
+        arrival = np.cumsum(self.time_matrix[frm, to])
+        if arrival[-1] > self.evaluator.max_route_time:
+            return False
+        if self.evaluator.distance_matrix[frm, to].sum() > self.evaluator.truck_range:
+            return False
+        if self.evaluator.demands[nodes].sum() > self.evaluator.truck_capacity:
+            return False
+
+        visits = to[:-1]
+        return bool(np.all(arrival[:-1] <= self.tw_end[visits]) and np.all(arrival[:-1] >= self.tw_start[visits]))
+
+    def accept(self, routes: list, costs: list, changed: dict, move: str) -> bool:
+        """
+        Internal method. Applies a move if the changed routes ({route number: new route}) are cheaper and feasible.
+        The estimated delta of a move only preselects it, as the exact cost is checked here
+        """
+        new_costs = {num: self.route_cost(route) for num, route in changed.items()}
+        if sum(new_costs.values()) >= sum(costs[num] for num in changed):
+            return False
+        if not all(self.feasible(route) for route in changed.values()):
+            return False
+
+        for num, route in changed.items():
+            routes[num] = route
+            costs[num] = new_costs[num]
+        self.moves[move] += 1
+        return True
+
+    def two_opt(self, routes: list, costs: list, r: int) -> bool:
+        """Internal method. Tries reversing each segment of route r. returns True if a move was applied"""
+        route, times = routes[r], self.times
+        for i in range(1, len(route) - 2):
+            a, b = route[i - 1], route[i]
+            for j in range(i + 1, len(route) - 1):
+                c, d = route[j], route[j + 1]
+                if times[a][c] + times[b][d] - times[a][b] - times[c][d] < 0:
+                    new_route = route[:i] + route[i:j + 1][::-1] + route[j + 1:]
+                    if self.accept(routes, costs, {r: new_route}, "2-opt"):
+                        return True
+        return False
+
+    def or_opt(self, routes: list, costs: list, r: int) -> bool:
+        """Internal method. Tries moving each segment of up to max_segment moloks within route r"""
+        route, times = routes[r], self.times
+        for length in range(1, self.max_segment + 1):
+            for i in range(1, len(route) - length):
+                segment = route[i:i + length]
+                p, q = route[i - 1], route[i + length]
+                removal_gain = times[p][segment[0]] + times[segment[-1]][q] - times[p][q]
+                rest = route[:i] + route[i + length:]
+
+                for k in range(len(rest) - 1):
+                    if k == i - 1:                          # same place
+                        continue
+                    x, y = rest[k], rest[k + 1]
+                    if times[x][segment[0]] + times[segment[-1]][y] - times[x][y] - removal_gain < 0:
+                        new_route = rest[:k + 1] + segment + rest[k + 1:]
+                        if self.accept(routes, costs, {r: new_route}, "or-opt"):
+                            return True
+        return False
+
+    def relocate(self, routes: list, costs: list, loads: list, a: int, b: int) -> bool:
+        """Internal method. Tries moving each molok of route a to each place in route b"""
+        route_a, route_b, times = routes[a], routes[b], self.times
+        for i in range(1, len(route_a) - 1):
+            u = route_a[i]
+            if loads[b] + self.demands[u] > self.evaluator.truck_capacity:
+                continue
+            p, q = route_a[i - 1], route_a[i + 1]
+            removal_gain = times[p][u] + times[u][q] - times[p][q]
+
+            for k in range(len(route_b) - 1):
+                x, y = route_b[k], route_b[k + 1]
+                if times[x][u] + times[u][y] - times[x][y] - removal_gain < 0:
+                    changed = {a: route_a[:i] + route_a[i + 1:], b: route_b[:k + 1] + [u] + route_b[k + 1:]}
+                    if self.accept(routes, costs, changed, "relocate"):
+                        loads[a] -= self.demands[u]
+                        loads[b] += self.demands[u]
+                        return True
+        return False
+
+    def swap(self, routes: list, costs: list, loads: list, a: int, b: int) -> bool:
+        """Internal method. Tries exchanging each molok of route a with each molok of route b"""
+        route_a, route_b, times = routes[a], routes[b], self.times
+        capacity = self.evaluator.truck_capacity
+        for i in range(1, len(route_a) - 1):
+            u, p, q = route_a[i], route_a[i - 1], route_a[i + 1]
+            for j in range(1, len(route_b) - 1):
+                v, x, y = route_b[j], route_b[j - 1], route_b[j + 1]
+                load_change = self.demands[v] - self.demands[u]
+                if loads[a] + load_change > capacity or loads[b] - load_change > capacity:
+                    continue
+
+                delta = (times[p][v] + times[v][q] - times[p][u] - times[u][q]
+                         + times[x][u] + times[u][y] - times[x][v] - times[v][y])
+                if delta < 0:
+                    changed = {a: route_a[:i] + [v] + route_a[i + 1:], b: route_b[:j] + [u] + route_b[j + 1:]}
+                    if self.accept(routes, costs, changed, "swap"):
+                        loads[a] += load_change
+                        loads[b] -= load_change
+                        return True
+        return False
+
+    def improve(self, routes: list) -> dict:
+        """
+        Improves a plan until no move is better or the deadline is reached. 'routes' are on any form accepted by
+        RouteEvaluator.
+        returns dictionary with 'routes' (nodes framed by depots, 0 = depot), 'cost' and 'initial_cost' (total drive
+        time), 'improved', 'moves' (applied moves of each kind) and 'seconds'
+        """
+        start = time.time()
+        routes = [[0] + self.evaluator.route_nodes(route) + [0] for route in routes]
+        costs = [self.route_cost(route) for route in routes]
+        loads = [sum(self.demands[node] for node in route) for route in routes]
+        initial_cost = sum(costs)
+
+        improved = True
+        while improved and not self.timed_out():
+            improved = False
+
+            for r in range(len(routes)):
+                while not self.timed_out() and (self.two_opt(routes, costs, r) or self.or_opt(routes, costs, r)):
+                    improved = True
+
+            for a in range(len(routes)):
+                for b in range(len(routes)):
+                    if a == b or len(routes[a]) == 2 or self.timed_out():
+                        continue
+                    while not self.timed_out() and (self.relocate(routes, costs, loads, a, b) or
+                                                    (len(routes[b]) > 2 and self.swap(routes, costs, loads, a, b))):
+                        improved = True
+
+        return {"routes": routes, "cost": sum(costs), "initial_cost": initial_cost, "improved": sum(costs) < initial_cost,
+                "moves": dict(self.moves), "seconds": time.time() - start}
+
+
+if __name__ == "__main__":
+    import support_functions as sf
+    from routeEvaluator import RouteEvaluator
+
+    rng = np.random.default_rng(10)
+    num_moloks = 100
+    num_trucks = 8
+
+    positions = np.column_stack((rng.normal(57.02, 0.01, num_moloks), rng.normal(9.95, 0.02, num_moloks)))
+    locations = np.concatenate(([[57.0257998, 9.9194714]], positions))
+    distance_matrix = np.round(sf.pairwise_meters(locations, locations)).astype(np.int64)
+    time_matrix = np.round(distance_matrix / (50 / 3.6)).astype(np.int64) + 300     # 50 km/h and 5 min to empty
+    time_matrix[0, :] -= 300
+    np.fill_diagonal(time_matrix, 0)
+
+    fill_pcts = rng.uniform(40, 70, num_moloks)
+    growthrates = rng.uniform(5, 30, num_moloks) / 86400
+    demands = np.concatenate(([0], np.round(fill_pcts / 100 * 500))).astype(np.int64)
+    time_windows = [[0, 8 * 3600]] + sf.molokTimeWindows(fill_pcts, growthrates, slack=0)
+
+    evaluator = RouteEvaluator(time_matrix, distance_matrix, demands, time_windows, fill_pcts, growthrates,
+                               truck_range=100000, truck_capacity=6000, max_route_time=8 * 3600)
+
+    # moloks dealt out to the trucks in random order
+    routes = [[0] + (rng.permutation(np.arange(truck, num_moloks, num_trucks)) + 1).tolist() + [0] for truck in range(num_trucks)]
+    print(f"initial plan feasible: {evaluator.evaluate(routes)['fleet']['feasible']}")
+
+    result = LocalSearch(evaluator, deadline=time.time() + 5).improve(routes)
+    fleet = evaluator.evaluate(result["routes"])["fleet"]
+    print(f"drive time {result['initial_cost']} s -> {result['cost']} s in {result['seconds']} seconds, moves: {result['moves']}")
+    print(f"improved plan feasible: {fleet['feasible']}, trucks used: {fleet['trucks_used']}, distance: {fleet['total_distance'] / 1000} km")
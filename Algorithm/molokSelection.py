@@ -0,0 +1,133 @@
+"""
+Predictive selection of the moloks to plan. Instead of planning every molok at or above a fixed waste limit, each molok's
+fill is projected to the next planned shift with its growthrate from DataStorage.avg_growth_over_period:
+
+    predicted fill = fillPct + growthrate * horizon
+
+A molok is selected when its predicted fill reaches the overflow limit, i.e. when it will overflow before it can be
+emptied on the next shift. Moloks just below the waste limit that grow fast are selected, and nearly full moloks that
+grow slowly are left for a later shift.
+
+Optionally, moloks that are not at risk yet are included anyway if they are a cheap detour: fuller than 'detour_fill'
+and within 'detour_meters' of a selected molok (or the depot).
+
+Everything is computed on NumPy arrays, so a whole table is selected in milliseconds.
+"""
+
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import support_functions as sf
+
+
+class MolokSelector:
+
+    def __init__(self, horizon_hours: float = 24, overflow_limit: float = 100, detour_meters: float = None,
+                 detour_fill: float = 50, depot_pos: tuple = None) -> None:
+        """
+        Inputs:
+        ---
+        - horizon_hours: hours from now until the moloks not visited on this shift can be emptied on the next one
+        - overflow_limit: predicted fillpct at which a molok is selected. 100 selects the moloks that would overflow
+        - detour_meters: max distance from a selected molok (or the depot) for the cheap detour rule. None disables it
+        - detour_fill: min predicted fillpct of a molok included by the cheap detour rule
+        - depot_pos: (lat, long) of the depot. Counts as a selected molok in the cheap detour rule if given
+        """
+        self.horizon = horizon_hours * 3600           # hours to sec, same unit as the growthrates
+        self.overflow_limit = overflow_limit
+        self.detour_meters = detour_meters
+        self.detour_fill = detour_fill
+        self.depot_pos = depot_pos
+
+    def predict(self, fill_pcts, growthrates) -> tuple:
+        """
+        Internal method. Projects the fill of every molok to the end of the horizon.
+        returns (predicted fillpcts, hours until each molok reaches the overflow limit). Moloks without a valid
+        growthrate (NaN or negative) are assumed not to grow
+        """
+        fill_pcts = np.asarray(fill_pcts, dtype=np.float64)
+        growthrates = np.nan_to_num(np.asarray(growthrates, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0)
+        growthrates = np.maximum(growthrates, 0)
+
+        predicted = fill_pcts + growthrates * self.horizon
+
+        remaining = np.maximum(self.overflow_limit - fill_pcts, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hours_to_limit = remaining / growthrates / 3600         # inf if no growth
+        hours_to_limit[remaining == 0] = 0                          # already at the limit, also without growth (0/0)
+
+        return predicted, hours_to_limit
+
+    def nearest_selected(self, positions: np.ndarray, candidates: np.ndarray, selected: np.ndarray) -> np.ndarray:
+        """
+        Internal method. Haversine distance in meters from each candidate to the nearest selected molok or the depot.
+        The points are placed on a unit sphere and looked up in a k-d tree. The straight line (chord) distance between
+        two points grows with their haversine distance, so the nearest point by chord is also the nearest by haversine
+        """
+        anchors = positions[selected]
+        if self.depot_pos is not None:
+            anchors = np.concatenate((anchors, np.asarray([self.depot_pos], dtype=np.float64)))
+
+        if len(anchors) == 0:
+            return np.full(len(candidates), np.inf)
+
+        tree = cKDTree(sf.unit_sphere_points(anchors))
+        chords, _ = tree.query(sf.unit_sphere_points(positions[candidates]))
+
+        return 2 * 6371000 * np.arcsin(np.minimum(chords / 2, 1))     # chord on unit sphere -> meters
+
+    def select(self, fill_pcts, growthrates, positions=None) -> dict:
+        """
+        Selects the moloks to plan. 'fill_pcts' and 'growthrates' (fillpct pr. second) have one entry pr. molok, and
+        'positions' is a list or array of (lat, long), only needed for the cheap detour rule.
+        returns dictionary with:
+        - 'selected': sorted indices of the selected moloks
+        - 'at_risk': indices selected because they reach the overflow limit within the horizon
+        - 'detours': indices selected by the cheap detour rule
+        - 'predicted': predicted fillpct of every molok at the end of the horizon
+        - 'hours_to_limit': hours until every molok reaches the overflow limit
+        - 'seconds': time spent selecting
+        """
+        start = time.time()
+
+        predicted, hours_to_limit = self.predict(fill_pcts, growthrates)
+        at_risk_mask = predicted >= self.overflow_limit
+        at_risk = np.flatnonzero(at_risk_mask)
+
+        detours = np.array([], dtype=np.int64)
+        if self.detour_meters is not None and positions is not None:
+            positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+            candidates = np.flatnonzero(~at_risk_mask & (predicted >= self.detour_fill))
+            if len(candidates):
+                nearest = self.nearest_selected(positions, candidates, at_risk)
+                detours = candidates[nearest <= self.detour_meters]
+
+        selected = np.union1d(at_risk, detours)         # sorted
+
+        return {"selected": selected, "at_risk": at_risk, "detours": detours, "predicted": predicted,
+                "hours_to_limit": hours_to_limit, "seconds": time.time() - start}
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(10)
+    num_moloks = 30000
+
+    positions = np.column_stack((rng.normal(57.02, 0.02, num_moloks), rng.normal(9.95, 0.04, num_moloks)))
+    fill_pcts = rng.uniform(0, 100, num_moloks)
+    growthrates = rng.uniform(5, 60, num_moloks) / 86400            # 5 - 60 % pr. day
+
+    static = np.flatnonzero(fill_pcts >= 80)
+    print(f"waste limit 80 %: {len(static)} moloks")
+
+    selector = MolokSelector(horizon_hours=24)
+    selection = selector.select(fill_pcts, growthrates)
+    print(f"predicted overflow: {len(selection['selected'])} moloks in {selection['seconds'] * 1000:.1f} ms")
+    print(f"  missed by the waste limit: {len(np.setdiff1d(selection['at_risk'], static))}, "
+          f"planned too early by the waste limit: {len(np.setdiff1d(static, selection['at_risk']))}")
+
+    selector = MolokSelector(horizon_hours=24, detour_meters=50, detour_fill=80, depot_pos=(57.0257998, 9.9194714))
+    selection = selector.select(fill_pcts, growthrates, positions)
+    print(f"with cheap detours: {len(selection['selected'])} moloks ({len(selection['detours'])} detours) "
+          f"in {selection['seconds'] * 1000:.1f} ms")
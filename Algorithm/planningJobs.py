@@ -0,0 +1,264 @@
+"""
+Route planning as background jobs. Each job runs MasterPlanner in a pool of worker processes, so the process that
+submits it (fx. the Dash GUI) stays responsive, and several plans can run at the same time.
+
+A job gets an ID when submitted. While it runs, its progress (attempt, best objective found, slack added) can be polled
+with 'status'. It can be cancelled, and its result is fetched with 'result' when it is done.
+
+With a checkpoint directory, each job checkpoints its MasterPlanner to '<job ID>.json.gz' in it. If the process stops,
+a new PlanningJobs with the same directory can 'resume' the job under the same ID from its last checkpoint.
+"""
+
+import os
+import time
+import uuid
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from routePlanner import MasterPlanner
+from routeEvaluator import RouteEvaluator, format_routes, format_kpis
+
+
+def run_planning_job(job_id: str, planner_kwargs: dict, molok_ids: list, progress, cancel_event,
+                     resume_from: str = None) -> dict:
+    """
+    Internal method. Runs in a worker process. Plans routes with MasterPlanner(**planner_kwargs), or continues the
+    planning checkpointed in 'resume_from', and writes its progress to the shared 'progress' dictionary under 'job_id'.
+    returns dictionary with 'routes' (indices into the planned moloks and 'depot'), 'visit_times', 'truck_loads',
+    'truck_distances', 'empty_molok_times', 'route_string', 'KPI', 'fleet' (KPIs of RouteEvaluator.evaluate),
+    'added_slack', 'objective' and 'overfill', or None if
+    the job was cancelled. 'molok_ids' are the IDs shown in route_string, one pr. planned molok.
+    raises RuntimeError if no routes were found
+    """
+    def report(state):
+        progress[job_id] = dict(state, started=started)     # reassign, so the change reaches the manager
+
+    started = time.time()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):     # MasterPlanner prints a lot
+        if resume_from is None:
+            mp = MasterPlanner(**planner_kwargs, progress_callback=report, cancel_event=cancel_event)
+        else:
+            mp = MasterPlanner.from_checkpoint(resume_from, progress_callback=report, cancel_event=cancel_event)
+            molok_ids = mp.checkpoint_meta["molok_ids"]
+        mp.report_progress()
+
+        try:
+            mp.master()
+        finally:                                        # only a stopped process leaves its checkpoint to resume from
+            remove_checkpoint(mp.checkpoint_path)
+
+        if mp.cancelled:
+            return None
+        if not hasattr(mp, "empty_molok_times"):        # only set when the last attempt found routes
+            raise RuntimeError(f"No routes found after {mp.goal_tries} attempts. Try a longer time limit or more trucks")
+
+        routes = mp.current_best["routes"]
+        evaluation = RouteEvaluator.from_data(mp.rp.data).evaluate(routes)
+        route_string, KPI = format_routes(evaluation, molok_ids), format_kpis(evaluation)
+        overfill = mp.identify_overfill()
+
+    return {"routes": routes,
+            "visit_times": mp.current_best["visit_times"],
+            "truck_loads": mp.current_best["truck_loads"],
+            "truck_distances": mp.current_best["truck_distances"],
+            "empty_molok_times": mp.empty_molok_times,
+            "route_string": route_string,
+            "KPI": KPI,
+            "fleet": evaluation["fleet"],
+            "added_slack": mp.added_slack,
+            "objective": mp.best_objective,
+            "overfill": overfill,
+            "seconds": time.time() - started}
+
+
+def remove_checkpoint(checkpoint_path: str):
+    """Internal method. Removes a checkpoint file if it exists"""
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+class PlanningJobs:
+
+    def __init__(self, max_workers: int = 2, checkpoint_dir: str = None) -> None:
+        """
+        Runs up to 'max_workers' planning jobs at the same time. Jobs submitted beyond that wait in a queue.
+        Jobs are checkpointed to 'checkpoint_dir' if given, see 'resume'.
+        Create it under 'if __name__ == "__main__"' or lazily, as the worker processes may import the creating module
+        """
+        self.checkpoint_dir = checkpoint_dir
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.dict()                 # job ID -> latest progress reported by the worker
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+        self.jobs = {}                                      # job ID -> {"future", "cancel_event", "submitted"}
+        self.jobs_lock = threading.Lock()                   # jobs are submitted and polled from many server threads
+
+    def submit(self, molok_ids: list = None, **planner_kwargs) -> str:
+        """
+        Submits a planning job. 'planner_kwargs' are the keyword arguments of MasterPlanner, and 'molok_ids' the IDs
+        of the planned moloks used in the route descriptions (defaults to their indices).
+        returns job ID
+        """
+        job_id = uuid.uuid4().hex
+        if molok_ids is None:
+            molok_ids = list(range(len(planner_kwargs["fill_pcts"])))
+
+        if self.checkpoint_dir is not None:
+            planner_kwargs = dict(planner_kwargs, checkpoint_path=self.checkpoint_path(job_id),
+                                  checkpoint_meta={"molok_ids": list(molok_ids)})
+
+        self.start(job_id, planner_kwargs, list(molok_ids))
+        return job_id
+
+    def start(self, job_id: str, planner_kwargs: dict, molok_ids: list, resume_from: str = None):
+        """Internal method. Queues run_planning_job in the worker processes and registers the job"""
+        cancel_event = self.manager.Event()
+        future = self.executor.submit(run_planning_job, job_id, planner_kwargs, molok_ids, self.progress, cancel_event,
+                                      resume_from)
+
+        with self.jobs_lock:
+            self.jobs[job_id] = {"future": future, "cancel_event": cancel_event, "submitted": time.time()}
+
+    def checkpoint_path(self, job_id: str) -> str:
+        """returns path of the checkpoint of a job"""
+        return os.path.join(self.checkpoint_dir, f"{job_id}.json.gz")
+
+    def resumable(self) -> list:
+        """returns IDs of the jobs with a checkpoint that are not running, fx. because the process was restarted"""
+        if self.checkpoint_dir is None:
+            return []
+
+        with self.jobs_lock:
+            known = set(self.jobs)
+        job_ids = [name[:-len(".json.gz")] for name in os.listdir(self.checkpoint_dir) if name.endswith(".json.gz")]
+
+        return [job_id for job_id in job_ids if job_id not in known]
+
+    def resume(self, job_id: str) -> bool:
+        """
+        Continues a job from its checkpoint under the same ID, with the best routes found so far and the time it had
+        left. returns False if the job has no checkpoint or is already known, else True
+        """
+        if job_id not in self.resumable():
+            return False
+
+        self.start(job_id, {}, [], resume_from=self.checkpoint_path(job_id))
+        return True
+
+    def status(self, job_id: str) -> dict:
+        """
+        returns dictionary with 'state' ('queued', 'running', 'cancelling', 'done', 'cancelled', 'failed' or 'unknown')
+        and the latest progress of the job: 'attempt', 'attempts', 'objective', 'slack' and 'time_left'. 'cancelling' is
+        a running job that has been asked to stop. Failed jobs have 'error'
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return {"state": "unknown"}
+
+        status = dict(self.progress.get(job_id, {}))
+        future = job["future"]
+
+        if future.cancelled():
+            status["state"] = "cancelled"
+        elif future.done():
+            if future.exception() is not None:
+                status["state"] = "failed"
+                status["error"] = str(future.exception())
+            elif future.result() is None:
+                status["state"] = "cancelled"
+            else:
+                status["state"] = "done"
+        elif job["cancel_event"].is_set():
+            status["state"] = "cancelling"
+        else:
+            status["state"] = "running" if status else "queued"
+
+        return status
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancels a job. Queued jobs never start. Running jobs stop at the next solution found or at the end of the
+        current attempt.
+        returns False if the job is unknown or already finished, else True
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+        if job is None or job["future"].done():
+            return False
+
+        job["cancel_event"].set()
+        job["future"].cancel()                              # only succeeds if the job hasn't started
+        return True
+
+    def result(self, job_id: str, forget: bool = True) -> dict:
+        """
+        returns result of a finished job (see run_planning_job), or None if it is not done, failed or was cancelled.
+        With 'forget' the job is removed, so its ID becomes unknown
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+        if job is None or not job["future"].done() or job["future"].cancelled() or job["future"].exception() is not None:
+            return None
+
+        result = job["future"].result()
+        if forget:
+            self.forget(job_id)
+
+        return result
+
+    def forget(self, job_id: str):
+        """removes a finished job, its progress and its checkpoint"""
+        with self.jobs_lock:
+            self.jobs.pop(job_id, None)
+        self.progress.pop(job_id, None)
+
+        if self.checkpoint_dir is not None:
+            remove_checkpoint(self.checkpoint_path(job_id))
+
+    def shutdown(self):
+        """cancels all jobs and stops the worker processes"""
+        with self.jobs_lock:
+            job_ids = list(self.jobs)
+        for job_id in job_ids:
+            self.cancel(job_id)
+
+        self.executor.shutdown(wait=True)
+        self.manager.shutdown()
+
+
+if __name__ == "__main__":
+    import numpy as np
+
+    rng = np.random.default_rng(10)
+    num_moloks = 40
+    molok_pos_list = list(zip(rng.normal(57.02, 0.01, num_moloks).tolist(), rng.normal(9.95, 0.02, num_moloks).tolist()))
+
+    planner_kwargs = {"depot_open": 600, "depot_close": 2200, "molok_pos_list": molok_pos_list, "tte_molok": 5,
+                      "fill_pcts": rng.uniform(60, 80, num_moloks).tolist(), "molok_capacity": 500,
+                      "molok_est_growthrates": (rng.uniform(5, 10, num_moloks) / 86400).tolist(), "truck_range": 100,
+                      "num_trucks": 5, "truck_capacity": 3000, "work_start": 600, "work_stop": 1400,
+                      "time_limit_seconds": 6, "num_attempts": 3}
+
+    jobs = PlanningJobs(max_workers=2)
+    first = jobs.submit(**planner_kwargs)
+    second = jobs.submit(**planner_kwargs)
+
+    time.sleep(2)
+    jobs.cancel(second)
+    while jobs.status(first)["state"] not in ("done", "failed", "cancelled"):
+        print(f"first: {jobs.status(first)}  second: {jobs.status(second)}")
+        time.sleep(1)
+
+    print(f"second job: {jobs.status(second)['state']}")
+    result = jobs.result(first)
+    if result is None:
+        print(f"first job: {jobs.status(first)}")
+    else:
+        print(f"first job done in {result['seconds']} seconds. Objective {result['objective']}, routes: {result['routes']}")
+    jobs.shutdown()
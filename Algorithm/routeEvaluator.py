@@ -0,0 +1,328 @@
+"""
+KPIs of route sets, computed from the time and distance matrices instead of the solver. Any set of routes can be
+evaluated: solver output, hand edited routes, cached plans or routes from another planner.
+
+Routes are lists of nodes in the matrices (0 = depot, molok i = node i + 1) like RoutePlanner.get_routes returns, or
+lists of molok indices framed by 'depot' like the final routes of MasterPlanner. Node 0 at the ends of node routes is
+optional, but index routes must start and end with 'depot': without it, molok index 0 would be read as the depot.
+
+All routes of all plans are laid out as one array of nodes, where the depot ending a route also starts the next one:
+
+    [0, a, b, 0, c, 0, 0, ...]  ->  legs (0, a), (a, b), (b, 0), (0, c), (c, 0), (0, 0), ...
+
+so times, distances and loads of every leg are looked up in the matrices at once, and summed pr. route and plan with
+cumsum and bincount. Text for the GUI is made by 'format_routes' and 'format_kpis', separate from the numbers.
+"""
+
+import time
+
+import numpy as np
+
+
+class RouteEvaluator:
+
+    def __init__(self, time_matrix, distance_matrix, demands, time_windows=None, fill_pcts=None, growthrates=None,
+                 truck_range: float = None, truck_capacity: float = None, max_route_time: float = None) -> None:
+        """
+        Inputs:
+        ---
+        - time_matrix, distance_matrix: (n + 1) x (n + 1) matrices in seconds and meters, depot at index 0. Same as
+        RoutePlanner.time_and_dist_matrices returns
+        - demands: kg of each node, depot first
+        - time_windows: [start, end] in seconds from route start of each node, depot first. None means no windows
+        - fill_pcts, growthrates: fillpct and growth in fillpct pr. second of each molok (no depot), for the predicted
+        fill at visit. None means no prediction
+        - truck_range: meters, truck_capacity: kg, max_route_time: seconds. None means no limit
+        """
+        self.time_matrix = np.asarray(time_matrix)
+        self.distance_matrix = np.asarray(distance_matrix)
+        self.demands = np.asarray(demands)
+        self.num_moloks = len(self.time_matrix) - 1
+
+        self.tw_start = self.tw_end = None
+        if time_windows is not None:
+            time_windows = np.asarray(time_windows, dtype=np.float64)
+            self.tw_start, self.tw_end = time_windows[:, 0], time_windows[:, 1]
+
+        # predicted fill at visit is fill + growthrate * visit time. Depot gets 0 so it can be indexed by node
+        self.fill_pcts = self.growthrates = None
+        if fill_pcts is not None and growthrates is not None:
+            self.fill_pcts = np.concatenate(([0.0], np.asarray(fill_pcts, dtype=np.float64)))
+            self.growthrates = np.concatenate(([0.0], np.asarray(growthrates, dtype=np.float64)))
+
+        self.truck_range = np.inf if truck_range is None else truck_range
+        self.truck_capacity = np.inf if truck_capacity is None else truck_capacity
+        self.max_route_time = np.inf if max_route_time is None else max_route_time
+
+    @classmethod
+    def from_data(cls, data: dict):
+        """creates an evaluator from the data model of a RoutePlanner (RoutePlanner.data). Time windows include the
+        slack added by MasterPlanner"""
+        return cls(data["time_matrix"], data["distance_matrix"], data["demands"], data["timeWindows"],
+                   data["molokFillPcts"], data["molok_est_growthrates"], truck_range=data["truckRange"] * 1000,
+                   truck_capacity=max(data["truckCapacities"]),
+                   max_route_time=(data["truckWorkStop"] - data["truckWorkStart"]) * 60)     # same as the Time dimension
+
+    def route_nodes(self, route) -> list:
+        """Internal method. returns the moloks of a route as nodes, without depots. Raises ValueError if a route with
+        'depot' entries is not framed by them, as its form would be ambiguous"""
+        if len(route) and route[0] == "depot" and route[-1] == "depot":     # molok indices, shift to nodes
+            return [node + 1 for node in route[1:-1]]
+        if any(node == "depot" for node in route):
+            raise ValueError(f"route {route} of molok indices must start and end with 'depot'")
+        return [node for node in route if node != 0]
+
+    def layout(self, plans: list) -> tuple:
+        """
+        Internal method. Lays out all routes of all plans as one array of nodes, see the module docstring.
+        returns (nodes, route of each leg, plan of each route, moloks pr. route)
+        """
+        nodes = [0]
+        route_stops = []
+        route_plan = []
+
+        for plan_num, routes in enumerate(plans):
+            for route in routes:
+                stops = self.route_nodes(route)
+                nodes.extend(stops)
+                nodes.append(0)                             # ends this route and starts the next
+                route_stops.append(len(stops))
+                route_plan.append(plan_num)
+
+        route_stops = np.array(route_stops, dtype=np.int64)
+        leg_route = np.repeat(np.arange(len(route_stops)), route_stops + 1)     # a route has one leg more than moloks
+
+        return np.array(nodes, dtype=np.int64), leg_route, np.array(route_plan, dtype=np.int64), route_stops
+
+    def legs(self, plans: list) -> dict:
+        """
+        Internal method. Evaluates every leg of every route.
+        returns dictionary of arrays with one entry pr. leg ('to', 'route', 'arrival', 'distance', 'load', 'lateness',
+        'predicted_fill') and pr. route ('plan', 'stops', 'route_time', 'route_distance', 'route_load',
+        'route_violations', 'route_lateness', 'route_max_fill')
+        """
+        nodes, leg_route, route_plan, route_stops = self.layout(plans)
+        frm, to = nodes[:-1], nodes[1:]
+        num_routes = len(route_stops)
+
+        # first leg of each route. Cumulative sums are taken over all legs and made relative to the start of each route
+        first_leg = np.concatenate(([0], np.cumsum(route_stops + 1)[:-1])).astype(np.int64)
+
+        def cumulative(leg_values):
+            cum = np.cumsum(leg_values)
+            route_offset = cum[first_leg] - leg_values[first_leg] if num_routes else cum[:0]
+            return cum - route_offset[leg_route]
+
+        arrival = cumulative(self.time_matrix[frm, to])
+        distance = cumulative(self.distance_matrix[frm, to])
+        load = cumulative(self.demands[to])
+
+        is_visit = to != 0
+        lateness = np.zeros(len(to))
+        if self.tw_end is not None:
+            lateness = np.where(is_visit, np.maximum(arrival - self.tw_end[to], 0) + np.maximum(self.tw_start[to] - arrival, 0), 0)
+
+        predicted_fill = np.full(len(to), np.nan)
+        if self.fill_pcts is not None:
+            predicted_fill = np.where(is_visit, self.fill_pcts[to] + self.growthrates[to] * arrival, np.nan)
+
+        last_leg = first_leg + route_stops                  # the leg back to the depot, so cumulative values are totals
+        route_max_fill = np.full(num_routes, np.nan)
+        if num_routes and self.fill_pcts is not None:
+            visited_routes = route_stops > 0
+            route_max_fill[visited_routes] = np.maximum.reduceat(np.where(is_visit, predicted_fill, -np.inf),
+                                                                 first_leg)[visited_routes]
+
+        return {"to": to, "route": leg_route, "arrival": arrival, "distance": distance, "load": load,
+                "lateness": lateness, "predicted_fill": predicted_fill,
+                "plan": route_plan, "stops": route_stops, "route_time": arrival[last_leg],
+                "route_distance": distance[last_leg], "route_load": load[last_leg],
+                "route_violations": np.bincount(leg_route, weights=lateness > 0, minlength=num_routes).astype(np.int64),
+                "route_lateness": np.bincount(leg_route, weights=lateness, minlength=num_routes),
+                "route_max_fill": route_max_fill}
+
+    def fleet(self, legs: dict, num_plans: int) -> dict:
+        """Internal method. Sums the routes of each plan. returns dictionary of arrays with one entry pr. plan"""
+        plan = legs["plan"]
+        used = legs["stops"] > 0
+
+        def per_plan(values):
+            return np.bincount(plan, weights=values, minlength=num_plans)
+
+        trucks_used = per_plan(used).astype(np.int64)
+        moloks_visited = per_plan(legs["stops"]).astype(np.int64)
+        total_time = per_plan(legs["route_time"]).astype(legs["route_time"].dtype)     # keep ints of the matrices
+        total_distance = per_plan(legs["route_distance"]).astype(legs["route_distance"].dtype)
+        total_load = per_plan(legs["route_load"]).astype(legs["route_load"].dtype)
+
+        # unique moloks pr. plan, so moloks missing from or visited twice in hand edited routes are found
+        visit_plan = plan[legs["route"]][legs["to"] != 0]
+        unique_visits = np.unique(visit_plan * (self.num_moloks + 1) + legs["to"][legs["to"] != 0])
+        unique_moloks = np.bincount(unique_visits // (self.num_moloks + 1), minlength=num_plans)
+
+        over_range = per_plan(legs["route_distance"] > self.truck_range)
+        over_capacity = per_plan(legs["route_load"] > self.truck_capacity)
+        over_time = per_plan(legs["route_time"] > self.max_route_time)
+
+        max_route_time = np.zeros(num_plans, dtype=legs["route_time"].dtype)
+        np.maximum.at(max_route_time, plan, legs["route_time"])
+
+        predicted_fill = legs["predicted_fill"]
+        overfilled = np.bincount(visit_plan, weights=predicted_fill[legs["to"] != 0] > 100, minlength=num_plans)
+
+        with np.errstate(divide="ignore", invalid="ignore"):    # plans without used trucks get 0 averages
+            divisor = np.where(trucks_used > 0, trucks_used, 1)
+
+            return {"trucks_used": trucks_used,
+                    "moloks_visited": moloks_visited,
+                    "unvisited": self.num_moloks - unique_moloks,
+                    "duplicates": moloks_visited - unique_moloks,
+                    "total_time": total_time,
+                    "total_distance": total_distance,
+                    "total_load": total_load,
+                    "max_route_time": max_route_time,
+                    "avg_moloks_pr_route": moloks_visited / divisor,
+                    "avg_time_pr_route": total_time / divisor,
+                    "avg_distance_pr_route": total_distance / divisor,
+                    "avg_load_pr_route": total_load / divisor,
+                    "tw_violations": per_plan(legs["route_violations"]).astype(np.int64),
+                    "lateness": per_plan(legs["route_lateness"]),
+                    "overfilled": overfilled.astype(np.int64),
+                    "over_range": over_range.astype(np.int64),
+                    "over_capacity": over_capacity.astype(np.int64),
+                    "over_time": over_time.astype(np.int64),
+                    "feasible": (per_plan(legs["route_violations"]) + over_range + over_capacity + over_time) == 0}
+
+    def evaluate_many(self, plans: list) -> dict:
+        """
+        Evaluates many plans (lists of routes) at once, fx. candidates from a search.
+        returns dictionary of arrays with one entry pr. plan, see 'evaluate' for the keys of 'fleet'
+        """
+        return self.fleet(self.legs(plans), len(plans))
+
+    def cumul_data(self, routes: list) -> tuple:
+        """
+        returns (visit_times, truck_loads, truck_distances) of a plan on the same form as RoutePlanner.get_cumul_data:
+        one list pr. route with a value pr. node, depots included. Loads are before emptying the molok, like the solver
+        """
+        legs = self.legs([routes])
+        bounds = np.cumsum(legs["stops"] + 1)[:-1]         # legs of each route
+        loads_before = legs["load"] - self.demands[legs["to"]]
+
+        return tuple([[0] + route_values.tolist() for route_values in np.split(values, bounds)]
+                     for values in (legs["arrival"], loads_before, legs["distance"]))
+
+    def evaluate(self, routes: list) -> dict:
+        """
+        Evaluates a single plan.
+        returns dictionary with:
+        - 'routes': arrays with one entry pr. route: 'stops', 'time' (s), 'distance' (m), 'load' (kg),
+        'tw_violations', 'lateness' (s past the time windows), 'max_fill' (predicted fillpct), and 'range_slack',
+        'capacity_slack', 'time_slack' (left before the limits)
+        - 'visits': arrays with one entry pr. molok visit: 'route', 'molok' (index, no depot), 'arrival' (s from route
+        start), 'distance' and 'load' (cumulative, after emptying the molok), 'lateness' and 'predicted_fill'
+        - 'fleet': totals and averages of the plan: 'trucks_used', 'moloks_visited', 'unvisited', 'duplicates',
+        'total_time', 'total_distance', 'total_load', 'max_route_time', 'avg_..._pr_route', 'tw_violations',
+        'lateness', 'overfilled', 'over_range', 'over_capacity', 'over_time' and 'feasible'
+        - 'seconds': time spent evaluating
+        """
+        start = time.time()
+        legs = self.legs([routes])
+        fleet = {key: value[0].item() for key, value in self.fleet(legs, 1).items()}
+
+        visit = legs["to"] != 0
+        return {"routes": {"stops": legs["stops"], "time": legs["route_time"], "distance": legs["route_distance"],
+                           "load": legs["route_load"], "tw_violations": legs["route_violations"],
+                           "lateness": legs["route_lateness"], "max_fill": legs["route_max_fill"],
+                           "range_slack": self.truck_range - legs["route_distance"],
+                           "capacity_slack": self.truck_capacity - legs["route_load"],
+                           "time_slack": self.max_route_time - legs["route_time"]},
+                "visits": {"route": legs["route"][visit], "molok": legs["to"][visit] - 1,
+                           "arrival": legs["arrival"][visit], "distance": legs["distance"][visit],
+                           "load": legs["load"][visit], "lateness": legs["lateness"][visit],
+                           "predicted_fill": legs["predicted_fill"][visit]},
+                "fleet": fleet,
+                "seconds": time.time() - start}
+
+
+def format_routes(evaluation: dict, molok_ids: list = None) -> str:
+    """
+    returns markdown of the routes in an evaluation from RouteEvaluator.evaluate, one pr. used truck.
+    'molok_ids' are the IDs shown for the moloks (defaults to their indices)
+    """
+    routes = evaluation["routes"]
+    visits = evaluation["visits"]
+    route_string = ""
+
+    for truck in np.flatnonzero(routes["stops"] > 0):
+        stops = visits["molok"][visits["route"] == truck]
+        names = [str(molok_ids[molok]) if molok_ids is not None else str(molok) for molok in stops]
+        route_time = int(routes["time"][truck])
+
+        route_string += f"  \n  \nTruck {truck}'s route with molok ID:"
+        route_string += f"  \nTruck {truck}: depot --> " + " --> ".join(names) + " --> depot"
+        route_string += f"  \nRoutes total time: {route_time // 60}:{route_time % 60} min   \nRoutes total distance: {routes['distance'][truck] / 1000} km   \nRoutes total load: {routes['load'][truck]} kg"
+
+    return route_string
+
+
+def format_kpis(evaluation: dict) -> str:
+    """returns markdown of the key performance indicators in an evaluation from RouteEvaluator.evaluate"""
+    fleet = evaluation["fleet"]
+    if fleet["trucks_used"] == 0:
+        return "  \n___Key performance indicators___  \n  \nNo trucks utilized   \n"
+
+    total_time = int(fleet["total_time"])
+    avg_secs_pr_route = fleet["avg_time_pr_route"]
+
+    final_string = f"  \n___Key performance indicators___  \n  \nMoloks emptied: {fleet['moloks_visited']}   \n"
+    final_string += f"Trucks utilized: {fleet['trucks_used']}   \n"
+    final_string += f"Total time spent: {total_time // 60}:{total_time % 60} min   \nTotal distance driven: {fleet['total_distance'] / 1000} km   \nTotal load collected: {fleet['total_load']} kg   \n"
+    final_string += f"Average number of moloks pr. route: {fleet['avg_moloks_pr_route']} moloks/route   \n"
+    final_string += f"Average time spent pr. route: {int(avg_secs_pr_route // 60)}:{int(avg_secs_pr_route % 60)} min/route   \n"
+    final_string += f"Average distance driven pr. route: {fleet['avg_distance_pr_route'] / 1000} km/route   \n"
+    final_string += f"Average load collected pr. route: {fleet['avg_load_pr_route']} kg/route   \n"
+
+    if fleet["tw_violations"]:
+        final_string += f"Time window violations: {fleet['tw_violations']} ({int(fleet['lateness'])} s late in total)   \n"
+    if fleet["overfilled"]:
+        final_string += f"Moloks predicted overfilled at visit: {fleet['overfilled']}   \n"
+
+    return final_string
+
+
+if __name__ == "__main__":
+    import support_functions as sf
+
+    rng = np.random.default_rng(10)
+    num_moloks = 60
+    num_trucks = 9
+
+    positions = np.column_stack((rng.normal(57.02, 0.01, num_moloks), rng.normal(9.95, 0.02, num_moloks)))
+    locations = np.concatenate(([[57.0257998, 9.9194714]], positions))
+    distance_matrix = np.round(sf.pairwise_meters(locations, locations)).astype(np.int64)
+    time_matrix = np.round(distance_matrix / (50 / 3.6)).astype(np.int64) + 300     # 50 km/h and 5 min to empty
+    time_matrix[0, :] -= 300
+    np.fill_diagonal(time_matrix, 0)
+
+    fill_pcts = rng.uniform(60, 90, num_moloks)
+    growthrates = rng.uniform(5, 60, num_moloks) / 86400
+    demands = np.concatenate(([0], np.round(fill_pcts / 100 * 500))).astype(np.int64)
+    time_windows = [[0, 8 * 3600]] + sf.molokTimeWindows(fill_pcts, growthrates, slack=0)
+
+    evaluator = RouteEvaluator(time_matrix, distance_matrix, demands, time_windows, fill_pcts, growthrates,
+                               truck_range=100000, truck_capacity=3000, max_route_time=8 * 3600)
+
+    routes = [[0] + (np.arange(truck, num_moloks, num_trucks) + 1).tolist() + [0] for truck in range(num_trucks)]
+    evaluation = evaluator.evaluate(routes)
+    print(format_routes(evaluation))
+    print(format_kpis(evaluation))
+    print(f"range slack pr. route: {evaluation['routes']['range_slack']}")
+
+    plans = [[rng.permutation(route[1:-1]).tolist() for route in routes] for _ in range(5000)]
+    start = time.time()
+    fleet = evaluator.evaluate_many(plans)
+    seconds = time.time() - start
+    best = np.argmin(np.where(fleet["feasible"], fleet["total_distance"], np.inf))
+    print(f"Evaluated {len(plans)} plans in {seconds} seconds ({len(plans) / seconds:.0f} plans/s). "
+          f"{fleet['feasible'].sum()} feasible, shortest {fleet['total_distance'][best] / 1000} km")
@@ -6,6 +6,9 @@ https://developers.google.com/optimization/routing/dimensions
 If they were not enough, read the entire routing section on the page from top to bottom.
 """
 
+import os
+import gzip
+import json
 import numpy as np
 import time
 from ortools.constraint_solver import routing_enums_pb2
@@ -13,6 +16,10 @@ from ortools.constraint_solver import pywrapcp
 
 # our support functions
 import support_functions as sf
+from routeEvaluator import RouteEvaluator, format_routes, format_kpis
+from localSearch import LocalSearch
+
+CHECKPOINT_VERSION = 1                                      # bump when the checkpoint format changes
 
 
 class MasterPlanner:
@@ -21,7 +28,9 @@ class MasterPlanner:
                  fill_pcts: list, molok_capacity: int, molok_est_growthrates: list, truck_range: int, num_trucks: int,
                  truck_capacity: int, work_start: int, work_stop: int, time_limit_seconds: int, depot_pos: tuple = 
                  (57.0257998,9.9194714), first_solution_strategy: int = "1", local_search_strategy: int = "3",
-                 num_attempts: int = 10) -> None:
+                 num_attempts: int = 10, progress_callback = None, cancel_event = None, post_optimize: bool = False,
+                 checkpoint_path: str = None, checkpoint_interval: float = 5, checkpoint_meta: dict = None,
+                 warm_start_routes: list = None) -> None:
         """
         contains all inputs and meta parameters
         
@@ -58,6 +67,22 @@ class MasterPlanner:
             - '4' = TABU_SEARCH
 
         - num_attempts: The number of attempts that the master planner will try to plan routes using the route planner
+
+        - progress_callback: optional function called with a dictionary of 'attempt', 'attempts', 'objective' (best
+        objective found so far), 'slack' and 'time_left' every time a solution is found and after each attempt
+        - cancel_event: optional threading/multiprocessing Event. When set, planning stops at the next solution found or
+        at the end of the current attempt, and self.cancelled is set to True
+        - post_optimize: improve the final routes with LocalSearch in the time left when the last attempt finishes
+        before the time limit. The improved routes are only kept if they are cheaper
+
+        - checkpoint_path: optional path of a gzipped JSON file. The inputs and the state of the planning are written to
+        it after each attempt and when a better solution is found, so the planning can be resumed with
+        'MasterPlanner.from_checkpoint' if the process stops
+        - checkpoint_interval: min seconds between checkpoints of better solutions within an attempt
+        - checkpoint_meta: extra JSON data saved with the checkpoint, fx. the molok IDs of a planning job
+
+        - warm_start_routes: optional initial routes as lists of indices into 'molok_pos_list', fx. from
+        warmStart.warm_start_routes. The first attempt searches from them instead of building a first solution
         """
 
         # --- depot vars ---
@@ -90,7 +115,11 @@ class MasterPlanner:
             "truck_loads": [],
             "truck_distances": []
         }
+        if warm_start_routes:                               # same form as the routes of the solver, depot = 0
+            self.current_best['routes'] = [[0] + [molok + 1 for molok in route] + [0] for route in warm_start_routes]
+            print(f"Warm starting from {len(warm_start_routes)} routes")
         self.rp = None
+        self.best_objective = None                          # lowest objective value found by OR-Tools in any attempt
 
         # --- control vars ---
         self.molok_ids = list(range(len(self.fill_pcts)))   # list of all true molok IDs
@@ -107,6 +136,21 @@ class MasterPlanner:
         self.time_limit = time_limit_seconds                # seconds for MasterPlanner to try to optimize routes
         self.max_time = time.time() + self.time_limit       # epoch time when MP must be done
 
+        # --- progress and cancellation ---
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+        self.cancelled = False
+
+        # --- post optimization ---
+        self.post_optimize = post_optimize
+        self.post_optimization = None                       # result of LocalSearch.improve, if it ran
+
+        # --- checkpoints ---
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_meta = checkpoint_meta
+        self.last_checkpoint = 0                            # epoch time of the last checkpoint written
+
 
     # --- internal methods ---
     def add_action(self, action_type: str, value):
@@ -134,6 +178,93 @@ class MasterPlanner:
 
         return routes
 
+    def report_progress(self, objective = None):
+        """Internal method. Calls progress_callback (if given) with the current state of the planning"""
+        if objective is not None and (self.best_objective is None or objective < self.best_objective):
+            self.best_objective = objective
+
+        if self.progress_callback:
+            self.progress_callback({"attempt": min(self.try_num, self.goal_tries), "attempts": self.goal_tries,
+                                    "objective": self.best_objective, "slack": self.added_slack,
+                                    "time_left": max(self.max_time - time.time(), 0)})
+
+    def on_solution(self, objective):
+        """Internal method. Called by the RoutePlanner every time OR-Tools finds a solution"""
+        improved = self.best_objective is None or objective < self.best_objective
+        self.report_progress(objective)
+
+        if improved and self.checkpoint_path and time.time() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint(routes=self.rp.current_routes())
+
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            self.rp.routing.solver().FinishCurrentSearch()      # OR-Tools returns the best solution so far
+
+    def checkpoint(self, routes: list = None):
+        """
+        Internal method. Writes inputs and state to self.checkpoint_path. 'routes' are the routes of a solution found
+        within the current attempt. They replace the current best routes in the checkpoint, without cumulative data.
+        The file is replaced atomically, so a stop while writing leaves the previous checkpoint
+        """
+        current_best = self.current_best
+        if routes is not None:
+            current_best = {"routes": routes, "visit_times": [], "truck_loads": [], "truck_distances": []}
+
+        state = {"version": CHECKPOINT_VERSION,
+                 "inputs": {"depot_open": self.depot_open, "depot_close": self.depot_close,
+                            "molok_pos_list": self.molok_pos_list, "tte_molok": self.tte_molok,
+                            "fill_pcts": self.fill_pcts, "molok_capacity": self.molok_capacity,
+                            "molok_est_growthrates": self.molok_est_gr, "truck_range": self.truck_range,
+                            "num_trucks": self.num_trucks, "truck_capacity": self.truck_capacity,
+                            "work_start": self.work_start, "work_stop": self.work_stop,
+                            "time_limit_seconds": self.time_limit, "depot_pos": self.depot_pos,
+                            "first_solution_strategy": self.first_solution_strat,
+                            "local_search_strategy": self.local_search_strat, "num_attempts": self.goal_tries,
+                            "post_optimize": self.post_optimize, "checkpoint_interval": self.checkpoint_interval,
+                            "checkpoint_meta": self.checkpoint_meta},
+                 "try_num": self.try_num,
+                 "current_best": current_best,
+                 "actions_taken": self.actions_taken,
+                 "added_slack": self.added_slack,
+                 "molok_id_mapping": list(self.molok_id_mapping.items()),       # JSON keys can't be ints
+                 "best_objective": self.best_objective,
+                 "time_left": max(self.max_time - time.time(), 0)}
+
+        tmp_path = self.checkpoint_path + ".tmp"
+        with gzip.open(tmp_path, "wt", compresslevel=5) as file:
+            json.dump(state, file, separators=(",", ":"))
+        os.replace(tmp_path, self.checkpoint_path)
+
+        self.last_checkpoint = time.time()
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path: str, progress_callback = None, cancel_event = None):
+        """
+        Creates a MasterPlanner from a checkpoint written by 'checkpoint'. Calling 'master' continues the planning from
+        the attempt it stopped in, with the best routes found as initial routes and the time that was left.
+        Keeps writing checkpoints to 'checkpoint_path'.
+        raises ValueError if the checkpoint is from another version of the format
+        """
+        with gzip.open(checkpoint_path, "rt") as file:
+            state = json.load(file)
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Checkpoint {checkpoint_path} has version {state.get('version')}, expected {CHECKPOINT_VERSION}")
+
+        inputs = state["inputs"]
+        inputs["molok_pos_list"] = [tuple(pos) for pos in inputs["molok_pos_list"]]
+        inputs["depot_pos"] = tuple(inputs["depot_pos"])
+
+        mp = cls(**inputs, progress_callback=progress_callback, cancel_event=cancel_event, checkpoint_path=checkpoint_path)
+        mp.try_num = state["try_num"]
+        mp.current_best = state["current_best"]
+        mp.actions_taken = state["actions_taken"]
+        mp.added_slack = state["added_slack"]
+        mp.molok_id_mapping = dict(state["molok_id_mapping"])
+        mp.best_objective = state["best_objective"]
+        mp.max_time = time.time() + max(state["time_left"], 1)     # OR-Tools needs at least a second
+
+        print(f"Resuming from attempt {mp.try_num} of {mp.goal_tries} with {state['time_left']} seconds left")
+        return mp
+
     def add_slack_to_tw(self):
         """Adds slack to time windows, allowing moloks to be overfilled if no solution exists. This might help the
         RoutePlanner actually create routes. If added_slack reaches slack_max, a molok should be droppen instead of
@@ -177,7 +308,8 @@ class MasterPlanner:
                                time_limit=timelimit_for_curr_try,
                                first_solution_strategy=self.first_solution_strat,
                                local_search_strategy=self.local_search_strat,
-                               initial_routes=initial_routes)
+                               initial_routes=initial_routes,
+                               solution_callback=self.on_solution)
         
         return True
 
@@ -212,6 +344,11 @@ class MasterPlanner:
         """
         while self.try_num <= self.goal_tries:
 
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                print("Planning cancelled")
+                self.cancelled = True
+                break
+
             print(f"\n---------- attempt {self.try_num} of {self.goal_tries} ----------")
 
             success = self.prep_rp()
@@ -220,6 +357,11 @@ class MasterPlanner:
             
             solver_status, routes, visit_times, truck_loads, truck_distances = self.run_rp()
 
+            if self.cancel_event is not None and self.cancel_event.is_set():    # search was finished early by on_solution
+                print("Planning cancelled")
+                self.cancelled = True
+                break
+
             # solver status = 0 means not solved yet, 1 means solved, 2 means no solution found,
             # 3 means timeout, 4 means invalid model
             if solver_status != 1:                          # check if solution exists
@@ -233,6 +375,9 @@ class MasterPlanner:
                 self.add_slack_to_tw()
 
                 self.try_num += 1     # after action is taken, increment and continue to next try
+                self.report_progress()
+                if self.checkpoint_path and self.try_num <= self.goal_tries:
+                    self.checkpoint()
                 continue                                    
 
 
@@ -257,6 +402,36 @@ class MasterPlanner:
                 print(f"Solution found - jumping to last try to give it the remaining time to find best solution within time limit")
                 self.try_num = self.goal_tries                      # go to last try
 
+            self.report_progress()
+            if self.checkpoint_path and self.try_num <= self.goal_tries:  # the final routes are in another form
+                self.checkpoint()
+
+        if self.post_optimize and not self.cancelled and hasattr(self, "empty_molok_times"):
+            self.post_optimize_routes()
+
+    def post_optimize_routes(self):
+        """Improves the final routes with LocalSearch until the time limit. The current best routes and their cumulative
+        data are replaced if the improved routes are cheaper"""
+        evaluator = RouteEvaluator.from_data(self.rp.data)
+        self.post_optimization = LocalSearch(evaluator, deadline=self.max_time).improve(self.current_best['routes'])
+        print(f"Post optimization: {self.post_optimization['initial_cost']} -> {self.post_optimization['cost']} in "
+              f"{self.post_optimization['seconds']} seconds. Moves: {self.post_optimization['moves']}")
+
+        if not self.post_optimization['improved']:
+            return
+
+        # back to the form of the final routes: 'depot' and true molok IDs
+        routes = [['depot'] + [node - 1 for node in route[1:-1]] + ['depot'] for route in self.post_optimization['routes']]
+        visit_times, truck_loads, truck_distances = evaluator.cumul_data(routes)
+
+        self.current_best['routes'] = routes
+        self.current_best['visit_times'] = visit_times
+        self.current_best['truck_loads'] = truck_loads
+        self.current_best['truck_distances'] = truck_distances
+        self.empty_molok_times = self.rp.get_molok_empty_timestamps(routes, visit_times)
+
+        self.report_progress(self.post_optimization['cost'])
+
     def identify_overfill(self):
         """Returns a list of tuples. Each tuple contains a molok id, its timewindow, when it was visited and its fillpct
         at visit time"""
@@ -267,8 +442,7 @@ class MasterPlanner:
             visit_times = self.current_best['visit_times']
             gwrs = self.rp.data['molok_est_growthrates']
 
-            tws = self.rp.data['timeWindows']
-            tws.pop(0)          # remove depot tw at index 0
+            tws = self.rp.data['timeWindows'][1:]          # without depot tw at index 0
 
 
             for route_id, route_list in enumerate(routes):  # loop over each route and save its id (route 0, 1,...,n) and the route itself
@@ -298,7 +472,8 @@ class RoutePlanner:
                  solution_limit = None,
                  first_solution_strategy: str = "1",
                  local_search_strategy: str = "3",
-                 initial_routes = None) -> None:
+                 initial_routes = None,
+                 solution_callback = None) -> None:
         """
         Executed when initializing a routePlanner-object
 
@@ -357,6 +532,10 @@ class RoutePlanner:
         self.capacity_constraint = self.add_capacity_constraint()
         self.range_constraint = self.add_truckrange_constraint()
 
+        # report each solution found (fx. as progress in the GUI) with its objective value
+        if solution_callback is not None:
+            self.routing.AddAtSolutionCallback(lambda: solution_callback(self.routing.CostVar().Value()))
+
     # --- Methods for creating data model ---
     def createManager(self):
         """Create the routing index manager"""
@@ -372,7 +551,6 @@ class RoutePlanner:
         This means that empty time is NOT applied from depot to molok, but only from molok to molok or molok to depot"""
 
         locations = [depotPos] + molokPos
-        numMoloks = len(molokPos)
         molok_ET = time_to_empty_molok * 60 # min to sec
 
         # generalisation on truck speed
@@ -381,26 +559,14 @@ class RoutePlanner:
         
         start_time = time.time()
 
-        time_matrix = np.zeros(shape=(numMoloks + 1, numMoloks + 1), dtype=np.int64) # +1 because of the depot at ij = 00.
-        distance_matrix = np.zeros_like(time_matrix)
-
-        for i in range(len(locations)): # row index
-            row_length = len(locations) # Only calc all entries over main diagonal, so i + 1 is subtracted from j's range
-            for j in range(i + 1, row_length): # j is column-index.
-                
-                distance = sf.decimaldegrees_to_meters(locations[i], locations[j])
-                
-                distance_matrix[i][j] = round(distance)
-                distance_matrix[j][i] = round(distance)
-
-                drive_time = round((distance / speed_mtr_pr_sec) + molok_ET, 0) # round to whole seconds. OR-Tools requires ints
-                
-                # mirror entries in main daigonal, so that molok i to j is same as j to i, except from depot(i = 0) to j
-                if i == 0:
-                    time_matrix[i][j] = drive_time - molok_ET
-                else:
-                    time_matrix[i][j] = drive_time
-                time_matrix[j][i] = drive_time
+        # all distances at once. +1 because of the depot at ij = 00.
+        distances = sf.pairwise_meters(locations, locations)
+        distance_matrix = np.round(distances).astype(np.int64)
+
+        drive_times = np.round((distances / speed_mtr_pr_sec) + molok_ET) # round to whole seconds. OR-Tools requires ints
+        drive_times[0, :] -= molok_ET       # no empty time from depot(i = 0) to j, but from j back to the depot
+        np.fill_diagonal(drive_times, 0)
+        time_matrix = drive_times.astype(np.int64)
         
         finish_time = time.time()
 
@@ -564,6 +730,25 @@ class RoutePlanner:
 
         return routes
 
+    def current_routes(self) -> list:
+        """
+        Routes of the solution being reported, read from the solver's variables. Same form as 'get_routes'.
+        Only valid inside a solution callback
+        """
+        routes = []
+
+        for truck_num in range(self.routing.vehicles()):
+            index = self.routing.Start(truck_num)
+            route = [self.manager.IndexToNode(index)]
+
+            while not self.routing.IsEnd(index):
+                index = self.routing.NextVar(index).Value()
+                route.append(self.manager.IndexToNode(index))
+
+            routes.append(route)
+
+        return routes
+
     def get_cumul_data(self, solution, routing, dimension):
         """
         Get cumulative data from a dimension and store it in a list.
@@ -614,72 +799,23 @@ class RoutePlanner:
 
         return molok_IDs_and_empty_time                     # list of tuples of (ID, time in seconds)
 
-    def print_solution(self, routes: list, visit_times: list, cumul_load: list, cumul_dist) -> None:
-        """Prints solution along with cumulative data and stats on routes"""
-
+    def print_solution(self, routes: list, molok_ids: list = None) -> tuple:
+        """
+        Prints solution along with stats on routes. KPIs are computed by RouteEvaluator from the data model, so
+        'routes' can be the solver's routes or the final routes of MasterPlanner. 'molok_ids' are the IDs shown
+        returns (route string, KPI string)
+        """
         print("  \n________Route Planner output________")
-        # print(f'Objective: {solution.ObjectiveValue()}')        # Tror det er OR-Tools gæt på optimal værdi af total tid
-        
-        total_time = 0
-        total_dist = 0
-        total_load = 0
-        num_trucks = len(routes)
-        trucks_utilized = 0
-        route_string = ""
 
-        for truck in range(num_trucks):
-            route_lst = routes[truck]                           # save trucks route to var
-
-            if len(route_lst) > 2:
-            
-                route_string += f"  \n  \nTruck {truck}'s route with molok ID:"
-                route_string +=  f"  \nTruck {truck}: "                   # begin route at depot
-                
-                route_visit_times = visit_times[truck]              # save trucks visit times to var
-                route_cumul_load = cumul_load[truck]                # save trucks cumulative load to var
-                route_cumul_dist = cumul_dist[truck]                # save trucks cumulative distance to var
-
-                stops = len(route_lst)
-                for stop_num in range(stops):                       # loop over the length of trucks route
-                    node = route_lst[stop_num]                      # molok or depot index (if 0)
-                    node_time = route_visit_times[stop_num]         # visit time at node
-                    mins_secs = f"{node_time // 60}:{node_time % 60}"
-                    node_cumul_load = route_cumul_load[stop_num]    # cumulative load at node
-                    node_cumul_dist = route_cumul_dist[stop_num]    # cumulative distance at node
-                    node_cumul_dist = node_cumul_dist / 1000        # convert to km
-                    
-                    route_string += f"{node}"
-
-                    if stop_num < stops - 1:                        # add an arrow between nodes
-                        route_string += " --> "
-                    
-                    elif stop_num == stops - 1:                     # add totals to end of route string
-                        route_string += f"  \nRoutes total time: {node_time // 60}:{node_time % 60} min   \nRoutes total distance: {node_cumul_dist} km   \nRoutes total load: {node_cumul_load} kg"
-                        total_time += node_time                     # count total time
-                        total_load += node_cumul_load               # count total load
-                        total_dist += node_cumul_dist               # count total distance
-
-                        if node_time != 0:                          # If truck actually left depot, count it as utilized
-                            trucks_utilized += 1 
-
-                print(route_string)
-        
-        # --- key performance indicators ---
-        num_moloks = len(self.data['molokPositions'])
-        final_string = f"  \n___Key performance indicators___  \n  \nMoloks emptied: {num_moloks}   \n"
-        final_string += f"Trucks utilized: {trucks_utilized}   \n"
-        final_string += f"Total time spent: {total_time // 60}:{total_time % 60} min   \nTotal distance driven: {total_dist} km   \nTotal load collected: {total_load} kg   \n"
-        final_string += f"Average number of moloks pr. route: {num_moloks / trucks_utilized} moloks/route   \n"
-        avg_secs_pr_route = total_time / trucks_utilized
-        final_string += f"Average time spent pr. route: {int(avg_secs_pr_route // 60)}:{int(avg_secs_pr_route % 60)} min/route   \n"
-        final_string += f"Average distance driven pr. route: {total_dist / trucks_utilized} km/route   \n"
-        final_string += f"Average load collected pr. route: {total_load / trucks_utilized} kg/route   \n"
+        evaluation = RouteEvaluator.from_data(self.data).evaluate(routes)
+        route_string = format_routes(evaluation, molok_ids)
+        final_string = format_kpis(evaluation)
 
+        print(route_string)
         print(final_string)
 
         return route_string, final_string
 
-
     def main(self):
         """Runs the show"""
 
@@ -706,11 +842,12 @@ class RoutePlanner:
             self.routing.CloseModelWithParameters(search_parameters)
             initial_solution = self.routing.ReadAssignmentFromRoutes(self.data['initial_routes'], True)
 
+        # if no initial routes are passed in, or they can't be read (fx. more routes than trucks), solve from the ground up.
+        if self.data['initial_routes'] != None and initial_solution != None:
             solution = self.routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
             solver_status = self.routing.status()
             print("Solver status: ", solver_status)
 
-        # if no initial routes are passed in, solve from the ground up.
         else:
             solution = self.routing.SolveWithParameters(search_parameters)
 
@@ -764,6 +901,6 @@ if __name__ == "__main__":
     overfill = mp.identify_overfill()
     print(overfill)
     print(mp.rp.data)
-    # mp.rp.print_solution(mp.current_best['routes'], mp.current_best['visit_times'], mp.current_best['truck_loads'], mp.current_best['truck_distances'])
+    # mp.rp.print_solution(mp.current_best['routes'])
 
     exit()
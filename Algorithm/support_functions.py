@@ -24,6 +24,37 @@ def decimaldegrees_to_meters(coords_tuple1, coords_tuple2):
     return d * 1000 # ganges til meter
 
 
+def pairwise_meters(coords1, coords2):
+    """haversine distance in meters between every point in 'coords1' and every point in 'coords2'.
+    Same formula as 'decimaldegrees_to_meters', but on arrays of (lat, long), so a whole matrix is computed at once.
+    returns array of shape (len(coords1), len(coords2))"""
+
+    R = 6371 # earth's radius in km.
+
+    coords1 = np.radians(np.asarray(coords1, dtype=np.float64).reshape(-1, 2))
+    coords2 = np.radians(np.asarray(coords2, dtype=np.float64).reshape(-1, 2))
+    lat1, long1 = coords1[:, 0, None], coords1[:, 1, None]     # columns, so they broadcast against the rows of coords2
+    lat2, long2 = coords2[:, 0], coords2[:, 1]
+
+    lat_calc = ( np.sin( (lat2 - lat1) / 2) ) **2
+
+    long_calc = (np.sin( (long2 - long1) / 2)) **2
+
+    calc = np.sqrt( lat_calc + np.cos(lat1) * np.cos(lat2) * long_calc )
+
+    d = 2 * R * np.arcsin(calc) # in km
+
+    return d * 1000
+
+
+def unit_sphere_points(coords):
+    """converts an array of (lat, long) in decimal degrees to (x, y, z) points on a sphere of radius 1"""
+    coords = np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+    lat, long = coords[:, 0], coords[:, 1]
+
+    return np.column_stack((np.cos(lat) * np.cos(long), np.cos(lat) * np.sin(long), np.sin(lat)))
+
+
 def normal_distribution(loc_lat, loc_long, scale, size):
      norm_dist_lat = np.random.normal(loc_lat, scale/2, size=size) # normal distribution of latitudes with size being number of moloks and scale being the outer bound
      norm_dist_long = np.random.normal(loc_long, scale, size=size) # normal distribution of longitudes with size being number of moloks and scale being the outer bound
@@ -0,0 +1,137 @@
+"""
+Initial routes for MasterPlanner from a previous plan, fx. yesterday's plan from DataStorage.fetch_similar_plan.
+
+The molok set and the geography barely change from day to day, so the previous routes are a good start:
+1. moloks of the previous plan that are not planned now are dropped from its routes
+2. routes beyond the number of trucks are dissolved, smallest first, and their moloks inserted again
+3. moloks that are new in this plan are inserted one by one where they add the least distance (cheapest insertion),
+in a route with capacity left if there is one, or in a new route while there are unused trucks
+
+The insertion cost of a molok at every place in every route is computed at once on the node layout used by
+RouteEvaluator, where the depot between two routes ends one and starts the next.
+"""
+
+import numpy as np
+
+import support_functions as sf
+
+
+def warm_start_routes(previous_routes: list, molok_ids: list, molok_pos_list: list, depot_pos: tuple,
+                      demands: list = None, truck_capacity: float = None, num_trucks: int = None) -> list:
+    """
+    Builds initial routes for the moloks in 'molok_ids' from 'previous_routes'.
+
+    Inputs:
+    ---
+    - previous_routes: routes of the previous plan as lists of molok IDs. 'depot' entries are ignored
+    - molok_ids: IDs of the moloks to plan now, and 'molok_pos_list' their positions (lat, long)
+    - depot_pos: position of the depot
+    - demands: kg of each molok to plan, 'truck_capacity' kg. Capacity is ignored if either is None
+    - num_trucks: max number of routes. None means no limit
+
+    returns list of routes as indices into 'molok_ids' (no depots). Every molok is on a route
+    """
+    index_of = {int(molok_id): i for i, molok_id in enumerate(molok_ids)}
+    routes = [[index_of[molok_id] for molok_id in route if molok_id != "depot" and molok_id in index_of]
+              for route in previous_routes]
+    routes = sorted((route for route in routes if route), key=len, reverse=True)
+
+    # moloks on routes beyond the number of trucks are inserted again with the new moloks
+    if num_trucks is not None and len(routes) > num_trucks:
+        routes = routes[:num_trucks]
+
+    placed = {molok for route in routes for molok in route}
+    to_insert = [i for i in range(len(molok_ids)) if i not in placed]
+
+    if to_insert:
+        positions = np.asarray(molok_pos_list, dtype=np.float64).reshape(-1, 2)
+        depot = np.asarray(depot_pos, dtype=np.float64)
+        demands = np.zeros(len(molok_ids)) if demands is None else np.asarray(demands, dtype=np.float64)
+        capacity = np.inf if truck_capacity is None else truck_capacity
+        loads = [demands[route].sum() for route in routes]
+
+        for molok in to_insert:
+            insert_molok(routes, loads, molok, positions, depot, demands[molok], capacity, num_trucks)
+
+    return routes
+
+
+def insert_molok(routes: list, loads: list, molok: int, positions: np.ndarray, depot: np.ndarray, demand: float,
+                 capacity: float, num_trucks: int = None):
+    """Internal method. Inserts 'molok' in 'routes' where it adds the least distance, see the module docstring"""
+    # nodes of all routes with a depot between them, and the route each leg belongs to
+    node_coords = [depot[None, :]]
+    leg_route = []
+    for route_num, route in enumerate(routes):
+        node_coords += [positions[route], depot[None, :]]
+        leg_route += [route_num] * (len(route) + 1)
+    node_coords = np.concatenate(node_coords)
+    leg_route = np.array(leg_route, dtype=np.int64)
+
+    to_molok = sf.pairwise_meters(positions[molok], node_coords)[0]
+    points = sf.unit_sphere_points(node_coords)
+    chords = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    leg_length = 2 * 6371000 * np.arcsin(np.minimum(chords / 2, 1))      # chord on unit sphere -> meters
+    insertion_cost = to_molok[:-1] + to_molok[1:] - leg_length
+
+    fits = np.array([loads[route_num] + demand <= capacity for route_num in range(len(routes))], dtype=bool)
+    if len(leg_route) and fits[leg_route].any():
+        insertion_cost = np.where(fits[leg_route], insertion_cost, np.inf)
+
+    new_route_cost = 2 * to_molok[0]                        # depot -> molok -> depot
+    can_open = num_trucks is None or len(routes) < num_trucks
+
+    if len(leg_route) == 0 or (can_open and (not fits.any() or new_route_cost < insertion_cost.min())):
+        routes.append([molok])
+        loads.append(demand)
+        return
+
+    leg = int(np.argmin(insertion_cost))
+    route_num = leg_route[leg]
+    first_leg = int(np.searchsorted(leg_route, route_num))  # legs are in route order
+    routes[route_num].insert(leg - first_leg, molok)
+    loads[route_num] += demand
+
+
+if __name__ == "__main__":
+    import io
+    import time
+    import contextlib
+    from routePlanner import MasterPlanner
+
+    rng = np.random.default_rng(4)
+    num_moloks = 140
+    num_trucks = 7
+    depot_pos = (57.0257998, 9.9194714)
+    molok_ids = np.arange(1000, 1000 + num_moloks)
+    positions = list(zip(rng.normal(57.02, 0.015, num_moloks).tolist(), rng.normal(9.95, 0.03, num_moloks).tolist()))
+    fill_pcts = rng.uniform(50, 80, num_moloks)
+    growthrates = rng.uniform(5, 20, num_moloks) / 86400
+
+    def plan(selected, time_limit, warm_routes=None):
+        """plans the selected moloks. returns (MasterPlanner, [(seconds, best objective) pr. solution found])"""
+        trace = []
+        start = time.time()
+        mp = MasterPlanner(600, 2200, [positions[i] for i in selected], 5, fill_pcts[selected].tolist(), 500,
+                           growthrates[selected].tolist(), 100, num_trucks, 10000, 600, 1400, time_limit,
+                           depot_pos=depot_pos, first_solution_strategy="2", num_attempts=1,
+                           warm_start_routes=warm_routes,
+                           progress_callback=lambda state: trace.append((round(time.time() - start, 2), state["objective"])))
+        with contextlib.redirect_stdout(io.StringIO()):        # MasterPlanner prints a lot
+            mp.master()
+        return mp, trace
+
+    # yesterday's plan, and today 12 of its moloks are gone and 12 new ones are planned
+    yesterday, today = np.arange(0, 120), np.arange(12, 132)
+    mp, _ = plan(yesterday, 20)
+    previous_routes = [[int(molok_ids[yesterday[i]]) for i in route if i != "depot"] for route in mp.current_best["routes"]]
+
+    start = time.time()
+    demands = np.round(fill_pcts[today] / 100 * 500)
+    warm_routes = warm_start_routes(previous_routes, molok_ids[today].tolist(), [positions[i] for i in today], depot_pos,
+                                    demands, 10000, num_trucks)
+    print(f"warm start routes built in {(time.time() - start) * 1000:.1f} ms: {[len(route) for route in warm_routes]}")
+
+    for name, routes in (("cold", None), ("warm", warm_routes)):
+        mp, trace = plan(today, 5, routes)
+        print(f"{name}: first solution {trace[0] if trace else None}, final objective {mp.best_objective}")
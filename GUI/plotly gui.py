@@ -7,25 +7,52 @@ import plotly.express as px
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
-from dash import Dash, dcc, html
+from dash import Dash, dcc, html, no_update, Patch
 from dash.dependencies import Input, Output, State
 from tqdm import tqdm
 
 import sys, os.path
+import threading
 
 # Append the Server/ folder to the sys.path in order to grab both datastorage.py and simulation.py
 a = (os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 + '/Server/')
 sys.path.append(a)
-from datastorage import DataStorage
+from datastorage import DataStorage, plan_inputs_hash
 #from Simulation import Simulation
 
 b = (os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 + '/Algorithm/')
 sys.path.append(b)
-from routePlanner import MasterPlanner
+from planningJobs import PlanningJobs
+from molokSelection import MolokSelector
+from warmStart import warm_start_routes
 
 DEPOT_COORDINATES = (57.0257998,9.9194714)          #depot adress: Over Bækken 2, Aalborg
+PLANNING_WORKERS = 2                                # route plans running at the same time. Others wait in a queue
+PLAN_CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "planCheckpoints")   # resumed after a restart
+MAP_ZOOM = 10                                       # zoom of the map when a table is shown
+CLUSTER_MIN_MOLOKS = 2000                           # tables with more moloks are drawn as clusters on a spatial grid
+CLUSTER_CELL_PIXELS = 40                            # width of a grid cell on the screen
+MERGE_ROUTES_MIN_TRUCKS = 10                        # with more routes, all routes are drawn as a single trace
+SELECTION_HORIZON_HOURS = 24                        # moloks that would overflow before the next shift are planned
+DETOUR_METERS = 150                                 # moloks this close to a planned molok are planned as well if ...
+DETOUR_FILL = 60                                    # ... their predicted fill is above this
+WARM_START_SIMILARITY = 0.5                         # min share of moloks in common with a previous plan to start from it
+GROWTH_WINDOW_DAYS = 7                              # growthrates are regressed over this many days before the newest reading
+HISTORY_POINTS = 2000                               # max points in the fill history of a molok. Readings are downsampled
+
+plan_jobs = None            # PlanningJobs, created on first use so worker processes don't create their own
+live_sims = {}              # table name -> DataStorage running a simulation into the table
+map_cache = {}              # table name -> arrays, version and base figure of the table (see 'fetch_map_data')
+version_readers = threading.local()     # DataStorage pr. server thread, kept open for the version lookups of 'fetch_map_data'
+
+
+def get_plan_jobs():
+    global plan_jobs
+    if plan_jobs is None:
+        plan_jobs = PlanningJobs(max_workers=PLANNING_WORKERS, checkpoint_dir=PLAN_CHECKPOINT_DIR)
+    return plan_jobs
 
 
 
@@ -45,36 +72,51 @@ def blank_fig():    # A template for an empty figure
     return fig
 
 
-def FigCraft(selectedTable):
-    #print(selectedTable, seed, moloks)
+def fetch_map_data(selectedTable):
+    """
+    returns the latest state of a table as typed arrays (see DataStorage.fetch_latest_state) together with its
+    'version' and base 'figure', or None if the table doesn't exist or is empty. Cached until DataStorage bumps the
+    version of the table, so unchanged tables are neither queried nor rendered again
+    """
+    if not hasattr(version_readers, "dataS"):       # sqlite connections can't be shared between threads
+        version_readers.dataS = DataStorage()
+    cached = map_cache.get(selectedTable)
+    if cached != None and cached["version"] == version_readers.dataS.fetch_table_version(selectedTable):
+        return cached
+
     tmpDS = DataStorage()
     tableType, seed, moloks = getSeedAndMolok(selectedTable)
     a = tmpDS.select_table(selectedTable, seed, moloks)
     if a == False:
         #print(f"{selectedTable} does not exist!")
-        return blank_fig()
-
+        map_cache.pop(selectedTable, None)
+        return None
 
-    latest_rows = tmpDS.fetch_latest_rows("main")
-    if len(latest_rows) == 0:
+    version = tmpDS.fetch_table_version()               # before the state, so a write in between only makes it stale
+    latest_state = tmpDS.fetch_latest_state("main")      # typed columns, one row per molok
+    if len(latest_state["molokID"]) == 0:
         print("[!] THIS TABLE IS EMPTY")
-        return blank_fig()
-    
-    df = pd.DataFrame(latest_rows)
-    df.columns = ["maxID", "MolokID", "Coords", "Fill_pct", "Timestamp"]        # Set names of columns
+        return None
+
+    map_data = dict(latest_state, table=selectedTable, version=version, clusters={},
+                    clustered=len(latest_state["molokID"]) > CLUSTER_MIN_MOLOKS)
+    map_data["figure"] = craft_clustered_figure(map_data) if map_data["clustered"] else craft_base_figure(map_data)
+    map_cache[selectedTable] = map_data
+    return map_data
 
-    # Remove the Coords[] column and split it into lon and lat, then place into their own columns
-    y = df['Coords'].str.replace(' ', ',', 1).str.strip('[ ]')
-    df[['lat', 'lon']] = y.str.split(',', expand=True)
-    df = df.drop(columns=["Coords"])    # Remove Coords column (useless now)
 
-    # Convert column data from string to float or int
-    df = df.astype('float')
-    df["MolokID"] = df["MolokID"].astype('int')
+def craft_base_figure(latest_state):
+    """Internal method. returns the map of the moloks in 'latest_state' (see fetch_map_data), one marker pr. molok, without routes"""
+    df = pd.DataFrame({"maxID": latest_state["lastID"],
+                       "MolokID": latest_state["molokID"],
+                       "Fill_pct": latest_state["fillPct"],
+                       "Timestamp": latest_state["timestamp"],
+                       "lat": latest_state["lat"],
+                       "lon": latest_state["lon"]})
 
     fig = px.scatter_mapbox(df,
                             title='Route planner',
-                            zoom=10, #Starts zoom
+                            zoom=MAP_ZOOM, #Starts zoom
                             range_color=[0,100],
                             color_continuous_scale=["LimeGreen", "Gold","Red"], #px.colors.diverging.RdYlGn_r,
                             #width=1280, height=720,
@@ -86,12 +128,35 @@ def FigCraft(selectedTable):
                             lon="lon",
                             lat="lat")
     
-    # Make map larger in GUI
-    fig.update_layout(mapbox_style="open-street-map", margin ={'l':0,'t':0,'b':0,'r':0})
+    fig.data[0].marker.color = df["Fill_pct"].tolist()     # plain list, so LiveUpdate can patch single markers
+
+    # Make map larger in GUI. uirevision keeps the operator's zoom and position when the map is patched
+    fig.update_layout(mapbox_style="open-street-map", margin ={'l':0,'t':0,'b':0,'r':0}, uirevision=latest_state["table"])
     #Color scale left side
     fig.update_layout(coloraxis_colorbar=dict(yanchor="top", y=1, x=0,
                                           ticks="outside"))
     
+    add_depot_marker(fig)
+    return fig
+
+
+def craft_clustered_figure(map_data):
+    """Internal method. returns the map of a large table as clusters of moloks (see cluster_markers), without routes"""
+    fig = go.Figure(cluster_trace(cluster_markers(map_data, MAP_ZOOM)))
+
+    # same look as craft_base_figure, built directly as px would add a hover string pr. molok
+    fig.update_layout(title='Route planner', uirevision=map_data["table"], margin ={'l':0,'t':0,'b':0,'r':0},
+                      mapbox={"style": "open-street-map", "zoom": MAP_ZOOM,
+                              "center": {"lat": float(np.nanmean(map_data["lat"])), "lon": float(np.nanmean(map_data["lon"]))}},
+                      coloraxis={"cmin": 0, "cmax": 100, "colorscale": [[0, "LimeGreen"], [0.5, "Gold"], [1, "Red"]],
+                                 "colorbar": dict(yanchor="top", y=1, x=0, ticks="outside", title="Fill_pct")})
+
+    add_depot_marker(fig)
+    return fig
+
+
+def add_depot_marker(fig):
+    """Internal method. Adds the depot to a map"""
     # DEPOT MARKER
     fig.add_trace(go.Scattermapbox(
     mode = "markers",
@@ -99,7 +164,88 @@ def FigCraft(selectedTable):
     marker = {'size': 20, "color": "purple"},
     text = "Depot",textposition = "bottom right", name = "DEPOT"))
 
-    return fig
+
+def cluster_markers(map_data, zoom):
+    """
+    groups the moloks of 'map_data' (see fetch_map_data) in the cells of a grid, where a cell is about
+    CLUSTER_CELL_PIXELS wide on the screen at 'zoom'.
+    returns dictionary of lists with 'lat' and 'lon' (mean of the cell's moloks), 'fillPct' (max of the cell, so full
+    moloks stand out), 'count' and 'molokID' (of the cell's first molok, so a cell with one molok can be clicked) pr.
+    non-empty cell. Cached in map_data pr. whole zoom level
+    """
+    zoom = int(round(zoom))
+    if zoom in map_data["clusters"]:
+        return map_data["clusters"][zoom]
+
+    placed = np.isfinite(map_data["lat"]) & np.isfinite(map_data["lon"])      # moloks without a position aren't drawn
+    lat, lon, fill_pcts = map_data["lat"][placed], map_data["lon"][placed], map_data["fillPct"][placed]
+    molok_ids = map_data["molokID"][placed]
+
+    cell_lon = 360 / 2 ** zoom * CLUSTER_CELL_PIXELS / 256      # map tiles are 256 pixels and 360 / 2^zoom degrees wide
+    cell_lat = cell_lon * np.cos(np.radians(np.mean(lat)))      # a degree of latitude is longer on the screen
+    cells = np.stack((np.floor(lat / cell_lat), np.floor(lon / cell_lon)), axis=1)
+    cell_of_molok = np.unique(cells, axis=0, return_inverse=True)[1].ravel()
+
+    counts = np.bincount(cell_of_molok)
+    order = np.argsort(cell_of_molok, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    clusters = {"lat": np.round(np.bincount(cell_of_molok, lat) / counts, 5).tolist(),     # 5 decimals is ~1 m
+                "lon": np.round(np.bincount(cell_of_molok, lon) / counts, 5).tolist(),
+                "fillPct": np.round(np.maximum.reduceat(fill_pcts[order], starts), 1).tolist(),
+                "count": counts.tolist(),
+                "molokID": molok_ids[order][starts].tolist()}
+
+    map_data["clusters"][zoom] = clusters
+    return clusters
+
+
+def cluster_trace(clusters):
+    """Internal method. returns marker trace of clusters. Only numbers are sent, the hover text is made by the browser"""
+    return go.Scattermapbox(mode="markers", name="Moloks", showlegend=False,
+                            lat=clusters["lat"], lon=clusters["lon"], customdata=cluster_customdata(clusters),
+                            marker={"color": clusters["fillPct"], "coloraxis": "coloraxis", "opacity": 1,
+                                    "size": cluster_sizes(clusters)},
+                            hovertemplate="%{customdata[0]} moloks<br>Max fill: %{marker.color} %<extra></extra>")
+
+
+def cluster_customdata(clusters):
+    """Internal method. returns [number of moloks, molokID of first molok] pr. cluster"""
+    return [list(pair) for pair in zip(clusters["count"], clusters["molokID"])]
+
+
+def cluster_sizes(clusters):
+    """Internal method. returns marker size of each cluster. Grows with the log of its number of moloks"""
+    return np.round(8 + 4 * np.log2(clusters["count"]), 1).tolist()
+
+
+def cluster_patch(clusters):
+    """returns Patch that replaces the clusters on a map from craft_clustered_figure"""
+    patched_fig = Patch()
+    patched_fig["data"][0]["lat"] = clusters["lat"]
+    patched_fig["data"][0]["lon"] = clusters["lon"]
+    patched_fig["data"][0]["customdata"] = cluster_customdata(clusters)
+    patched_fig["data"][0]["marker"]["color"] = clusters["fillPct"]
+    patched_fig["data"][0]["marker"]["size"] = cluster_sizes(clusters)
+    return patched_fig
+
+
+def FigCraft(selectedTable, copy=True, zoom=None):
+    """
+    returns a copy of the map of the table, which routes can be added to. copy=False returns the cached figure itself
+    for callbacks that only display it, which saves copying it. Don't modify it then.
+    zoom is the current zoom of the map in the browser. Large tables are clustered for it
+    """
+    map_data = fetch_map_data(selectedTable)
+    if map_data == None:
+        return blank_fig()
+
+    if map_data["clustered"] and zoom != None and int(round(zoom)) != MAP_ZOOM:
+        fig = go.Figure(map_data["figure"])         # small, as it only has the clusters
+        fig.data[0].update(cluster_trace(cluster_markers(map_data, zoom)))
+        return fig
+    if not copy:
+        return map_data["figure"]
+    return go.Figure(map_data["figure"])
 
 
 app = Dash(__name__)
@@ -110,7 +256,18 @@ app.layout = html.Div([
             
             dcc.Graph(id="Map1", style={'width': '60vw', 'height': '85vh'}),
             dcc.Markdown("", id="routesOutput"),
-            dcc.Markdown("", id="KPIField")
+            dcc.Markdown("", id="KPIField"),
+
+            # Fill history of the molok clicked on the map
+            dcc.Markdown("Click a molok on the map to see its history", id="historyInfo"),
+            dcc.Graph(id="historyGraph", figure=blank_fig(), style={'width': '60vw', 'height': '35vh'}),
+
+            # Zoom of the map in the browser. Large tables are clustered for it
+            dcc.Store(id="mapZoom"),
+
+            # Live updates of the map while a simulation is running
+            dcc.Store(id="liveState"),
+            dcc.Interval(id="liveInterval", interval=1000, disabled=True)
             ]),
         
         
@@ -166,14 +323,17 @@ app.layout = html.Div([
                 #Plan route
                 html.Button("Plan route", id='planRouteButton', style={"width": "100px", "margin-right": "40px"}),
 
+                #Cancel planning
+                html.Button("Cancel", id='cancelPlanButton', style={"width": "100px", "margin-right": "40px"}),
+
                 #Time limit input
                 dcc.Input(type="number", id="timeLimit", value=30, placeholder="Time limit", style={"width": "100px"}),
                 
                 #Number of truck
                 dcc.Input(type="text", id="numTrucks", placeholder="Number of trucks", value=61, style={"width": "100px", "margin-top": "10px"}),
                 
-                #Waste limit pct
-                dcc.Input(type="number", id='filter_pct', value=80, placeholder= "Waste limit pct."),
+                #Predicted fill limit pct. Moloks predicted to reach it before the next shift are planned
+                dcc.Input(type="number", id='filter_pct', value=100, placeholder= "Predicted fill limit pct."),
 
                 # Number of attempts
                 dcc.Input(type="number", id='numberOfAttempts', value=10, placeholder= "Number of attempts"),
@@ -183,7 +343,12 @@ app.layout = html.Div([
 
                 #Local solution strategy 
                 dcc.Dropdown(id="lssDropdown", searchable=True, placeholder="Local search strategy", value=3, options=[1, 2, 3, 4], style={"width": "100px","margin-top": "5px"}),
-                ])
+                ]),
+
+            #Progress of the planning job of this browser tab
+            dcc.Markdown("", id="planProgress"),
+            dcc.Store(id="planJob"),
+            dcc.Interval(id="planInterval", interval=1000, disabled=True)
 
         ])
         
@@ -211,53 +376,190 @@ def callCreateTable(n_clicksButton, nrMoloksSlider, seedText, typeTable):
 
 
 
-#Starts a simulation from the selected table
+#Starts a simulation from the selected table. The map is rendered once, then LiveUpdate patches it while data arrives
 @app.callback(Output("Map1", "figure", allow_duplicate=True),
+              Output("liveState", "data"),
+              Output("liveInterval", "disabled"),
               Input('gatherDataButton', "n_clicks"),
               State('tableDropdown', "value"),
-              State('IPTextInput', "value"), prevent_initial_call=True)
-def StartSim(nrOfClicks, selectTable, IP):
+              State('IPTextInput', "value"),
+              State("mapZoom", "data"), prevent_initial_call=True)
+def StartSim(nrOfClicks, selectTable, IP, zoom):
     if selectTable == None:
-        return blank_fig()
+        return blank_fig(), None, True
+
+    fig = FigCraft(selectTable, copy=False, zoom=zoom)  # before the sim starts, so LiveUpdate gets every reading after this render
+    map_data = map_cache.get(selectTable)
+    last_id = int(map_data["lastID"].max()) if map_data != None else 0
     
     try:
         tmpDS = DataStorage()
         tableType, seed, molok = getSeedAndMolok(selectTable)
         tmpDS.select_table(selectTable, seed, molok)
         tmpDS.startSim((IP, 12445),1)
-        # tmpDS.simThread.join()
+        live_sims[selectTable] = tmpDS
     except Exception as e:
         print(e)
-    tmpDS.join_sim_thread()
-    return FigCraft(selectTable)
+        return fig, None, True
+
+    return fig, {"table": selectTable, "lastID": last_id}, False
+
+
+#Patches the colours of the moloks that got new readings since the last poll, while a simulation is running
+@app.callback(Output("Map1", "figure", allow_duplicate=True),
+              Output("liveState", "data", allow_duplicate=True),
+              Output("liveInterval", "disabled", allow_duplicate=True),
+              Input("liveInterval", "n_intervals"),
+              State("liveState", "data"),
+              State('tableDropdown', "value"),
+              State("mapZoom", "data"), prevent_initial_call=True)
+def LiveUpdate(n_intervals, live, selectTable, zoom):
+    if live == None or live["table"] != selectTable:     # another table is shown now
+        return no_update, None, True
+    
+    tmpDS = DataStorage()
+    tmpDS.table_name = selectTable      # no select_table, as it writes to the DB the sim is logging to
+    changes = tmpDS.fetch_latest_changes(live["lastID"])
+
+    sim = live_sims.get(selectTable)
+    running = sim != None and sim.sim_thread.is_alive()
+    if not running:
+        live_sims.pop(selectTable, None)
+
+    if len(changes["molokID"]) == 0:
+        return no_update, no_update, not running
+
+    # clusters cover many moloks, so they are made again from the whole table (read once for all operators)
+    map_data = map_cache.get(selectTable)
+    if map_data != None and map_data["clustered"]:
+        map_data = fetch_map_data(selectTable)
+        last_id = int(map_data["lastID"].max())
+        return cluster_patch(cluster_markers(map_data, zoom or MAP_ZOOM)), {"table": selectTable, "lastID": last_id}, not running
+
+    # markers are ordered by molokID. New moloks are not on the map yet, so they need a full render
+    molok_ids = map_data["molokID"] if map_data != None else np.array([], dtype=np.int64)
+    indices = np.searchsorted(molok_ids, changes["molokID"])
+    if np.any(indices >= len(molok_ids)) or np.any(molok_ids[np.minimum(indices, len(molok_ids) - 1)] != changes["molokID"]):
+        fig = FigCraft(selectTable, copy=False, zoom=zoom)
+        map_data = map_cache.get(selectTable)
+        last_id = int(map_data["lastID"].max()) if map_data != None else live["lastID"]
+        return fig, {"table": selectTable, "lastID": last_id}, not running
+
+    patched_fig = Patch()
+    for index, fill_pct in zip(indices.tolist(), changes["fillPct"].tolist()):
+        patched_fig["data"][0]["marker"]["color"][index] = fill_pct
+
+    return patched_fig, {"table": selectTable, "lastID": int(changes["lastID"].max())}, not running
 
 
 #Button for updates 
 @app.callback(Output("Map1","figure", allow_duplicate=True),
               Input("update", "n_clicks"),
-              State('tableDropdown', "value"), prevent_initial_call=True)
-def update_map(n_clicks,select_table):
+              State('tableDropdown', "value"),
+              State("mapZoom", "data"), prevent_initial_call=True)
+def update_map(n_clicks,select_table, zoom):
     #print("update button !!!!!")
-    return FigCraft(select_table)
+    return FigCraft(select_table, copy=False, zoom=zoom)
 
 
 
-#Updates Scatter-map when table is selected from dropdown
+#Updates Scatter-map when table is selected from dropdown. The map of another table starts at MAP_ZOOM
 @app.callback(Output("Map1", "figure"),
+              Output("mapZoom", "data"),
               Input('tableDropdown', "value"))
 def Callupdate_scatterMap(selectedTable):
     print("\n@ Callupdate_scatterMap()")
     # When intitial request (meaning selectedTable is None), return the first table in Database
-    if selectedTable == None: return blank_fig()
-    fig = FigCraft(selectedTable)
+    if selectedTable == None: return blank_fig(), None
+    fig = FigCraft(selectedTable, copy=False)
+    return fig, None
+
+
+#Shows the fill history of the molok clicked on the map
+@app.callback(Output("historyGraph", "figure"),
+              Output("historyInfo", "children"),
+              Input("Map1", "clickData"),
+              State('tableDropdown', "value"), prevent_initial_call=True)
+def ShowHistory(clickData, selectTable):
+    if clickData == None or selectTable == None:
+        return no_update, no_update
+
+    point = clickData["points"][0]
+    map_data = fetch_map_data(selectTable)
+    if point.get("curveNumber") != 0 or map_data == None:      # fx. the depot or a route
+        return no_update, "Click a molok on the map to see its history"
+
+    if map_data["clustered"]:
+        count, molok_id = point["customdata"]
+        if count > 1:
+            return no_update, f"{count} moloks here. Zoom in to pick a single molok"
+    else:
+        molok_id = int(map_data["molokID"][point.get("pointNumber", point.get("pointIndex"))])
+
+    tmpDS = DataStorage()
+    tmpDS.table_name = selectTable
+    history = tmpDS.fetch_molok_history(molok_id, max_points=HISTORY_POINTS)     # whole history
+    info = f"**Molok {molok_id}**: {history['readings']} readings (showing {len(history['timestamp'])}), {len(history['sections'])} sections"
+    return history_figure(molok_id, history), info
+
+
+def history_figure(molok_id, history):
+    """returns figure of the fill history of a molok (see DataStorage.fetch_molok_history) with its regression sections on top"""
+    fig = go.Figure()
+
+    # compacted readings as a band between the min and max of each hour
+    rollups = history["rollups"]
+    if len(rollups):
+        hours = pd.to_datetime(rollups[:, 0], unit="s")
+        fig.add_trace(go.Scatter(x=hours, y=rollups[:, 1], mode="lines", line={"width": 0}, showlegend=False, hoverinfo="skip"))
+        fig.add_trace(go.Scatter(x=hours, y=rollups[:, 2], mode="lines", line={"width": 0}, fill="tonexty",
+                                 name="Compacted (hourly min-max)"))
+
+    fig.add_trace(go.Scatter(x=pd.to_datetime(history["timestamp"], unit="s"), y=history["fillPct"], mode="lines",
+                             name="Fill pct"))
+
+    # one line pr. section from its regression, in a single trace with gaps between sections
+    Sx = []
+    Sy = []
+    for a, b, t0, t1, msg_IDs in history["sections"]:
+        Sx += [pd.to_datetime(t0, unit="s"), pd.to_datetime(t1, unit="s"), None]
+        Sy += [b, b + a * (t1 - t0), None]
+    fig.add_trace(go.Scatter(x=Sx, y=Sy, mode="lines", line={"dash": "dash"}, name="Regression"))
+
+    fig.update_layout(title=f"Molok {molok_id}", uirevision=molok_id, margin={'l': 0, 't': 30, 'b': 0, 'r': 0},
+                      yaxis_title="Fill pct", xaxis_title="Time")
     return fig
 
+
+#Clusters the moloks of a large table again when the map is zoomed
+@app.callback(Output("Map1", "figure", allow_duplicate=True),
+              Output("mapZoom", "data", allow_duplicate=True),
+              Input("Map1", "relayoutData"),
+              State('tableDropdown', "value"),
+              State("mapZoom", "data"), prevent_initial_call=True)
+def ClusterOnZoom(relayoutData, selectTable, zoom):
+    if relayoutData == None or "mapbox.zoom" not in relayoutData or selectTable == None:
+        return no_update, no_update       # panning or other layout changes
+
+    new_zoom = int(round(relayoutData["mapbox.zoom"]))
+    if new_zoom == (zoom or MAP_ZOOM):
+        return no_update, new_zoom
+
+    map_data = fetch_map_data(selectTable)
+    if map_data == None or not map_data["clustered"]:
+        return no_update, new_zoom
+    return cluster_patch(cluster_markers(map_data, new_zoom)), new_zoom
+
     
 
 # ______PLOT ROUTES______
-@app.callback(Output("Map1", "figure", allow_duplicate=True),
-            Output("routesOutput", "children"),
-            Output("KPIField", "children"),
+# Planning runs as a background job, so the server keeps responding and several operators can plan at the same time.
+# Each browser tab keeps its own job in the 'planJob' store and polls it with 'planInterval'
+
+#Submits a planning job for the moloks predicted to reach the fill limit before the next shift
+@app.callback(Output("planJob", "data"),
+            Output("planInterval", "disabled"),
+            Output("planProgress", "children"),
             Input('planRouteButton', "n_clicks"),
             State('tableDropdown', "value"),
             State('timeLimit', "value"),
@@ -267,88 +569,96 @@ def Callupdate_scatterMap(selectedTable):
             State('filter_pct', "value"),
             State('numberOfAttempts', "value"),
             prevent_initial_call=True)
-def DisplayRoutes(n_clicks, select_table, timeLimit, numTrucks, fss, lss, waste_limit, numberOfAttempts):
-    print("@ DisplayRoutes", select_table, timeLimit, numTrucks, fss, lss, waste_limit)
-    fig = FigCraft(select_table)
+def SubmitPlan(n_clicks, select_table, timeLimit, numTrucks, fss, lss, waste_limit, numberOfAttempts):
+    print("@ SubmitPlan", select_table, timeLimit, numTrucks, fss, lss, waste_limit)
+    if select_table == None:
+        return no_update, True, "Select a table first"
+
+    map_data = fetch_map_data(select_table)
+    if map_data == None:
+        return no_update, True, "Ingen valide molokker"
 
-    molok_pos_list = list(zip(fig.data[0]["lat"], fig.data[0]["lon"]))
-    molok_fillpcts = fig.data[0]['marker']['color']
+    molok_pos_list = list(zip(map_data["lat"].tolist(), map_data["lon"].tolist()))
+    molok_fillpcts = map_data["fillPct"]
     
     dataS = DataStorage() 
     tableType, seed, molok = getSeedAndMolok(select_table)
     dataS.select_table(select_table, seed, molok)
-    molok_est_data = dataS.lin_reg_sections()
-    
-    avg_grs = dataS.avg_growth_over_period(molok_est_data, period_start = 0, period_end = 999999999999999)  #lol
-    #FILTER (only include if Fill Pct over 40)
-    filteredMoloks = [id for id in range(len(molok_pos_list)) if molok_fillpcts[id] >= waste_limit]
-    print("Filtered moloks ->", filteredMoloks)
+    newest = float(map_data["timestamp"].max())        # window ends at the newest reading, as simulated tables run ahead of the clock
+    growthrates = dataS.growthrates_over_period(period_start = newest - GROWTH_WINDOW_DAYS * 86400, period_end = newest)
+    if type(growthrates) == str:
+        return no_update, True, "Not enough measurements! (Minimum of 2 required to perform linear regression)"
+    avg_grs = np.array([growthrates.get(molok_id, np.nan) for molok_id in map_data["molokID"].tolist()])  # same order as map_data rows
+
+    #FILTER (only include moloks predicted to reach the limit before the next shift, and cheap detours)
+    selector = MolokSelector(horizon_hours=SELECTION_HORIZON_HOURS, overflow_limit=waste_limit,
+                             detour_meters=DETOUR_METERS, detour_fill=DETOUR_FILL, depot_pos=DEPOT_COORDINATES)
+    selection = selector.select(molok_fillpcts, avg_grs, np.column_stack((map_data["lat"], map_data["lon"])))
+    filteredMoloks = selection["selected"].tolist()
+    print(f"Filtered moloks -> {len(filteredMoloks)} ({len(selection['detours'])} detours) in {selection['seconds']} seconds")
 
     # Error handling
     if len(filteredMoloks) == 0:
-        return fig, "Ingen valide molokker"
-    if type(avg_grs) == str:
-        return fig, "Not enough measurements! (Minimum of 2 required to perform linear regression)"
+        return no_update, True, "Ingen valide molokker"
     
     #Apply filter to other lists
     molok_pos_list = [molok_pos_list[i] for i in filteredMoloks]
-    molok_fillpcts = [molok_fillpcts[i] for i in filteredMoloks]
-    avg_grs        = [avg_grs[i]        for i in filteredMoloks]
-    
+    molok_fillpcts = [float(molok_fillpcts[i]) for i in filteredMoloks]
+    avg_grs        = [float(avg_grs[i])        for i in filteredMoloks]
+    molok_ids      = map_data["molokID"][filteredMoloks].tolist()
     
     ttem = 5                #Time it takes to empty molok
     truck_range = 100
     truck_capacity = 3000
-    print("Creating MasterPlanner object")
-    mp = MasterPlanner(600, 2200, molok_pos_list, int(ttem), molok_fillpcts, 500, avg_grs, int(truck_range), int(numTrucks), int(truck_capacity), 600, 1400, int(timeLimit), first_solution_strategy=str(fss), local_search_strategy=str(lss), num_attempts=int(numberOfAttempts))
-        
-    print("[!] Planning routes -> ")
-    sys.stdout = open(os.devnull, 'w')      #Disable print()
-    mp.master()
-    routes = mp.current_best["routes"]
-    sys.stdout = sys.__stdout__             #Enable print()
-    #print(routes)
-    #print(mp.empty_molok_times)
-    #print(mp.rp.routing.status())
-
-    emptiedMoloks = mp.empty_molok_times
-    
-    #Empty moloks + converting
-    emptyMoloks_C = []
-    for i in emptiedMoloks:     # [(1, 234), (3, 4123)]
-        emptyMoloks_C.append((filteredMoloks[i[0]], 1))       
-    
-    #Get max() epoch time
-    latest_rows_data = dataS.fetch_latest_rows("main")
-    
-    max_epoch_time = max(list(zip(*latest_rows_data))[4])
-    dataS.set_fillpcts_to_0(emptyMoloks_C, float(max_epoch_time))
 
-    # Create converted routes for GUI
-    convertedRoutes = []    
-    for route in routes:
-        c_route = []
-        for molok in route:
-            if molok == "depot":
-                c_route.append("depot")
-            else:
-                c_route.append(filteredMoloks[molok])
-        convertedRoutes.append(c_route)
-    #print("ConvertedRoutes", convertedRoutes)
-    route_string, KPI = mp.rp.print_solution(convertedRoutes, mp.current_best["visit_times"], mp.current_best["truck_loads"], mp.current_best["truck_distances"])
-    # KPI_print = str(mp.rp.routing.status())
-    # print(KPI_print)
-    print(f"Added slack at finish: {mp.added_slack}")
-    print(mp.identify_overfill())
-    routeFormattedOutput = ""
-    for i, route in enumerate(convertedRoutes):
-        routeFormattedOutput += f"**Truck {i}** | "
-        for place in route:
-            routeFormattedOutput +=  " --> " + str(place)
-        routeFormattedOutput += "  \n"
+    #WARM START (from the routes of the most similar previous plan of the table)
+    inputs_hash = plan_inputs_hash(molok_ids, {"num_trucks": int(numTrucks), "truck_range": truck_range,
+                                               "truck_capacity": truck_capacity, "tte_molok": ttem})
+    previous_plan, similarity = dataS.fetch_similar_plan(molok_ids, inputs_hash, min_similarity=WARM_START_SIMILARITY)
+    warm_routes = None
+    if previous_plan != None:
+        demands = [round(fillpct / 100 * 500) for fillpct in molok_fillpcts]
+        warm_routes = warm_start_routes(previous_plan["routes"], molok_ids, molok_pos_list, DEPOT_COORDINATES,
+                                        demands, truck_capacity, int(numTrucks))
+        print(f"Warm starting from plan {previous_plan['planID']} ({similarity:.0%} similar)")
+
+    job_id = get_plan_jobs().submit(molok_ids=molok_ids,
+                                    depot_open=600, depot_close=2200, molok_pos_list=molok_pos_list, tte_molok=int(ttem),
+                                    fill_pcts=molok_fillpcts, molok_capacity=500, molok_est_growthrates=avg_grs,
+                                    truck_range=int(truck_range), num_trucks=int(numTrucks), truck_capacity=int(truck_capacity),
+                                    work_start=600, work_stop=1400, time_limit_seconds=int(timeLimit),
+                                    first_solution_strategy=str(fss), local_search_strategy=str(lss),
+                                    num_attempts=int(numberOfAttempts), post_optimize=True,
+                                    warm_start_routes=warm_routes)
+    print(f"[!] Planning routes in job {job_id} -> ")
+
+    job = {"job_id": job_id, "table": select_table, "molok_pos_list": molok_pos_list, "molokIDs": molok_ids,
+           "inputs_hash": inputs_hash}
+    return job, False, f"Planning job {job_id[:8]} queued"
+
+
+def format_progress(job_id, status):
+    """returns markdown of the progress of a planning job"""
+    text = f"Planning job {job_id[:8]}: {status['state']}  \n"
+    if "attempt" in status:
+        text += f"Attempt {status['attempt']} of {status['attempts']}  \n"
+        text += f"Best objective: {status['objective'] if status['objective'] is not None else '-'}  \n"
+        text += f"Slack added: {status['slack']} min  \n"
+        text += f"Time left: {int(status['time_left'])} s  \n"
+    if "error" in status:
+        text += f"{status['error']}  \n"
+    return text
+
+
+def add_route_traces(fig, routes, molok_pos_list):
+    """
+    adds a line trace pr. truck route to fig. 'routes' contain 'depot' and indices into molok_pos_list.
+    With MERGE_ROUTES_MIN_TRUCKS or more routes, they are added as one trace instead (see add_merged_route_trace)
+    """
+    if len(routes) >= MERGE_ROUTES_MIN_TRUCKS:
+        add_merged_route_trace(fig, routes, molok_pos_list)
+        return
 
-    
-    # ADD ROUTE TRACES
     for i, route in enumerate(routes):
         Rlat = []
         Rlon = []
@@ -369,12 +679,102 @@ def DisplayRoutes(n_clicks, select_table, timeLimit, numTrucks, fss, lss, waste_
             lon = Rlon,
             lat = Rlat,
             line = {"width" : 3}))
-    
 
+
+def add_merged_route_trace(fig, routes, molok_pos_list):
+    """
+    adds all routes to fig as a single line trace, with a gap (None) between routes. Routes that don't leave the depot
+    are left out. One trace draws much faster in the browser than a trace pr. truck
+    """
+    positions = np.round(np.array(molok_pos_list, dtype=np.float64).reshape(-1, 2), 5)     # 5 decimals is ~1 m
+    depot = np.round(DEPOT_COORDINATES, 5)
+
+    Rlat = []
+    Rlon = []
+    for route in routes:
+        if len(route) <= 2:
+            continue
+        stops = np.array([depot if molok == "depot" else positions[molok] for molok in route])
+        Rlat += stops[:, 0].tolist() + [None]
+        Rlon += stops[:, 1].tolist() + [None]
+
+    fig.add_trace(go.Scattermapbox(
+        mode = "lines",
+        hoverinfo= "skip",
+        name= "Routes",
+        showlegend=True,
+        lon = Rlon,
+        lat = Rlat,
+        line = {"width" : 3}))
+
+
+#Polls the planning job. When it is done, the routed moloks are emptied and the routes are drawn on the map
+@app.callback(Output("Map1", "figure", allow_duplicate=True),
+            Output("routesOutput", "children"),
+            Output("KPIField", "children"),
+            Output("planProgress", "children", allow_duplicate=True),
+            Output("planInterval", "disabled", allow_duplicate=True),
+            Input("planInterval", "n_intervals"),
+            State("planJob", "data"),
+            State("mapZoom", "data"),
+            prevent_initial_call=True)
+def PollPlan(n_intervals, job, zoom):
+    if job == None:
+        return no_update, no_update, no_update, no_update, True
+
+    jobs = get_plan_jobs()
+    status = jobs.status(job["job_id"])
+    if status["state"] == "unknown" and jobs.resume(job["job_id"]):     # the server was restarted while planning
+        return no_update, no_update, no_update, f"Planning job {job['job_id'][:8]}: resumed from checkpoint", False
+    if status["state"] in ("queued", "running", "cancelling"):
+        return no_update, no_update, no_update, format_progress(job["job_id"], status), False
+
+    result = jobs.result(job["job_id"])
+    jobs.forget(job["job_id"])
+    if result == None:      # cancelled, failed or unknown
+        return no_update, no_update, no_update, format_progress(job["job_id"], status), True
+
+    select_table = job["table"]
+    molok_ids = job["molokIDs"]                 # planner indices -> molok IDs of the table
+    fig = FigCraft(select_table, zoom=zoom)
+
+    #Empty moloks + converting
+    emptyMoloks_C = []
+    for i in result["empty_molok_times"]:     # [(1, 234), (3, 4123)]
+        emptyMoloks_C.append((molok_ids[i[0]], 1))
     
-    
+    #Get max() epoch time
+    dataS = DataStorage()
+    tableType, seed, molok = getSeedAndMolok(select_table)
+    dataS.select_table(select_table, seed, molok)
+    max_epoch_time = dataS.fetch_latest_state("main")["timestamp"].max()
+    dataS.set_fillpcts_to_0(emptyMoloks_C, float(max_epoch_time))
+
+    #Store the plan, so the next plan of the table can start from its routes
+    plan_routes = [[molok_ids[molok] for molok in route if molok != "depot"] for route in result["routes"]]
+    plan_visit_times = [[t for molok, t in zip(route, times) if molok != "depot"]
+                        for route, times in zip(result["routes"], result["visit_times"])]
+    dataS.insert_plan(plan_routes, plan_visit_times, result["fleet"], job["inputs_hash"], result["objective"])
 
-    return fig, route_string, KPI #routeFormattedOutput
+    print(f"Added slack at finish: {result['added_slack']}")
+    print(result["overfill"])
+
+    # ADD ROUTE TRACES
+    add_route_traces(fig, result["routes"], job["molok_pos_list"])
+
+    progress = f"Planning job {job['job_id'][:8]}: done in {int(result['seconds'])} s, objective {result['objective']}"
+    return fig, result["route_string"], result["KPI"], progress, True
+
+
+#Cancels the planning job of this tab. PollPlan shows when it has stopped
+@app.callback(Output("planProgress", "children", allow_duplicate=True),
+            Input("cancelPlanButton", "n_clicks"),
+            State("planJob", "data"),
+            prevent_initial_call=True)
+def CancelPlan(n_clicks, job):
+    if job == None or not get_plan_jobs().cancel(job["job_id"]):
+        return "No planning job to cancel"
+    return f"Cancelling planning job {job['job_id'][:8]}"
 
 
 if __name__ == "__main__":
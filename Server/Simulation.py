@@ -2,50 +2,108 @@ from time import sleep
 import numpy as np
 from socket import *
 import pickle
+import select
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import wireformat
 
 class Simulation:   
-    def __init__(self, PORT = 12445, start_listen = True):
+    def __init__(self, PORT = 12445, start_listen = True, HOST = '', max_sessions = 32):
         """
-        Creates sockets as servers on both TCP and UDP using the C22-Sim Protocol
+        Creates sockets as servers on both TCP and UDP using the C22-Sim Protocol \n
+        start_listen = True serves forever on PORT (blocking). Use start() and stop() instead to serve in the background,
+        fx. from tests. Each session is handled by its own worker thread, so up to max_sessions DataStorages are served
+        at the same time
         """
+        self.HOST = HOST            # '' = All available interfaces. local/online DataStorage.py
+        self.PORT = PORT
+        self.max_sessions = max_sessions
+
+        self.TCP_handshake_socket = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.sessions_lock = threading.Lock()
+        self.sessions_active = 0
+        self.sessions_served = 0
+
         if start_listen != True:    #If start_listen == False -> simulate() debug mode
             return
-        
-        HOST = ''                   # All available interfaces. local/online DataStorage.py
+
+        self.serve_forever()
+
+    def listen(self):
+        """Internal method. Creates the TCP handshake socket. PORT = 0 picks a free port, which is put in self.PORT"""
+        self.TCP_handshake_socket = socket(AF_INET, SOCK_STREAM)                # IPv4, TCP
+        self.TCP_handshake_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)       # restart right after a stop
+        self.TCP_handshake_socket.bind((self.HOST, self.PORT))                  # Bind(listen) sockect to the address
+        self.TCP_handshake_socket.listen(self.max_sessions)                     # Listen for connections on the socket
+        self.TCP_handshake_socket.settimeout(0.2)                               # so accept() notices stop()
+        self.PORT = self.TCP_handshake_socket.getsockname()[1]
+
+    def serve_forever(self):
+        """Accepts DataStorage sessions until stop() is called and handles them in a pool of worker threads"""
+        if self.TCP_handshake_socket is None:
+            self.listen()
+
+        print('-----        TCP SERVER RUNNING        -----')
+        print(f"Listening for incoming connections on {(self.HOST, self.PORT)}")
+
+        with ThreadPoolExecutor(max_workers=self.max_sessions, thread_name_prefix="simSession") as executor:
+            while not self.stopping.is_set():
+                try:
+                    # TCP handshake. c = SOCKET to client. a = ADDRESS of client
+                    TCP_connected_sock, tcpADDR = self.TCP_handshake_socket.accept()
+                except timeout:
+                    continue
+                executor.submit(self.handle_session, TCP_connected_sock, tcpADDR)
+
+        self.TCP_handshake_socket.close()
+
+    def start(self, port = 0) -> int:
+        """Serves in a background thread. port = 0 picks a free port. returns the port"""
+        self.PORT = port
+        self.stopping.clear()
+        self.listen()
+        self.thread = threading.Thread(target=self.serve_forever, name="simServerThread", daemon=True)
+        self.thread.start()
+        return self.PORT
+
+    def stop(self):
+        """Stops accepting sessions and waits for the active ones to finish"""
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def handle_session(self, TCP_connected_sock, tcpADDR):
+        """Internal method. Runs in a worker thread. Simulates and sends data for a single DataStorage session"""
         BUFFER_SIZE = 1024
         END_MESSAGE = b"stop"
 
-        # TCP SOCKET
-        TCP_handshake_socket = socket(AF_INET, SOCK_STREAM) # IPv4, TCP
-        TCP_handshake_socket.bind((HOST, PORT))             # Bind(listen) sockect to the address
-        TCP_handshake_socket.listen(1)                      # Listen for connections on the socket (0-5)
+        with self.sessions_lock:
+            self.sessions_active += 1
 
-        while True:
-            # Start both sockets for listening, as the protocol (to not lose messages in UDP as they are put into a buffer)
-            UDP_data_socket = socket(AF_INET, SOCK_DGRAM)       # IPv4, UDP    
+        # Start both sockets for listening, as the protocol (to not lose messages in UDP as they are put into a buffer)
+        UDP_data_socket = socket(AF_INET, SOCK_DGRAM)       # IPv4, UDP    
 
+        try:
             """INITIAL HANDSHAKE PART (TCP)"""
-            print('-----        TCP SERVER RUNNING        -----')
-            print(f"Listening for incoming connections on {(HOST, PORT)}")
-            
-            # TCP handshake. c = SOCKET to client. a = ADDRESS of client
-            TCP_connected_sock, tcpADDR = TCP_handshake_socket.accept()        
             print('[1] Connection received from {}'.format(tcpADDR))
-            
-            print(f"    Connecting UDP socket {(tcpADDR[0], PORT)}")
-            UDP_data_socket.connect((tcpADDR[0], PORT))                  # Bind sockect to the address
 
             try:
                 numberOfPackets = 0
                 msg = b""
-                print("[2] Receiving packets -> ", end="")
                 while msg[-len(END_MESSAGE):] != END_MESSAGE:   # Check if END_MESSAGE is in a message yet
                     if len(msg) > len(END_MESSAGE): numberOfPackets += 1       # Only count message if more than END_MESSAGE
                     packetData = TCP_connected_sock.recv(BUFFER_SIZE)
+                    if not packetData:
+                        raise ConnectionError("closed before END_MESSAGE")
                     msg = msg + packetData
-                    print(".", end="")
-                print(f"\n{numberOfPackets}: Packets recieved. Bytes:", len(msg))
-            except Exception as e:  print("\nClient closed TCP socket. Assuming its done?", e)
+                print(f"[2] {numberOfPackets}: Packets recieved from {tcpADDR}. Bytes:", len(msg))
+            except Exception as e:
+                print(f"\nClient {tcpADDR} closed TCP socket before sending init data.", e)
+                return
 
             initData = pickle.loads(msg[:-len(END_MESSAGE)])      # Load msg but exclude END_MESSAGE
             #Split pickle object into variables
@@ -53,76 +111,209 @@ class Simulation:
             fill_pct = initData[1]
             sendHyp = initData[2]
             time_stamps = initData[3]
-            
+            options = initData[4] if len(initData) > 4 else {}      # protocol options. Not sent by version 1 clients
+            protocol_version = min(options.get("version", 1), wireformat.PROTOCOL_VERSION)
+
+            # older DataStorages receive on the same port number as the sim listens on
+            udp_port = options.get("udp_port", self.PORT)
+            print(f"    Connecting UDP socket {(tcpADDR[0], udp_port)}")
+            UDP_data_socket.connect((tcpADDR[0], udp_port))                  # Bind sockect to the address
             
             """SIMULATION PART (UDP)"""
             SIMULATED_DATA = self.simulate(seed, fill_pct, sendHyp, time_stamps)
-            print(f"[5] Sending {len(SIMULATED_DATA)*len(SIMULATED_DATA[0])} UDP Sim data packets to DS")
-            for sending_lap in SIMULATED_DATA:                  # For each sendings hyppighed
-                for id in range(len(sending_lap)):              # for each molok in sending -> [(fillPct, timestamp)]
-                    fill_pct = sending_lap[id][0]               # Grab fillPct
-                    time_stamp = sending_lap[id][1]             # Grab timestamp
-                    send_list = [id, fill_pct, time_stamp]      # Collect the values in a tuple with molokID
-
-                    sl = pickle.dumps(send_list)                # dumps: (MolokID, fill_pct, sendhyp)
-                    sleep(0.01)
-                    # print(send_list[0], end=", ")
-                    UDP_data_socket.send(sl)
-            
-            
-            end = pickle.dumps(END_MESSAGE.decode())                           # End session
-            UDP_data_socket.send(end)
-            
+            if protocol_version >= 3:
+                self.send_reliable(UDP_data_socket, TCP_connected_sock, SIMULATED_DATA, options.get("session", 0))
+            elif protocol_version >= 2:
+                self.send_binary(UDP_data_socket, SIMULATED_DATA, options.get("session", 0))
+            else:
+                self.send_pickled(UDP_data_socket, SIMULATED_DATA)
+
+        except Exception as e:
+            print(f"The following error occured in the session with {tcpADDR}: {e}")
+
+        finally:
             """END SESSION"""
-            # Close all sockets, ready for a new session
+            # Close the session's sockets. The handshake socket keeps listening for new sessions
             TCP_connected_sock.close()
-            #TCP_handshake_socket.close()
             UDP_data_socket.close()
-            sleep(1)
-            print("\n[6] SESSION WITH data storage ended")
+            with self.sessions_lock:
+                self.sessions_active -= 1
+                self.sessions_served += 1
+            print(f"[6] SESSION WITH data storage {tcpADDR} ended")
+
+    def send_pickled(self, UDP_data_socket, SIMULATED_DATA):
+        """Sends the simulated data with version 1 of the protocol. One pickled [molokID, fillPct, timestamp] pr. datagram"""
+        END_MESSAGE = b"stop"
+        print(f"[5] Sending {len(SIMULATED_DATA)*len(SIMULATED_DATA[0])} UDP Sim data packets to DS")
+        for sending_lap in SIMULATED_DATA:                  # For each sendings hyppighed
+            for id in range(len(sending_lap)):              # for each molok in sending -> [(fillPct, timestamp)]
+                fill_pct = float(sending_lap[id][0])        # Grab fillPct
+                time_stamp = float(sending_lap[id][1])      # Grab timestamp
+                send_list = [id, fill_pct, time_stamp]      # Collect the values in a tuple with molokID
+
+                sl = pickle.dumps(send_list)                # dumps: (MolokID, fill_pct, sendhyp)
+                sleep(0.01)
+                UDP_data_socket.send(sl)
+
+        end = pickle.dumps(END_MESSAGE.decode())            # End session
+        UDP_data_socket.send(end)
+
+    def send_binary(self, UDP_data_socket, SIMULATED_DATA, session_id):
+        """Sends the simulated data with version 2 of the protocol. Hundreds of readings pr. datagram (see wireformat.py)"""
+        laps = SIMULATED_DATA                               # (sendHyp, moloks, 2) -> fillPct, timestamp
+        molok_ids = np.tile(np.arange(laps.shape[1]), laps.shape[0])
+
+        datagrams = wireformat.pack_batches(session_id, molok_ids, laps[:, :, 0].ravel(), laps[:, :, 1].ravel())
+        print(f"[5] Sending {len(molok_ids)} UDP Sim data readings to DS in {len(datagrams)} datagrams")
+        for datagram in datagrams:
+            UDP_data_socket.send(datagram)
+            sleep(0.01)
+
+        UDP_data_socket.send(wireformat.pack_end(session_id, len(datagrams)))   # End session
+
+    def send_reliable(self, UDP_data_socket, TCP_connected_sock, SIMULATED_DATA, session_id,
+                      start_rate=200, min_rate=10, max_rate=20000, rate_step=50, retransmit_timeout=0.2, timeout=20):
+        """Sends the simulated data with version 3 of the protocol. Binary batches like version 2, but DS reports missing
+        datagrams over the TCP connection, and they are retransmitted until DS has everything.
+        The rate (datagrams pr. sec) starts at start_rate, increases by rate_step on feedback without new loss and is
+        halved when DS reports new loss (AIMD)"""
+        laps = SIMULATED_DATA                               # (sendHyp, moloks, 2) -> fillPct, timestamp
+        molok_ids = np.tile(np.arange(laps.shape[1]), laps.shape[0])
+        datagrams = wireformat.pack_batches(session_id, molok_ids, laps[:, :, 0].ravel(), laps[:, :, 1].ravel())
+        print(f"[5] Sending {len(molok_ids)} UDP Sim data readings to DS in {len(datagrams)} datagrams")
+
+        tcp_lines = wireformat.JSONLines(TCP_connected_sock)
+        to_send = deque(range(len(datagrams)))              # sequence numbers to send. Retransmits go in front
+        queued = set(to_send)                               # sequence numbers in to_send
+        last_sent = {}                                      # sequence number -> time it was last sent
+        rate = start_rate
+        tokens = 1                                          # token bucket. One token pr. datagram
+        sent = retransmits = 0
+        last_refill = last_end = last_feedback = last_decrease = time.time()
+
+        while True:
+            now = time.time()
+            tokens = min(tokens + (now - last_refill) * rate, max(rate * 0.05, 1))     # bursts of max 50 ms
+            last_refill = now
+            while to_send and tokens >= 1:
+                seq = to_send.popleft()
+                queued.discard(seq)
+                UDP_data_socket.send(datagrams[seq])
+                last_sent[seq] = now
+                tokens -= 1
+                sent += 1
+
+            # when everything has been sent once, ask DS what is missing. Repeated in case of retransmits
+            if not to_send and now - last_end > retransmit_timeout:
+                tcp_lines.send({"end": len(datagrams)})
+                last_end = now
 
+            wait = (1 - tokens) / rate if to_send else retransmit_timeout
+            if not select.select([TCP_connected_sock], [], [], max(wait, 0))[0]:
+                if now - last_feedback > timeout:
+                    print(f"\nNo feedback from DS in {timeout} seconds. Giving up")
+                    break
+                continue
 
+            last_feedback = time.time()
+            feedback = tcp_lines.recv()
+            if tcp_lines.closed or any(line.get("done") for line in feedback):
+                break
 
+            new_loss = False
+            for line in feedback:
+                # datagrams already waiting to be sent, or sent so recently that they may still be underway, are skipped
+                missing = [seq for seq in line.get("missing", [])
+                           if seq not in queued and now - last_sent.get(seq, 0) > retransmit_timeout]
+                for seq in reversed(missing):
+                    to_send.appendleft(seq)
+                queued.update(missing)
+                retransmits += len(missing)
+                new_loss = new_loss or bool(missing)
+
+            if new_loss and now - last_decrease > retransmit_timeout:        # halve at most once pr. round trip
+                rate = max(rate / 2, min_rate)
+                last_decrease = now
+            elif not new_loss:
+                rate = min(rate + rate_step, max_rate)
+
+        print(f"    Sent {sent} datagrams of which {retransmits} were retransmits. Final rate {rate} datagrams pr. sec")
 
     def simulate(self, seed, fill_pct, sendHyp, time_stamps):
-        """Start simulation
+        """Start simulation. All sendings of all moloks are simulated at once with array operations
 
         Args:
             seed (int): seed
             fill_pct (list): filling percentages for each molok
             sendHyp (int): how many times to simulate with the given values
-            time_stamps (int): time stamps for each molok
+            time_stamps (list): time stamps for each molok
 
         Returns:
-            complete_list: [(new_fill, time_stamp), ...]
+            complete_array: array of shape (sendHyp, moloks, 2) -> [[(new_fill, time_stamp), ...], ...]
         """
+        # a single day is the first chunk of a horizon of 1 day
+        new_fills, new_time_stamps, _ = next(self.simulate_horizon(seed, fill_pct, sendHyp, time_stamps, days=1,
+                                                                  chunk_rounds=sendHyp))
+        return np.stack((new_fills, new_time_stamps), axis=2)
+
+    def simulate_horizon(self, seed, fill_pct, sendHyp, time_stamps, days, chunk_rounds=None, empty_at=None):
+        """Generator simulating 'days' days of sendings in chunks, so long horizons don't have to fit in memory
 
+        Args:
+            seed (int): seed
+            fill_pct (list): filling percentages for each molok
+            sendHyp (int): sendings pr. molok pr. day
+            time_stamps (list): time stamps for each molok
+            days (float): number of days to simulate
+            chunk_rounds (int): sendings pr. chunk. Defaults to around 1 million readings pr. chunk
+            empty_at (float): if given, moloks are emptied right after a sending with a fillPct at or above this
 
-        np.random.seed(seed)    #Set random seed
-        # Normal gauss distribution: centre = 10, normal distribution = 3 og Output = 1
-        degreeFilling = np.random.normal(10,3,len(fill_pct)) 
-        Completelist = []
+        Yields:
+            (fills, time_stamps, emptied): arrays of shape (chunk_rounds, moloks). emptied is None if empty_at is None
+        """
+        rng = np.random.default_rng(seed)           # own generator. Reproducible without touching the global seed
+        fill_pct = np.array(fill_pct, dtype=float)
+        time_stamps = np.array(time_stamps, dtype=float)
+        num_rounds = int(days * sendHyp)
+        if len(fill_pct) == 0:                      # nothing to simulate, fx. a table without readings yet
+            return
+        chunk_rounds = chunk_rounds or max(1, 1000000 // len(fill_pct))
+
+        # Normal gauss distribution: centre = 10, normal distribution = 3 og Output = len(fill_pct)
+        degreeFilling = rng.normal(10, 3, len(fill_pct))
+        degreeFillingFreq = degreeFilling / sendHyp # Degree filling is divided with sendHyp, to divide the sendHyp over 1 day
         interval = (24*(60*60))/sendHyp             # How many hours (in seconds) 
-        
-        for x in range(sendHyp):
-            Now = max(time_stamps) + interval
-            sendingsListe = []  #[(13,12), (15,12), (14,12)] fill_pct, time_stamp
-            for i in range(len(fill_pct)):
-                sendingsBehind = (Now-time_stamps[i])/interval
-                
-                for _ in range(int(sendingsBehind)):             # Simulate equal to how many sendings each molok is behind NOW
-                    degreeFillingFreq = degreeFilling[i]/sendHyp # Degree filling is divided with sendHyp, to divide the sendHyp over 1 day
-                    Deviation = np.random.normal(1, 0.1)       # Generates a number between 0.9 and 1.1 to create a deviation
-                    new_fill = round(float(fill_pct[i] + degreeFillingFreq*Deviation), 2)
-                    fill_pct[i] = new_fill
-                    time_stamps[i] += interval
 
-                sendingsListe.append((fill_pct[i],  time_stamps[i]))
+        for first_round in range(0, num_rounds, chunk_rounds):
+            rounds = min(chunk_rounds, num_rounds - first_round)
+
+            # In the first sending each molok catches up to max(time_stamps) + interval, after that 1 sending pr. round
+            sendingsBehind = np.ones((rounds, len(fill_pct)))
+            if first_round == 0:
+                sendingsBehind[0] = np.floor((time_stamps.max() + interval - time_stamps) / interval)
+
+            # The sum of n deviations of N(1, 0.1) is N(n, 0.1*sqrt(n)), so all sendings behind are drawn at once
+            Deviation = rng.normal(sendingsBehind, 0.1 * np.sqrt(sendingsBehind))
+            growth = degreeFillingFreq * Deviation
+            new_time_stamps = time_stamps + np.cumsum(sendingsBehind, axis=0) * interval
 
-            Completelist.append(sendingsListe[:])
+            if empty_at is None:
+                new_fills = np.round(fill_pct + np.cumsum(growth, axis=0), 2)
+                emptied = None
+                fill_pct = new_fills[-1]
+            else:
+                # emptying resets the cumulative sum, so step through the rounds (still vectorized over moloks)
+                new_fills = np.empty_like(growth)
+                for r in range(rounds):
+                    fill_pct = np.round(fill_pct + growth[r], 2)
+                    new_fills[r] = fill_pct
+                    fill_pct = np.where(fill_pct >= empty_at, 0, fill_pct)
+                emptied = new_fills >= empty_at
 
-        return Completelist
+            time_stamps = new_time_stamps[-1]
+            yield new_fills, new_time_stamps, emptied
 
 
-sim = Simulation(start_listen=True)
+if __name__ == "__main__":
+    sim = Simulation(start_listen=True)
 #print(sim.simulate(2, [2, 2, 2], 2, [1, 1, 1]))
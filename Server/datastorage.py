@@ -1,4 +1,5 @@
 import socket
+import select
 import sqlite3 as lite
 import numpy as np
 import time
@@ -7,9 +8,49 @@ import pickle
 from scipy import stats
 import requests
 import json
+import os
+import hashlib
+import wireformat
+from Simulation import Simulation
 
 
 
+def parse_molok_pos(molok_pos):
+    """returns (lat, lon) from a molokPos string like '[57.006  9.888]' or '(57, 10)'. (nan, nan) if it can't be parsed"""
+    try:
+        lat, lon = str(molok_pos).strip("[]() ").replace(",", " ").split()
+        return float(lat), float(lon)
+    except ValueError:
+        return float("nan"), float("nan")
+
+
+def downsample_minmax(timestamps, values, max_points: int):
+    """
+    returns (timestamps, values) reduced to at most about 'max_points' points, by splitting them into max_points / 2
+    buckets of equal size and keeping the min and max of each bucket in time order. Unlike averaging, emptyings and
+    peaks survive. Input must be ordered by time, and is returned as it is if it is short enough
+    """
+    n = len(values)
+    if n <= max_points:
+        return timestamps, values
+
+    size = -(-n // max(max_points // 2, 1))             # points pr. bucket, rounded up
+    buckets = -(-n // size)
+    padded = np.full(buckets * size, np.nan)            # last bucket is padded, so all buckets fit in one 2D array
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+
+    offsets = np.arange(buckets) * size
+    keep = np.unique(np.concatenate((np.nanargmin(padded, axis=1) + offsets, np.nanargmax(padded, axis=1) + offsets)))
+
+    return timestamps[keep], values[keep]
+
+
+def plan_inputs_hash(molok_ids, params: dict = None) -> str:
+    """returns hash of the planned molok IDs (in any order) and the planner parameters, to find identical plans in
+    plan_history"""
+    key = json.dumps([sorted(int(molok_id) for molok_id in molok_ids), sorted((params or {}).items())])
+    return hashlib.sha1(key.encode()).hexdigest()
 
 
 class DataStorage:
@@ -19,7 +60,34 @@ class DataStorage:
     Manipulates data and presents it to 'Route Planner' or 'GUI'
     """
 
-    def __init__(self, center_coordinates = (57.01466, 9.987159), scale = 0.01) -> None:
+    # regressed sections shared by all DataStorage objects in the process, as the GUI creates a new one per callback.
+    # key: (DB_NAME, table_name, molok_id, period_start, period_end, last reading ID of molok) -> list of sections
+    regression_cache = {}
+    REGRESSION_CACHE_SIZE = 100000      # cache is cleared when it grows past this many entries
+    PERIOD_STEP = 60                    # the default period ends on a whole minute, so calls within a minute share cache entries
+
+    # device registry of each table, loaded once per process. (DB_NAME, table_name) -> dictionary of arrays (see 'load_device_registry')
+    device_registry_cache = {}
+
+    # tables in DB that are not readings tables. They all have a tableName column referring to a readings table
+    AUX_TABLES = ("molok_latest", "molok_rollup_hourly", "molok_rollup_sections", "sigfox_checkpoints", "device_registry",
+                  "table_versions", "plan_history")
+
+    SIGFOX_API_URL = "https://api.sigfox.com/v2"
+    SIGFOX_AUTH = ("643d0041e0b8bb55976d44fe", "ca70a8def999c45aaf1a3fd5a56f2f58") #Credentials
+
+    # columns that can be streamed with 'stream_readings': column -> (SQL expression, NumPy dtype)
+    STREAM_COLUMNS = {
+        "ID": ("ID", np.int64),
+        "molokID": ("molokID", np.int64),
+        "molokPos": ("molokPos", object),
+        "lat": ("pos_lat(molokPos)", np.float64),
+        "lon": ("pos_lon(molokPos)", np.float64),
+        "fillPct": ("fillPct", np.float64),
+        "timestamp": ("timestamp", np.float64)
+    }
+
+    def __init__(self, center_coordinates = (57.01466, 9.987159), scale = 0.01, db_name = "Server\MolokData.db") -> None:
         """
         There are two different ways to initialize DataStorages comms
         1. with ADDR = '(IP, PORT)' -> creates server socket for communication with simulation
@@ -29,12 +97,14 @@ class DataStorage:
         There are two different ways to use the DB
         1. with TABLE_NAME as "" (empty string) -> creates new TABLE in DB based on config vars
         2. with TABLE_NAME as "XYZ" (actual name) -> opens TABLE in DB with TABLE_NAME
+
+        db_name is the path of the DB file. Pass another path to fx. use a temporary DB for testing
         """
 
         # --- config vars ---
-        self.DB_NAME = "Server\MolokData.db" # fix stien senere
-        self.main_con = lite.connect(self.DB_NAME) # creates connection to DB from main thread
-        self.main_cur = self.main_con.cursor() # creates cursor for main thread
+        self.DB_NAME = db_name # fix stien senere
+        self.main_con, self.main_cur = self.connect_db() # creates connection and cursor to DB for main thread
+        self.create_aux_tables()
 
         self.seed = None                # set to none just to show that these exist and are attributes
         self.num_moloks = None
@@ -44,12 +114,62 @@ class DataStorage:
 
         self.sim_thread = None # creating simThread variable
         self.UDP_recv_socket = None
+        self.sim_stats = None       # counters of the last sim session. Set by simDBLogger
+
+        self.molok_pos_cache = {}   # table_name -> {molokID: molokPos}. Positions don't change, so they are looked up once
+
+    def connect_db(self):
+        """creates a connection and cursor to the DB. SQL functions pos_lat and pos_lon are registered on the connection
+        so molokPos strings can be split into lat and lon inside queries"""
+        con = lite.connect(self.DB_NAME)
+        con.create_function("pos_lat", 1, lambda molok_pos: parse_molok_pos(molok_pos)[0], deterministic=True)
+        con.create_function("pos_lon", 1, lambda molok_pos: parse_molok_pos(molok_pos)[1], deterministic=True)
 
+        return con, con.cursor()
+
+    def get_con_and_cur(self, cursor: str):
+        """returns (connection, cursor) for 'main' or 'sim' thread"""
+        if cursor == "sim":
+            return self.sim_con, self.sim_cur
+        return self.main_con, self.main_cur
+
+    def create_aux_tables(self):
+        """
+        Internal method. Creates the tables shared by all readings tables if they don't exist.
+        - molok_latest: materialized latest reading of each molok in each readings table. Updated in the same
+        transaction as the readings are inserted in (see 'insert_readings'). Indexed by lastID for 'fetch_latest_changes'
+        - molok_rollup_hourly: min, max and last fillpct of each molok in each hour, for readings removed by 'compact_readings'
+        - molok_rollup_sections: regression of each section (see 'lin_reg_sections'), for readings removed by 'compact_readings'
+        - sigfox_checkpoints: time (ms) of the newest message logged from each sigfox device (see sigfoxworker.py)
+        - device_registry: which molok each sigfox device measures, the molok's depth (cm) and position
+        - table_versions: counter of each readings table, bumped every time molok_latest of the table changes. Lets
+        caches (fx. of the GUI map) check if a table changed with a single lookup (see 'fetch_table_version')
+        - plan_history: planned routes of each readings table with their visit times, KPIs and inputs hash, so new
+        plans can start from the most similar previous one (see 'insert_plan' and 'fetch_similar_plan')
+        Skipped with a single lookup when they all exist, as the GUI creates a DataStorage per callback
+        """
+        placeholders = ", ".join("?" * len(self.AUX_TABLES))
+        self.main_cur.execute(f"SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name IN ({placeholders})", self.AUX_TABLES)
+        if self.main_cur.fetchone()[0] == len(self.AUX_TABLES):
+            return
+
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS molok_latest(tableName TEXT, molokID INTEGER, molokPos TUPLE, lat REAL, lon REAL, fillPct REAL, timestamp REAL, lastID INTEGER, PRIMARY KEY (tableName, molokID))")
+        self.main_cur.execute("CREATE INDEX IF NOT EXISTS molok_latest_last_id ON molok_latest(tableName, lastID)")
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS molok_rollup_hourly(tableName TEXT, molokID INTEGER, hour REAL, minFill REAL, maxFill REAL, lastFill REAL, lastTimestamp REAL, n INTEGER, PRIMARY KEY (tableName, molokID, hour))")
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS molok_rollup_sections(tableName TEXT, molokID INTEGER, a REAL, b REAL, t0 REAL, t1 REAL, n INTEGER, firstID INTEGER, lastID INTEGER)")
+        self.main_cur.execute("CREATE INDEX IF NOT EXISTS molok_rollup_sections_molok_time ON molok_rollup_sections(tableName, molokID, t1)")
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS sigfox_checkpoints(tableName TEXT, deviceID TEXT, lastTime INTEGER, PRIMARY KEY (tableName, deviceID))")
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS device_registry(tableName TEXT, deviceID TEXT, molokID INTEGER, depth REAL, lat REAL, lon REAL, PRIMARY KEY (tableName, deviceID))")
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS table_versions(tableName TEXT PRIMARY KEY, version INTEGER)")
+        self.main_cur.execute("CREATE TABLE IF NOT EXISTS plan_history(planID INTEGER PRIMARY KEY, tableName TEXT, created REAL, inputsHash TEXT, numMoloks INTEGER, moloks TEXT, routes TEXT, visitTimes TEXT, KPI TEXT, objective REAL)")
+        self.main_cur.execute("CREATE INDEX IF NOT EXISTS plan_history_table_created ON plan_history(tableName, created)")
+        self.main_cur.execute("CREATE INDEX IF NOT EXISTS plan_history_table_hash ON plan_history(tableName, inputsHash, created)")
+        self.main_con.commit()
 
     def get_tablenames(self):
         """returns table names from DB"""
         self.main_cur.execute("SELECT name FROM sqlite_schema WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
-        return [i[0] for i in list(self.main_cur)]
+        return [i[0] for i in list(self.main_cur) if i[0] not in self.AUX_TABLES]
 
     def create_table(self, seed, num_moloks, table_type):
         """creates new table in DB. If a table with same seed and num moloks exists, that is returned instead of a new
@@ -68,6 +188,7 @@ class DataStorage:
 
         else:
             self.main_cur.execute(f"CREATE TABLE {table_name}(ID INTEGER PRIMARY KEY, molokID INTEGER, molokPos TUPLE, fillPct REAL, timestamp REAL)")
+            self.create_indexes(table_name)
             if table_type == "sim": # only auto generate data if simulations are to be run
                 self.rng = np.random.default_rng(seed) # creates a np.random generator-object with specified seed. Use self.rng for randomness
                 self.generate_init_data(table_name, num_moloks)
@@ -90,12 +211,21 @@ class DataStorage:
 
             self.rng = np.random.default_rng(self.seed) # override previous self.rng with potential new seed
 
+            self.create_indexes(table_name)     # tables created before the index existed get it here
+            self.update_latest_state()          # catch up on readings not in molok_latest yet (fx. older tables)
+            self.main_con.commit()
+
             return True     # if success
         
         return False # if table does not exist
 
 
 
+    def create_indexes(self, table_name):
+        """creates an index on (molokID, timestamp) so time range queries on a single molok don't scan the whole table"""
+        self.main_cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_molok_time ON '{table_name}'(molokID, timestamp)")
+        self.main_con.commit()
+
     def show_table(self):
         """shows Table with TableName from DB"""
         self.main_cur.execute(f"SELECT * FROM '{self.table_name}'")
@@ -114,14 +244,154 @@ class DataStorage:
 
         return np.array(self.main_cur.fetchall()) 
     
+    def stream_readings(self, columns=("ID", "molokID", "fillPct", "timestamp"), period_start=None, period_end=None,
+                        molok_ids=None, order_by_molok=False, chunk_size: int = 10000, cursor: str = "main"):
+        """
+        generator that reads the selected table in chunks of 'chunk_size' rows, so memory use is bounded no matter
+        how long the history is.
+
+        Input
+        ---
+        columns: names from STREAM_COLUMNS. 'lat' and 'lon' are parsed from molokPos by the DB \n
+        period_start, period_end: only readings with timestamp inside the period. None means no bound \n
+        molok_ids: only readings from these moloks. None means all moloks \n
+        order_by_molok: order rows by (molokID, ID) instead of ID, so each molok's readings come in one run
+
+        Output
+        ---
+        yields dictionaries of typed NumPy arrays, one array per column
+        """
+        sql_columns = ", ".join(self.STREAM_COLUMNS[column][0] for column in columns)
+        conditions = []
+        params = []
+
+        if period_start is not None:
+            conditions.append("timestamp >= ?")
+            params.append(float(period_start))
+        if period_end is not None:
+            conditions.append("timestamp <= ?")
+            params.append(float(period_end))
+        if molok_ids is not None:
+            molok_ids = [int(molok_id) for molok_id in molok_ids]
+            conditions.append(f"molokID IN ({', '.join('?' * len(molok_ids))})")
+            params += molok_ids
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "ORDER BY molokID, ID" if order_by_molok else "ORDER BY ID"
+
+        con, cur = self.get_con_and_cur(cursor)
+        stream_cur = con.cursor()       # own cursor, so other queries can run while the generator is alive
+        stream_cur.execute(f"SELECT {sql_columns} FROM '{self.table_name}' {where} {order}", params)
+
+        while True:
+            rows = stream_cur.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            batch = {}
+            for column, values in zip(columns, zip(*rows)):
+                batch[column] = np.array(values, dtype=self.STREAM_COLUMNS[column][1])
+            yield batch
+
+        stream_cur.close()
+
     def fetch_latest_rows(self, cursor: str):
         """returns array containing a row for each molokId with its latest ID"""
-        if cursor == "main":
-            self.main_cur.execute(f"SELECT MAX(ID), molokID, molokPos, fillPct, timestamp FROM '{self.table_name}' GROUP BY molokID")
-            return np.array(self.main_cur.fetchall())
-        elif cursor == "sim":
-            self.sim_cur.execute(f"SELECT MAX(ID), molokID, molokPos, fillPct, timestamp FROM '{self.table_name}' GROUP BY molokID")
-            return np.array(self.sim_cur.fetchall())
+        con, cur = self.get_con_and_cur(cursor)
+        cur.execute("SELECT lastID, molokID, molokPos, fillPct, timestamp FROM molok_latest WHERE tableName = ? ORDER BY molokID", (self.table_name,))
+        return np.array(cur.fetchall())
+
+    def fetch_latest_state(self, cursor: str = "main"):
+        """
+        returns the latest state of each molok from molok_latest as a dictionary of typed NumPy columns ordered by molokID:
+        'molokID' (int), 'lat', 'lon', 'fillPct', 'timestamp' (floats) and 'lastID' (int, ID of latest reading)
+        """
+        con, cur = self.get_con_and_cur(cursor)
+        cur.execute("SELECT molokID, lat, lon, fillPct, timestamp, lastID FROM molok_latest WHERE tableName = ? ORDER BY molokID", (self.table_name,))
+        return self.latest_state_columns(cur.fetchall())
+
+    def fetch_latest_changes(self, since_id: int, cursor: str = "main"):
+        """
+        returns the latest state of the moloks that got a reading with an ID above 'since_id', in the same format as
+        'fetch_latest_state'. Uses the lastID index of molok_latest, so polling it costs only the changed moloks
+        """
+        con, cur = self.get_con_and_cur(cursor)
+        # no ORDER BY, as sqlite would then scan the molokID index instead of seeking the lastID index. Sorted below
+        cur.execute("SELECT molokID, lat, lon, fillPct, timestamp, lastID FROM molok_latest WHERE tableName = ? AND lastID > ?",
+                    (self.table_name, int(since_id)))
+        changes = self.latest_state_columns(cur.fetchall())
+
+        order = np.argsort(changes["molokID"])
+        return {column: values[order] for column, values in changes.items()}
+
+    def latest_state_columns(self, rows):
+        """Internal method. Converts rows of (molokID, lat, lon, fillPct, timestamp, lastID) to typed NumPy columns"""
+        columns = list(zip(*rows)) if rows else [()] * 6
+        return {
+            "molokID": np.array(columns[0], dtype=np.int64),
+            "lat": np.array(columns[1], dtype=np.float64),
+            "lon": np.array(columns[2], dtype=np.float64),
+            "fillPct": np.array(columns[3], dtype=np.float64),
+            "timestamp": np.array(columns[4], dtype=np.float64),
+            "lastID": np.array(columns[5], dtype=np.int64)
+        }
+
+    def update_latest_state(self, cursor: str = "main", table_name=None):
+        """
+        Internal method. Merges readings with an ID above the newest one in molok_latest into molok_latest.
+        Does not commit, so it is part of the same transaction as the insert that called it
+        """
+        table_name = table_name or self.table_name
+        con, cur = self.get_con_and_cur(cursor)
+        # NOT INDEXED: otherwise sqlite scans the whole molokID index for the GROUP BY instead of only the new IDs
+        cur.execute(f"""INSERT INTO molok_latest (tableName, molokID, molokPos, lat, lon, fillPct, timestamp, lastID)
+                        SELECT ?, molokID, molokPos, pos_lat(molokPos), pos_lon(molokPos), fillPct, timestamp, MAX(ID) FROM '{table_name}' NOT INDEXED
+                        WHERE ID > (SELECT COALESCE(MAX(lastID), 0) FROM molok_latest WHERE tableName = ?) GROUP BY molokID
+                        ON CONFLICT (tableName, molokID) DO UPDATE SET molokPos = excluded.molokPos, lat = COALESCE(excluded.lat, lat),
+                        lon = COALESCE(excluded.lon, lon), fillPct = excluded.fillPct, timestamp = excluded.timestamp, lastID = excluded.lastID""",
+                    (table_name, table_name))
+        if cur.rowcount > 0:
+            self.bump_table_version(cursor, table_name)
+
+    def bump_table_version(self, cursor: str = "main", table_name=None):
+        """Internal method. Increments the version of a table in table_versions. Does not commit, like update_latest_state"""
+        con, cur = self.get_con_and_cur(cursor)
+        cur.execute("INSERT INTO table_versions (tableName, version) VALUES (?, 1) ON CONFLICT (tableName) DO UPDATE SET version = version + 1",
+                    (table_name or self.table_name,))
+
+    def fetch_table_version(self, table_name=None, cursor: str = "main") -> int:
+        """returns version of the selected table (or 'table_name'). It changes every time the latest state of the table does. 0 if never written"""
+        con, cur = self.get_con_and_cur(cursor)
+        cur.execute("SELECT version FROM table_versions WHERE tableName = ?", (table_name or self.table_name,))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+    def fetch_molok_positions(self, cursor: str = "main", table_name=None):
+        """returns dictionary with molokID as key and molokPos string as value. Cached, as positions don't change"""
+        table_name = table_name or self.table_name
+        if table_name not in self.molok_pos_cache:
+            con, cur = self.get_con_and_cur(cursor)
+            cur.execute("SELECT molokID, molokPos FROM molok_latest WHERE tableName = ?", (table_name,))
+            self.molok_pos_cache[table_name] = dict(cur.fetchall())
+
+        return self.molok_pos_cache[table_name]
+
+    def insert_readings(self, molok_ids, fill_pcts, timestamps, molok_pos=None, cursor: str = "main", table_name=None):
+        """
+        inserts a batch of readings into the selected table (or 'table_name') and updates molok_latest in the same
+        transaction. molok_pos is a list of molokPos strings. If None, positions are looked up from molok_latest by molokID
+        """
+        table_name = table_name or self.table_name
+        con, cur = self.get_con_and_cur(cursor)
+
+        if molok_pos is None:
+            positions = self.fetch_molok_positions(cursor, table_name)
+            molok_pos = [positions.get(int(molok_id), str(None)) for molok_id in molok_ids]
+
+        rows = zip(map(int, molok_ids), molok_pos, map(float, fill_pcts), map(float, timestamps))
+        cur.executemany(f"INSERT INTO '{table_name}' (molokID, molokPos, fillPct, timestamp) VALUES (?,?,?,?)", rows)
+        self.update_latest_state(cursor, table_name)
+        con.commit()
 
     def drop_table(self, table_name):
         """
@@ -131,6 +401,14 @@ class DataStorage:
         """
         # check if tableName is in DB:
         self.main_cur.execute(f"DROP TABLE IF EXISTS '{table_name}'")
+        for aux_table in self.AUX_TABLES:
+            if aux_table != "table_versions":   # kept and bumped, so caches of the old table never match a new one
+                self.main_cur.execute(f"DELETE FROM {aux_table} WHERE tableName = ?", (table_name,))
+        self.bump_table_version("main", table_name)
+        self.main_con.commit()
+        self.molok_pos_cache.pop(table_name, None)
+        DataStorage.device_registry_cache.pop((self.DB_NAME, table_name), None)
+        DataStorage.regression_cache.clear()        # a new table with the same name would reuse the reading IDs
         return f"You just deleted table {table_name} if it even existed"
 
     def generate_init_data(self, table_name, num_moloks):
@@ -151,14 +429,92 @@ class DataStorage:
         # sim timestamp
         timestamp = time.time()
         
-        for i in range(num_moloks):
-            
-            # insert (molokID, molokPos, fillPcts, timestamp) into DB ; where i is molok id 
-            self.main_cur.execute(f"INSERT INTO {table_name}(molokID, molokPos, fillPct, timestamp) VALUES (?,?,?,?)", (i, str(molok_coords[i]), init_fill_pcts[i], timestamp))
-        self.main_con.commit()
+        # insert (molokID, molokPos, fillPcts, timestamp) into DB ; where i is molok id 
+        self.insert_readings(range(num_moloks), init_fill_pcts, [timestamp] * num_moloks, [str(pos) for pos in molok_coords], table_name=table_name)
 
         return True
 
+    def export_table(self, export_dir: str, chunk_size: int = 500000, compress: bool = False):
+        """
+        exports the selected table to 'export_dir' as columnar NumPy files:
+        - meta.json: table name, seed, number of moloks and list of chunk files
+        - moloks.npz: molok registry (molokID, molokPos, lat, lon) from molok_latest
+        - readings_XXXXX.npz: columns ID, molokID, molokPos, fillPct and timestamp in chunks of 'chunk_size' rows
+        returns number of exported readings
+        """
+        os.makedirs(export_dir, exist_ok=True)
+        save = np.savez_compressed if compress else np.savez
+
+        self.main_cur.execute("SELECT molokID, molokPos, lat, lon FROM molok_latest WHERE tableName = ? ORDER BY molokID", (self.table_name,))
+        moloks = list(zip(*self.main_cur.fetchall())) or [()] * 4
+        save(os.path.join(export_dir, "moloks.npz"), molokID=np.array(moloks[0], dtype=np.int64), molokPos=np.array(moloks[1], dtype=str),
+             lat=np.array(moloks[2], dtype=np.float64), lon=np.array(moloks[3], dtype=np.float64))
+
+        chunk_files = []
+        exported = 0
+        columns = ("ID", "molokID", "molokPos", "fillPct", "timestamp")
+        for chunk_num, batch in enumerate(self.stream_readings(columns, chunk_size=chunk_size)):
+            batch["molokPos"] = batch["molokPos"].astype(str)
+            chunk_file = f"readings_{chunk_num:05d}.npz"
+            save(os.path.join(export_dir, chunk_file), **batch)
+            chunk_files.append(chunk_file)
+            exported += len(batch["ID"])
+
+        meta = {"table_name": self.table_name, "seed": self.seed, "num_moloks": self.num_moloks,
+                "num_readings": exported, "chunks": chunk_files}
+        with open(os.path.join(export_dir, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file, indent=4)
+
+        print(f"Exported {exported} readings from {self.table_name} to {export_dir}")
+        return exported
+
+    def import_table(self, import_dir: str, table_name: str = None):
+        """
+        imports a table exported with 'export_table' (or generated offline in the same format) as a new table.
+        Chunks without a 'molokPos' or 'ID' column get positions from moloks.npz and IDs from the DB.
+        All readings are inserted in a single transaction, and the index and molok_latest are built afterwards.
+        returns name of the new table, or False if it already exists
+        """
+        with open(os.path.join(import_dir, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+        table_name = table_name or meta["table_name"]
+
+        if table_name in self.get_tablenames():
+            print(f"Table {table_name} already exists")
+            return False
+
+        moloks = np.load(os.path.join(import_dir, "moloks.npz"))
+        positions = dict(zip(moloks["molokID"].tolist(), moloks["molokPos"].tolist()))
+
+        self.main_cur.execute(f"CREATE TABLE {table_name}(ID INTEGER PRIMARY KEY, molokID INTEGER, molokPos TUPLE, fillPct REAL, timestamp REAL)")
+
+        try:
+            for chunk_file in meta["chunks"]:
+                chunk = np.load(os.path.join(import_dir, chunk_file))
+                molok_ids = chunk["molokID"].tolist()
+                if "molokPos" in chunk:
+                    molok_pos = chunk["molokPos"].tolist()
+                else:
+                    molok_pos = [positions.get(molok_id, str(None)) for molok_id in molok_ids]
+                ids = chunk["ID"].tolist() if "ID" in chunk else [None] * len(molok_ids)    # None lets the DB pick the ID
+
+                rows = zip(ids, molok_ids, molok_pos, chunk["fillPct"].tolist(), chunk["timestamp"].tolist())
+                self.main_cur.executemany(f"INSERT INTO {table_name}(ID, molokID, molokPos, fillPct, timestamp) VALUES (?,?,?,?,?)", rows)
+
+            # building index and latest state once is faster than keeping them updated during the insert
+            self.main_cur.execute(f"CREATE INDEX IF NOT EXISTS {table_name}_molok_time ON '{table_name}'(molokID, timestamp)")
+            self.update_latest_state("main", table_name)
+            self.main_con.commit()
+
+        except Exception as e:
+            print(f"The following error occured in import_table: {e}")
+            self.main_con.rollback()
+            self.drop_table(table_name)
+            return False
+
+        print(f"Imported {meta['num_readings']} readings into {table_name}")
+        return table_name
+
     def split_fillpcts_to_sections(self, fillpcts_array, timestamp_array, msg_ID_array):
         """split filpcts and their timestamps into sections to account for emptying moloks"""
 
@@ -244,11 +600,324 @@ class DataStorage:
 
         return growthrates_dict
 
-    def avg_growth_over_period(self, regression_dictionary: dict, period_start: float = (time.time() - 86400 * 7), period_end: float = time.time()):
+    def resolve_period(self, period_start=None, period_end=None):
+        """returns (period_start, period_end) in epoch time. Defaults to the last 7 days and is evaluated on every call,
+        so the window does not go stale in a long running process. The default end is rounded up to a whole
+        PERIOD_STEP, so repeated calls get the same window and hit 'regression_cache'"""
+        if period_end is None:
+            period_end = np.ceil(time.time() / self.PERIOD_STEP) * self.PERIOD_STEP
+        if period_start is None:
+            period_start = period_end - 86400 * 7
+
+        return float(period_start), float(period_end)
+
+    def fetch_data_in_period(self, molok_id, period_start, period_end):
+        """Returns array of (ID, fillPct, timestamp) rows for a molok with timestamps inside [period_start, period_end],
+        ordered by ID. Uses the (molokID, timestamp) index, so only readings inside the window are read"""
+        self.main_cur.execute(f"SELECT ID, fillPct, timestamp FROM '{self.table_name}' WHERE molokID = ? AND timestamp BETWEEN ? AND ? ORDER BY ID",
+                              (int(molok_id), period_start, period_end))
+
+        return np.array(self.main_cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+
+    def fetch_molok_history(self, molok_id, period_start=None, period_end=None, max_points: int = 2000) -> dict:
+        """
+        fill history of a single molok for plotting. period_start and period_end default to no bound. Uses the
+        (molokID, timestamp) index, so only readings inside the period are read.
+        returns dictionary with:
+        - 'timestamp', 'fillPct': readings downsampled to about 'max_points' points (see downsample_minmax)
+        - 'readings': number of readings before downsampling
+        - 'rollups': hourly rows of readings removed by 'compact_readings' (see 'fetch_hourly_rollups')
+        - 'sections': regression of each section in the period (see 'lin_reg_molok_period')
+        """
+        period_start = -np.inf if period_start is None else float(period_start)
+        period_end = np.inf if period_end is None else float(period_end)
+
+        # read once for both the regression, which splits sections in ID order like the other regressions, and the plot
+        readings = self.fetch_data_in_period(molok_id, period_start, period_end)
+        by_time = readings[np.argsort(readings[:, 2], kind="stable")]
+        timestamps, fill_pcts = downsample_minmax(by_time[:, 2], by_time[:, 1], max_points)
+
+        return {"timestamp": timestamps, "fillPct": fill_pcts, "readings": len(readings),
+                "rollups": self.fetch_hourly_rollups(molok_id, period_start, period_end),
+                "sections": self.lin_reg_molok_period(molok_id, period_start, period_end, molok_data=readings)}
+
+    def fetch_last_ids(self):
+        """returns dictionary with molokID as key and the ID of its latest reading as value"""
+        self.main_cur.execute("SELECT molokID, lastID FROM molok_latest WHERE tableName = ?", (self.table_name,))
+
+        return dict(self.main_cur.fetchall())
+
+    def lin_reg_molok_period(self, molok_id, period_start, period_end, molok_data=None):
+        """
+        linear regression on each section of a single molok, only using readings inside [period_start, period_end].
+        molok_data is the (ID, fillPct, timestamp) rows of the period, if they are fetched already.
+        returns list of (a = pcts/second, b = pcts at t0, t0 = seconds, t1 = seconds, msg_IDs)
+        """
+        # sections of readings that have been compacted are read from the rollups
+        sections_list = self.fetch_rollup_sections(period_start, period_end, molok_id).get(molok_id, [])
+
+        if molok_data is None:
+            molok_data = self.fetch_data_in_period(molok_id, period_start, period_end)
+        if len(molok_data) < 2:     # nothing to regress on
+            return sections_list
+
+        msg_ID_array, y_array, x_array = molok_data.T
+        molok_sections = self.split_fillpcts_to_sections(fillpcts_array=y_array, timestamp_array=x_array, msg_ID_array=msg_ID_array)
+
+        for section in molok_sections.values():
+            x, y, msg_IDs = section
+
+            if len(x) < 2 or x[-1] == x[0]:     # linregress needs at least two different timestamps
+                continue
+
+            # x is counted from start of section, so b is the fillpct at t0
+            a, b, r, p, std_err = stats.linregress(x - x[0], y)
+            sections_list.append((a, b, x[0], x[-1], msg_IDs))
+
+        return sections_list
+
+    def lin_reg_stream(self, period_start=None, period_end=None, chunk_size: int = 10000, include_rollups: bool = True):
+        """
+        linear regression on each section of each molok in a single pass over 'stream_readings', keeping only running
+        sums in memory. Use this on histories too long for 'lin_reg_sections' or 'lin_reg_period'.
+        period_start and period_end default to no bound. Sections of compacted readings are read from the rollups
+        unless include_rollups is False.
+        returns a dictionary on the same form as 'lin_reg_period', except that msg_IDs is (first ID, last ID, number of
+        readings) of section
+        """
+        growthrates_dict = {molok_id: [] for molok_id in range(self.num_moloks)}
+        if include_rollups:
+            for molok_id, sections in self.fetch_rollup_sections(period_start, period_end).items():
+                growthrates_dict.setdefault(molok_id, []).extend(sections)
+
+        open_section = None     # sums of the section that continues into the next chunk
+
+        def close_section(section):
+            molok_id, t0, t1, n, sx, sy, sxx, sxy, first_ID, last_ID = section
+            denominator = n * sxx - sx ** 2
+            if n < 2 or denominator <= 0:       # needs at least two different timestamps
+                return
+            a = (n * sxy - sx * sy) / denominator
+            b = (sy - a * sx) / n               # fillpct at t0
+            growthrates_dict.setdefault(molok_id, []).append((a, b, t0, t1, (first_ID, last_ID, int(n))))
+
+        for batch in self.stream_readings(("ID", "molokID", "fillPct", "timestamp"), period_start, period_end,
+                                          order_by_molok=True, chunk_size=chunk_size):
+            ids, moloks, y, t = batch["ID"], batch["molokID"], batch["fillPct"], batch["timestamp"]
+
+            # a section starts where the molok changes or where it has been emptied (fillpct = 0)
+            starts = np.ones(len(ids), dtype=bool)
+            starts[1:] = (moloks[1:] != moloks[:-1]) | (y[1:] == 0)
+            continues = open_section is not None and open_section[0] == moloks[0] and y[0] != 0
+            starts[0] = not continues
+            if open_section is not None and not continues:
+                close_section(open_section)
+
+            start_idx = np.flatnonzero(starts)
+            if continues:
+                start_idx = np.concatenate(([0], start_idx))
+            section_of_row = np.cumsum(starts) - (0 if continues else 1)
+
+            # x is counted from start of each section
+            t0 = t[start_idx]
+            if continues:
+                t0[0] = open_section[1]
+            x = t - t0[section_of_row]
+
+            n = np.add.reduceat(np.ones_like(x), start_idx)
+            sx = np.add.reduceat(x, start_idx)
+            sy = np.add.reduceat(y, start_idx)
+            sxx = np.add.reduceat(x * x, start_idx)
+            sxy = np.add.reduceat(x * y, start_idx)
+            end_idx = np.append(start_idx[1:], len(ids)) - 1
+
+            sections = [[int(moloks[start_idx[i]]), t0[i], t[end_idx[i]], n[i], sx[i], sy[i], sxx[i], sxy[i],
+                         int(ids[start_idx[i]]), int(ids[end_idx[i]])] for i in range(len(start_idx))]
+
+            if continues:       # add sums of the section from the previous chunk
+                for i in (3, 4, 5, 6, 7):
+                    sections[0][i] += open_section[i]
+                sections[0][8] = open_section[8]
+
+            for section in sections[:-1]:
+                close_section(section)
+            open_section = sections[-1]     # last section might continue in next chunk
+
+        if open_section is not None:
+            close_section(open_section)
+
+        return growthrates_dict
+
+    def lin_reg_period(self, period_start=None, period_end=None):
         """
-        calculate avg growth in fill pcts over time in the passed 'regression_dictionary'.
+        windowed version of 'lin_reg_sections'. Only readings inside [period_start, period_end] are fetched and
+        regressed. Defaults to the last 7 days, evaluated per call.
+        The sections of each molok are cached by (molok, window, last reading ID), so a molok is only regressed again
+        when it has received new readings.
+        returns a dictionary on the same form as 'lin_reg_sections', except that b is the fillpct at t0
         """
-        avg_growthrates = np.zeros(len(regression_dictionary))
+        period_start, period_end = self.resolve_period(period_start, period_end)
+        last_ids = self.fetch_last_ids()
+
+        if len(DataStorage.regression_cache) > DataStorage.REGRESSION_CACHE_SIZE:
+            DataStorage.regression_cache.clear()
+
+        growthrates_dict = {}
+
+        for molok_id in range(self.num_moloks):
+            key = (self.DB_NAME, self.table_name, molok_id, period_start, period_end, last_ids.get(molok_id))
+
+            if key not in DataStorage.regression_cache:
+                DataStorage.regression_cache[key] = self.lin_reg_molok_period(molok_id, period_start, period_end)
+
+            growthrates_dict[molok_id] = DataStorage.regression_cache[key]
+
+        return growthrates_dict
+
+    def fetch_rollup_sections(self, period_start=None, period_end=None, molok_id=None):
+        """returns dictionary with molokID as key and list of compacted sections overlapping the period as value.
+        Sections are on the same form as in 'lin_reg_stream'. None means no bound / all moloks"""
+        conditions = ["tableName = ?"]
+        params = [self.table_name]
+
+        if molok_id is not None:
+            conditions.append("molokID = ?")
+            params.append(int(molok_id))
+        if period_start is not None:
+            conditions.append("t1 > ?")
+            params.append(float(period_start))
+        if period_end is not None:
+            conditions.append("t0 < ?")
+            params.append(float(period_end))
+
+        self.main_cur.execute(f"SELECT molokID, a, b, t0, t1, firstID, lastID, n FROM molok_rollup_sections WHERE {' AND '.join(conditions)} ORDER BY molokID, t0", params)
+
+        rollup_sections = {}
+        for row in self.main_cur.fetchall():
+            rollup_sections.setdefault(row[0], []).append((row[1], row[2], row[3], row[4], (row[5], row[6], row[7])))
+
+        return rollup_sections
+
+    def compact_readings(self, retention_days: float = 30, archive_dir: str = os.path.join("Server", "archive"),
+                         chunk_size: int = 100000, vacuum: bool = False):
+        """
+        Compacts readings in the selected table that are older than 'retention_days' before its newest reading.
+        Each molok is only compacted up to the start of its section at the cutoff, so a section is either compacted
+        whole or kept as readings, and never counted twice by growth rate estimation:
+        1. each section is regressed and stored in molok_rollup_sections
+        2. readings are rolled up to hourly min/max/last fillpct in molok_rollup_hourly
+        3. raw readings are written to compressed .npz files in 'archive_dir', one per chunk
+        4. raw readings are deleted from the table. With vacuum = True the DB file is shrunk afterwards
+
+        molok_latest is not touched, so map and planner are unaffected. Growth rate estimation reads the rollups for
+        compacted periods (see 'fetch_rollup_sections').
+        returns number of compacted readings
+        """
+        newest = self.fetch_latest_state("main")["timestamp"]
+        if len(newest) == 0:
+            return 0
+
+        cutoff = float(newest.max()) - retention_days * 86400
+        period_end = np.nextafter(cutoff, -np.inf)      # stream_readings includes period_end, the delete below doesn't
+
+        # the section of a molok at the cutoff starts at its last emptying (fillpct = 0) before the cutoff. Readings
+        # before that are compacted. Moloks not emptied before the cutoff keep all their readings
+        self.main_cur.execute(f"SELECT molokID, MAX(timestamp) FROM '{self.table_name}' WHERE timestamp < ? AND fillPct = 0 GROUP BY molokID ORDER BY molokID", (cutoff,))
+        boundaries = self.main_cur.fetchall()
+        boundary_of = np.full(boundaries[-1][0] + 1 if boundaries else 0, -np.inf)     # molokID -> start of its section at the cutoff
+        for molok_id, boundary in boundaries:
+            boundary_of[molok_id] = boundary
+
+        def compacted_mask(molok_ids, timestamps):
+            """True for the readings before the section of their molok at the cutoff"""
+            molok_ids = np.asarray(molok_ids)
+            limits = np.full(len(molok_ids), -np.inf)
+            known = molok_ids < len(boundary_of)
+            limits[known] = boundary_of[molok_ids[known]]
+            return np.asarray(timestamps) < limits
+
+        # 1. regression of compacted sections
+        sections_rows = []
+        for molok_id, sections in self.lin_reg_stream(None, period_end, chunk_size, include_rollups=False).items():
+            for a, b, t0, t1, (first_ID, last_ID, n) in sections:
+                if compacted_mask([molok_id], [t0])[0]:
+                    sections_rows.append((self.table_name, molok_id, a, b, t0, t1, n, first_ID, last_ID))
+        self.main_cur.executemany("INSERT INTO molok_rollup_sections(tableName, molokID, a, b, t0, t1, n, firstID, lastID) VALUES (?,?,?,?,?,?,?,?,?)", sections_rows)
+
+        # 2. and 3. hourly rollups and archive, chunk by chunk
+        if archive_dir:
+            os.makedirs(archive_dir, exist_ok=True)
+
+        compacted = 0
+        columns = ("ID", "molokID", "molokPos", "fillPct", "timestamp")
+        for chunk_num, batch in enumerate(self.stream_readings(columns, None, period_end, order_by_molok=True, chunk_size=chunk_size)):
+            mask = compacted_mask(batch["molokID"], batch["timestamp"])
+            batch = {column: values[mask] for column, values in batch.items()}
+            if len(batch["ID"]) == 0:
+                continue
+            compacted += len(batch["ID"])
+
+            hours = np.floor(batch["timestamp"] / 3600) * 3600
+            order = np.lexsort((batch["ID"], hours, batch["molokID"]))     # sort by molok, then hour, then ID
+            moloks, hours = batch["molokID"][order], hours[order]
+            fills, timestamps = batch["fillPct"][order], batch["timestamp"][order]
+
+            group_starts = np.flatnonzero(np.concatenate(([True], (moloks[1:] != moloks[:-1]) | (hours[1:] != hours[:-1]))))
+            group_ends = np.append(group_starts[1:], len(order)) - 1
+            hourly_rows = zip([self.table_name] * len(group_starts), moloks[group_starts].tolist(), hours[group_starts].tolist(),
+                              np.minimum.reduceat(fills, group_starts).tolist(), np.maximum.reduceat(fills, group_starts).tolist(),
+                              fills[group_ends].tolist(), timestamps[group_ends].tolist(), np.diff(np.append(group_starts, len(order))).tolist())
+
+            # an hour can be split over two chunks, so existing rollups are merged with the new ones
+            self.main_cur.executemany("""INSERT INTO molok_rollup_hourly(tableName, molokID, hour, minFill, maxFill, lastFill, lastTimestamp, n) VALUES (?,?,?,?,?,?,?,?)
+                                         ON CONFLICT (tableName, molokID, hour) DO UPDATE SET minFill = MIN(minFill, excluded.minFill), maxFill = MAX(maxFill, excluded.maxFill),
+                                         lastFill = CASE WHEN excluded.lastTimestamp >= lastTimestamp THEN excluded.lastFill ELSE lastFill END,
+                                         lastTimestamp = MAX(lastTimestamp, excluded.lastTimestamp), n = n + excluded.n""", hourly_rows)
+
+            if archive_dir:
+                archive_file = os.path.join(archive_dir, f"{self.table_name}_until{int(cutoff)}_{chunk_num:05d}.npz")
+                np.savez_compressed(archive_file, ID=batch["ID"], molokID=batch["molokID"], molokPos=batch["molokPos"].astype(str),
+                                    fillPct=batch["fillPct"], timestamp=batch["timestamp"])
+
+        # 4. delete compacted readings in the same transaction as the rollups were written in
+        self.main_cur.executemany(f"DELETE FROM '{self.table_name}' WHERE molokID = ? AND timestamp < ?",
+                                  boundaries)
+        self.main_con.commit()
+
+        DataStorage.regression_cache.clear()        # cached sections might point at deleted readings
+
+        if vacuum:
+            self.main_cur.execute("VACUUM")
+
+        print(f"Compacted {compacted} readings older than {cutoff} in {self.table_name}")
+        return compacted
+
+    def fetch_hourly_rollups(self, molok_id, period_start=None, period_end=None):
+        """returns array of (hour, minFill, maxFill, lastFill, lastTimestamp, n) rows for a molok's compacted readings"""
+        period_start = -np.inf if period_start is None else period_start
+        period_end = np.inf if period_end is None else period_end
+        self.main_cur.execute("SELECT hour, minFill, maxFill, lastFill, lastTimestamp, n FROM molok_rollup_hourly WHERE tableName = ? AND molokID = ? AND hour BETWEEN ? AND ? ORDER BY hour",
+                              (self.table_name, int(molok_id), float(period_start), float(period_end)))
+
+        return np.array(self.main_cur.fetchall(), dtype=np.float64).reshape(-1, 6)
+
+    def growthrates_over_period(self, period_start=None, period_end=None):
+        """avg growthrate of each molok, only regressing the readings inside [period_start, period_end].
+        Same output as 'avg_growth_over_period'"""
+        period_start, period_end = self.resolve_period(period_start, period_end)
+        regression_dictionary = self.lin_reg_period(period_start, period_end)
+
+        return self.avg_growth_over_period(regression_dictionary, period_start, period_end)
+
+    def avg_growth_over_period(self, regression_dictionary: dict, period_start: float = None, period_end: float = None):
+        """
+        calculate avg growth in fill pcts pr. second in the passed 'regression_dictionary'.
+        period defaults to the last 7 days (see 'resolve_period')
+        returns dictionary with molokID as key and avg growthrate as value
+        """
+        period_start, period_end = self.resolve_period(period_start, period_end)
+
+        avg_growthrates = {}
 
         for key in regression_dictionary:
             molok_periods = regression_dictionary[key]
@@ -270,7 +939,7 @@ class DataStorage:
                 return f"No valid sections found for period {period_start} to {period_end}"
             
             # finding avg. growthrate of sections that are part of specified period
-            molok_avg_growthrate = (sum_period_growthrates / num_valid_periods) /60 # go from growth/min to growth/sec
+            molok_avg_growthrate = sum_period_growthrates / num_valid_periods   # sections are regressed in growth/sec
             avg_growthrates[key] = molok_avg_growthrate
 
         return avg_growthrates
@@ -280,20 +949,82 @@ class DataStorage:
         From routeplanner, when moloks are emptied from routes,
         this function sets the filling procentage to 0 by updating the latest rows in the database. 
         """
-        
-        for molok in molok_emptytimes:
-            molok_id = molok[0]
-            timestamp = molok[1] + route_start_time
-            self.main_cur.execute(f"SELECT molokPos FROM '{self.table_name}' WHERE molokID = '{molok_id}'")
-            molokPos = self.main_cur.fetchone() # Getting molokPos. Returns None if empty
-            try: molokPos = molokPos[0] # molokPos is either None or ((),) , so this tries to get the inner tuple
-            except Exception as e:
-                pass
+        molok_ids = [molok[0] for molok in molok_emptytimes]
+        timestamps = [molok[1] + route_start_time for molok in molok_emptytimes]
 
-            # writing sim msg to DB
-            self.main_cur.execute(f"INSERT INTO {self.table_name} (molokId, molokPos, fillPct, timestamp) VALUES (?,?,?,?)", (molok_id, str(molokPos), 0, timestamp))
-            self.main_con.commit()
-            
+        # writing emptied moloks to DB. molokPos is looked up from molok_latest
+        self.insert_readings(molok_ids, [0] * len(molok_ids), timestamps)
+
+
+    def insert_plan(self, routes: list, visit_times: list, kpis: dict, inputs_hash: str, objective: float = None,
+                    created: float = None) -> int:
+        """
+        stores a plan of the selected table in plan_history. 'routes' are lists of molok IDs of the table (depots are
+        left out), 'visit_times' the visit time of each stop (as in MasterPlanner's visit_times) and 'kpis' a JSON-able
+        dictionary (fx. the 'fleet' of RouteEvaluator.evaluate). 'created' defaults to now.
+        returns planID
+        """
+        routes = [[int(molok_id) for molok_id in route if molok_id != "depot"] for route in routes]
+        moloks = sorted(molok_id for route in routes for molok_id in route)
+
+        self.main_cur.execute("INSERT INTO plan_history(tableName, created, inputsHash, numMoloks, moloks, routes, visitTimes, KPI, objective) VALUES (?,?,?,?,?,?,?,?,?)",
+                              (self.table_name, time.time() if created is None else float(created), inputs_hash,
+                               len(moloks), json.dumps(moloks), json.dumps(routes), json.dumps(visit_times),
+                               json.dumps(kpis), objective))
+        self.main_con.commit()
+
+        return self.main_cur.lastrowid
+
+    def fetch_plans(self, limit: int = 30) -> list:
+        """returns the newest 'limit' plans of the selected table, newest first, as dictionaries with 'planID',
+        'created', 'inputsHash', 'moloks' (sorted molok IDs), 'routes', 'visitTimes', 'KPI' and 'objective'"""
+        self.main_cur.execute("SELECT planID, created, inputsHash, moloks, routes, visitTimes, KPI, objective FROM plan_history WHERE tableName = ? ORDER BY created DESC LIMIT ?",
+                              (self.table_name, int(limit)))
+
+        return [self.plan_from_row(row) for row in self.main_cur.fetchall()]
+
+    def fetch_similar_plan(self, molok_ids, inputs_hash: str = None, min_similarity: float = 0.5, limit: int = 30):
+        """
+        finds the previous plan of the selected table whose molok set is most similar to 'molok_ids'. A plan with the
+        same 'inputs_hash' is returned directly. Otherwise the newest 'limit' plans are compared by Jaccard similarity
+        (moloks in both / moloks in either).
+        returns (plan dictionary as in 'fetch_plans', similarity), or (None, 0) if no plan is at least 'min_similarity'
+        """
+        if inputs_hash is not None:
+            self.main_cur.execute("SELECT planID FROM plan_history WHERE tableName = ? AND inputsHash = ? ORDER BY created DESC LIMIT 1",
+                                  (self.table_name, inputs_hash))
+            row = self.main_cur.fetchone()
+            if row is not None:
+                return self.fetch_plan(row[0]), 1.0
+
+        molok_ids = np.unique(np.asarray(molok_ids, dtype=np.int64))
+        best_plan, best_similarity = None, 0
+
+        for plan in self.fetch_plans(limit):
+            plan_moloks = np.asarray(plan["moloks"], dtype=np.int64)      # sorted and unique
+            shared = len(np.intersect1d(molok_ids, plan_moloks, assume_unique=True))
+            similarity = shared / (len(molok_ids) + len(plan_moloks) - shared) if shared else 0
+
+            if similarity > best_similarity:
+                best_plan, best_similarity = plan, similarity
+
+        if best_similarity < min_similarity:
+            return None, 0
+        return best_plan, best_similarity
+
+    def fetch_plan(self, plan_id: int) -> dict:
+        """returns a plan from plan_history as a dictionary like 'fetch_plans', or None if it doesn't exist"""
+        self.main_cur.execute("SELECT planID, created, inputsHash, moloks, routes, visitTimes, KPI, objective FROM plan_history WHERE planID = ?",
+                              (int(plan_id),))
+        row = self.main_cur.fetchone()
+        return None if row is None else self.plan_from_row(row)
+
+    def plan_from_row(self, row) -> dict:
+        """Internal method. Plan dictionary from a (planID, created, inputsHash, moloks, routes, visitTimes, KPI,
+        objective) row of plan_history"""
+        return {"planID": row[0], "created": row[1], "inputsHash": row[2], "moloks": json.loads(row[3]),
+                "routes": json.loads(row[4]), "visitTimes": json.loads(row[5]), "KPI": json.loads(row[6]),
+                "objective": row[7]}
 
     def calc_fillpcts_from_MD(self, distance, molok_depth) -> float:
         """Calculates the fillpct from a measuring device based on measured distance and molok depth (both in cm)"""
@@ -310,11 +1041,11 @@ class DataStorage:
         epoch = str((int(epoch) + 1) * 1000) # Do not include specified 'epoch'. Only msgs after (AKA > epoch)
         # * 1000 as sigfox needs time in ms
 
-        authentication = ("643d0041e0b8bb55976d44fe", "ca70a8def999c45aaf1a3fd5a56f2f58") #Credentials
+        authentication = self.SIGFOX_AUTH
 
         sigID = "1D3711"
 
-        url = f"https://api.sigfox.com/v2/devices/{sigID}/messages?limit={10}&since={epoch}"
+        url = f"{self.SIGFOX_API_URL}/devices/{sigID}/messages?limit={10}&since={epoch}"
         
         req_result = requests.get(url=url, auth=authentication)
 
@@ -333,26 +1064,131 @@ class DataStorage:
     def log_sigfox_to_DB(self, device_coords: tuple = (57, 10), epoch: int = 1681720002):
         """Log information from MD's to DB"""
         
+        md_msgs = self.get_sigfox_data(epoch=epoch)
+
+        # registered devices are mapped to their molok, depth and position by the device registry
+        if md_msgs and md_msgs[0][0] in self.load_device_registry()["index"]:
+            device_ids, times, payloads = zip(*md_msgs)
+            self.log_sigfox_messages(device_ids, [int(msg_time) * 1000 for msg_time in times], payloads)
+            return
+
         # if multiple MDs were implemented, this var could be dynamic instead of hardcoded, but we only use the one
         meas_device_id = 0
 
-        md_msgs = self.get_sigfox_data(epoch=epoch)
-
         device_pos = device_coords
 
+        fill_pcts = []
+        timestamps = []
         for msg in md_msgs:
 
             # calc fill_pct
             meas_distance_str = str(msg[2])
             meas_dist = float(meas_distance_str.split(':')[0])
-            fill_pct = self.calc_fillpcts_from_MD(meas_dist, molok_depth=200)
+            fill_pcts.append(self.calc_fillpcts_from_MD(meas_dist, molok_depth=200))
 
             # isolate timestamp
-            timestamp = float(msg[1])
+            timestamps.append(float(msg[1]))
 
-            self.main_cur.execute(f"INSERT INTO {self.table_name} (molokId, molokPos, fillPct, timestamp) VALUES (?,?,?,?)", (meas_device_id, str(device_pos), fill_pct, timestamp))
-            self.main_con.commit()
+        self.insert_readings([meas_device_id] * len(md_msgs), fill_pcts, timestamps, [str(device_pos)] * len(md_msgs))
+
+
+    def register_devices(self, device_ids, molok_ids, depths, positions):
+        """
+        adds or updates sigfox devices in the device registry of the selected table.
+        positions is a list of (lat, lon) of the moloks. depths are in cm
+        """
+        rows = [(self.table_name, str(device_id), int(molok_id), float(depth), float(pos[0]), float(pos[1]))
+                for device_id, molok_id, depth, pos in zip(device_ids, molok_ids, depths, positions)]
+        self.main_cur.executemany("""INSERT INTO device_registry(tableName, deviceID, molokID, depth, lat, lon) VALUES (?,?,?,?,?,?)
+                                     ON CONFLICT (tableName, deviceID) DO UPDATE SET molokID = excluded.molokID, depth = excluded.depth,
+                                     lat = excluded.lat, lon = excluded.lon""", rows)
+        self.main_con.commit()
+
+        DataStorage.device_registry_cache.pop((self.DB_NAME, self.table_name), None)    # loaded again on next use
+
+    def load_device_registry(self):
+        """
+        returns the device registry of the selected table as a dictionary of arrays sorted by device ID:
+        'deviceID' (str), 'molokID' (int), 'depth', 'lat', 'lon' (floats), 'molokPos' (molokPos strings) and
+        'index' (dictionary of device ID -> row). Loaded from DB once and then cached
+        """
+        cache_key = (self.DB_NAME, self.table_name)
+        if cache_key not in DataStorage.device_registry_cache:
+            self.main_cur.execute("SELECT deviceID, molokID, depth, lat, lon FROM device_registry WHERE tableName = ? ORDER BY deviceID", (self.table_name,))
+            columns = list(zip(*self.main_cur.fetchall())) or [()] * 5
+
+            registry = {
+                "deviceID": np.array(columns[0], dtype=str),
+                "molokID": np.array(columns[1], dtype=np.int64),
+                "depth": np.array(columns[2], dtype=np.float64),
+                "lat": np.array(columns[3], dtype=np.float64),
+                "lon": np.array(columns[4], dtype=np.float64)
+            }
+            registry["molokPos"] = [str((lat, lon)) for lat, lon in zip(columns[3], columns[4])]
+            registry["index"] = {device_id: i for i, device_id in enumerate(columns[0])}
+            DataStorage.device_registry_cache[cache_key] = registry
+
+        return DataStorage.device_registry_cache[cache_key]
+
+    def decode_sigfox_payloads(self, device_ids, payloads):
+        """
+        decodes a batch of '<distance>:cm' payloads from registered devices in array operations.
+        returns (molok_ids, fill_pcts, molok_pos, known) where 'known' is a bool array that is False for payloads from
+        unregistered devices or payloads that can't be decoded. The other arrays only contain the known payloads
+        """
+        registry = self.load_device_registry()
+        device_ids = np.asarray(device_ids, dtype=str)
+        payloads = np.asarray(payloads, dtype=str)
+
+        # look up devices in registry, which is sorted by device ID
+        rows = np.searchsorted(registry["deviceID"], device_ids).clip(0, max(len(registry["deviceID"]) - 1, 0))
+        known = np.zeros(len(device_ids), dtype=bool)
+        if len(registry["deviceID"]):
+            known = registry["deviceID"][rows] == device_ids
+
+        # distance is the part before ':'. Payloads that aren't numbers become nan
+        distance_strs = np.char.strip(np.char.partition(payloads, ":")[:, 0]) if len(payloads) else payloads
+        distances = np.full(len(payloads), np.nan)
+        numeric = np.char.isdigit(np.char.replace(distance_strs, ".", "", count=1)) if len(payloads) else known
+        distances[numeric] = distance_strs[numeric].astype(np.float64)
+        known &= numeric
+
+        rows = rows[known]
+        fill_pcts = self.calc_fillpcts_from_MD(distances[known], registry["depth"][rows])   # works on arrays too
+        molok_pos = [registry["molokPos"][row] for row in rows]
+
+        return registry["molokID"][rows], fill_pcts, molok_pos, known
+
+    def log_sigfox_messages(self, device_ids, times_ms, payloads):
+        """
+        decodes messages from registered devices and logs them with a single bulk insert.
+        times_ms is the sigfox time of each message in ms.
+        returns number of logged messages. Messages from unregistered devices are skipped
+        """
+        molok_ids, fill_pcts, molok_pos, known = self.decode_sigfox_payloads(device_ids, payloads)
+
+        if not known.all():
+            print(f"Skipped {np.count_nonzero(~known)} sigfox messages from unregistered devices or with invalid payloads")
+
+        timestamps = np.asarray(times_ms, dtype=np.float64)[known] / 1000      # sigfox time is in ms
+        self.insert_readings(molok_ids, fill_pcts, timestamps, molok_pos)
+
+        return len(molok_ids)
 
+    def fetch_sigfox_checkpoints(self):
+        """returns dictionary with sigfox device ID as key and time (ms) of its newest logged message as value"""
+        self.main_cur.execute("SELECT deviceID, lastTime FROM sigfox_checkpoints WHERE tableName = ?", (self.table_name,))
+
+        return dict(self.main_cur.fetchall())
+
+    def set_sigfox_checkpoints(self, checkpoints: dict):
+        """
+        Internal method. Saves the time (ms) of the newest logged message for each device in 'checkpoints'.
+        Does not commit, so call it before 'insert_readings' to save checkpoints and readings in the same transaction
+        """
+        self.main_cur.executemany("""INSERT INTO sigfox_checkpoints(tableName, deviceID, lastTime) VALUES (?,?,?)
+                                     ON CONFLICT (tableName, deviceID) DO UPDATE SET lastTime = MAX(lastTime, excluded.lastTime)""",
+                                  [(self.table_name, str(device_id), int(last_time)) for device_id, last_time in checkpoints.items()])
 
     def handshake(self, send_freq):
         """
@@ -361,8 +1197,7 @@ class DataStorage:
         If succesfull, calls simDBLogger, if not then tells sim to abort
         """
         # --- DB vars ---
-        self.sim_con = lite.connect(self.DB_NAME) # creates connection to DB from sim thread
-        self.sim_cur = self.sim_con.cursor() # creates cursor for sim thread
+        self.sim_con, self.sim_cur = self.connect_db() # creates connection and cursor to DB for sim thread
 
         # --- socket var ---
         try:
@@ -376,18 +1211,17 @@ class DataStorage:
 
 
         # creates list of fillPcts to send to sim and creates list of latest timestamps by molokID
-        last_fillpct_list = []
-        latest_timestamps = []
-        last_row_list = self.fetch_latest_rows("sim")
-        for i in last_row_list:
-            fillpct = float(i[3])
-            timestamp = float(i[4])
-            last_fillpct_list.append(fillpct)
-            latest_timestamps.append(timestamp)
+        latest_state = self.fetch_latest_state("sim")
+        last_fillpct_list = latest_state["fillPct"].tolist()
+        latest_timestamps = latest_state["timestamp"].tolist()
         
         # creates message with nescessary data for sim. The list is pickled for easy use on sim-side.
         sends_pr_day = send_freq
-        init_data = [self.seed, last_fillpct_list, sends_pr_day, latest_timestamps]
+        # protocol options are appended last, so a simulation that only knows version 1 ignores them and sends pickles
+        self.sim_session_id = int.from_bytes(os.urandom(4), "big")
+        options = {"version": self.protocol_version, "session": self.sim_session_id,
+                   "udp_port": self.UDP_recv_socket.getsockname()[1]}
+        init_data = [self.seed, last_fillpct_list, sends_pr_day, latest_timestamps, options]
         # print(f"First message of protocol: {init_data}")
         init_data_pickle = pickle.dumps(init_data)
 
@@ -402,54 +1236,148 @@ class DataStorage:
     def simDBLogger(self):
         """
         Internal method. Do not call manually! \n 
-        logs data from sim into DB. This is the second part of our protocol called C22-SIM Protocol"""
-        self.UDP_recv_socket.settimeout(20) # socket now has n second to receive information before raising an error and ending the thread as intended
-        msg_counter = 0
+        logs data from sim into DB. This is the second part of our protocol called C22-SIM Protocol \n
+        With version 3 missing datagrams are reported back to the sim over the TCP connection of the handshake, so the sim
+        can retransmit them and adapt its sending rate (see wireformat.py). Readings are inserted in batches"""
+        udp_sock, tcp_sock = self.UDP_recv_socket, self.TCP_handshake_socket
+        tcp_lines = wireformat.JSONLines(tcp_sock)
+        feedback = self.protocol_version >= 3
+
+        msg_counter = 0                 # readings received
+        inserted = 0                    # readings inserted into DB
+        duplicates = 0                  # datagrams received more than once (retransmitted after all)
+        gaps = 0                        # datagrams that were missing at some point (lost or reordered)
+        received_seqs = set()           # sequence numbers of received binary datagrams
+        missing_seqs = set()            # gaps below the highest received sequence number
+        highest_seq = -1
+        num_datagrams = None            # known when the sim sends 'end'
+        batch = []                      # readings waiting to be inserted
+        batch_rows = 0
+
+        def insert_batch():
+            nonlocal batch, batch_rows, inserted
+            if batch: # molokPos is looked up from molok_latest
+                records = np.concatenate(batch)
+                self.insert_readings(records["molokID"], records["fillPct"], records["timestamp"], cursor="sim")
+                inserted += len(records)
+            batch, batch_rows = [], 0   # only emptied once inserted, so a failed batch is tried again at the end
+
+        def missing(up_to):
+            """sorted list of missing sequence numbers below 'up_to'"""
+            gaps = missing_seqs | set(range(highest_seq + 1, up_to))
+            return sorted(gaps)[:wireformat.MAX_MISSING]
+
+        last_activity = last_feedback = last_insert = time.time()
+        idle_timeout = 20               # seconds without datagrams before the session is ended
+        watched = [udp_sock, tcp_sock]
 
         try:
-            while True: # loop until self.END_MSG is received or socket times out
-
-                msg = self.UDP_recv_socket.recv(self.BUFFER_SIZE)
-                msg = pickle.loads(msg)                
-                
-                if msg == self.END_MSG: # when simulation is done
-                    print(f"END_MSG has been sent by simulation. Breaking out of loop and ending thread")
+            while True: # loop until the sim is done or nothing has been received for idle_timeout seconds
+                readable = select.select(watched, [], [], wireformat.FEEDBACK_INTERVAL)[0]
+                now = time.time()
+
+                if udp_sock in readable:
+                    last_activity = now
+                    msg = udp_sock.recv(self.BUFFER_SIZE)
+
+                    # version 2 and 3: batches of readings in the binary wire format
+                    if wireformat.is_binary(msg):
+                        header, records = wireformat.unpack(msg)
+                        seq = header["seq"]
+                        if header["session"] != self.sim_session_id:
+                            continue # stray datagram from an earlier session
+
+                        if header["flags"] & wireformat.FLAG_END:
+                            lost = seq - len(received_seqs)
+                            print(f"END datagram has been sent by simulation. {lost} of {seq} datagrams were lost")
+                            break
+
+                        if seq in received_seqs:
+                            duplicates += 1
+                            continue # retransmitted datagram that had already arrived
+
+                        received_seqs.add(seq)
+                        missing_seqs.discard(seq)
+                        if seq > highest_seq:
+                            gaps += seq - highest_seq - 1
+                            missing_seqs.update(range(highest_seq + 1, seq))
+                            highest_seq = seq
+
+                        msg_counter += header["count"]
+                        batch.append(records)
+                        batch_rows += header["count"]
+
+                    # version 1: a single pickled reading
+                    else:
+                        msg = pickle.loads(msg)
+                        if msg == self.END_MSG: # when simulation is done
+                            print(f"END_MSG has been sent by simulation. Breaking out of loop and ending thread")
+                            break
+
+                        msg_counter += 1
+                        batch.append(np.array([(int(msg[0]), float(msg[1]), float(msg[2]))], dtype=wireformat.RECORD_DTYPE))
+                        batch_rows += 1
+
+                if tcp_sock in readable:
+                    for line in tcp_lines.recv():
+                        num_datagrams = line.get("end", num_datagrams)
+
+                    if tcp_lines.closed:        # sims of version 1 and 2 close the connection after sending
+                        watched.remove(tcp_sock)
+                        idle_timeout = 1
+
+                if batch_rows >= 8192 or (batch and now - last_insert > 0.2):
+                    insert_batch()
+                    last_insert = now
+
+                if num_datagrams is not None and udp_sock not in readable:     # all sent and UDP buffer drained
+                    still_missing = missing(num_datagrams)
+                    if not still_missing:
+                        insert_batch()
+                        tcp_lines.send({"done": True, "readings": inserted})
+                        print(f"All {num_datagrams} datagrams received from simulation")
+                        break
+
+                    tcp_lines.send({"missing": still_missing})
+                    num_datagrams = None        # wait for retransmits and the next 'end'
+
+                elif feedback and not tcp_lines.closed and now - last_feedback > wireformat.FEEDBACK_INTERVAL:
+                    tcp_lines.send({"received": len(received_seqs), "highest": highest_seq, "missing": missing(0)})
+                    last_feedback = now
+
+                if now - last_activity > idle_timeout:
+                    print(f"No data received from simulation in {idle_timeout} seconds. {len(missing_seqs)} datagrams were lost")
                     break
-                
-                # print(f"recieved msg: {msg}")
-
-                molokId = int(msg[0])
-                fillPct = float(msg[1]) 
-                timestamp = float(msg[2]) 
 
-                msg_counter += 1
-                
-                # finding molok pos with molok ID
-                self.sim_cur.execute(f"SELECT molokPos FROM '{self.table_name}' WHERE molokID = '{molokId}'")
-                molokPos = self.sim_cur.fetchone() # Getting molokPos. Returns None if empty
-                try: molokPos = molokPos[0] # molokPos is either None or ((),) , so this tries to get the inner tuple
-                except Exception as e:
-                    pass
-
-                # writing sim msg to DB
-                self.sim_cur.execute(f"INSERT INTO {self.table_name} (molokId, molokPos, fillPct, timestamp) VALUES (?,?,?,?)", (molokId, str(molokPos), fillPct, timestamp))
-                self.sim_con.commit()
-            
-            self.TCP_handshake_socket.close()
             print(f"Comms ended succesfully. Recieved {msg_counter} datapoints")
 
         except Exception as e:
             print(f"The following error occured in simDBLogger: {e}")
             print("The thread will now be terminated")
-            self.UDP_recv_socket.settimeout(None) # now the socket will block forever, as by default. When thread runs again, timeout is set to n above
-            self.TCP_handshake_socket.close()
 
-    def startSim(self, ADDR, send_freq: int = 3) -> bool:
+        finally:
+            # readings received before an error are still inserted
+            try:
+                insert_batch()
+            except Exception as e:
+                print(f"The following error occured in simDBLogger when inserting the last {batch_rows} readings: {e}")
+
+            tcp_sock.close()
+            # counters of the last session, fx. for load tests. Readings only count once they are inserted
+            self.sim_stats = {"readings": inserted, "received": msg_counter, "datagrams": len(received_seqs), "gaps": gaps,
+                              "duplicates": duplicates, "unrecovered": len(missing_seqs)}
+
+    def startSim(self, ADDR, send_freq: int = 3, protocol_version: int = wireformat.PROTOCOL_VERSION, udp_port: int = None) -> bool:
         """Uses our protocol called C22-SIM Protocol to contact simulation and handle its responses in a thread. 
         
         Input
         ---
         sendFreq: int - determines how many times each simulated measuring device should report its fillPct in the simulation of a single day
+        protocol_version: int - 1 for one pickled reading pr. datagram, 2 for batches in the binary format of wireformat.py,
+        3 for batches with retransmission of lost datagrams and rate control. Data from a simulation that only knows an
+        older version is received either way
+        udp_port: int - port to receive sim data on. Defaults to the port of ADDR, like older sims expect. 0 picks a free
+        port, so several DataStorages on the same host can use the same sim. Only used the first time startSim is called
 
         Output
         ---
@@ -457,13 +1385,16 @@ class DataStorage:
         False: bool - if thread already running"""
 
         self.sim_ADDR = ADDR
-        self.BUFFER_SIZE = 1024
+        self.protocol_version = protocol_version
+        self.BUFFER_SIZE = 65535        # room for a full binary datagram
         self.END_MSG = "stop"
 
         if not self.UDP_recv_socket:        # only create the socket the first time this method is called
             self.UDP_recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # IPv4, UDP
+            self.UDP_recv_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024) # room for bursts while inserting
 
-            self.UDP_recv_socket.bind(("", self.sim_ADDR[1])) # UDP server sock for receiving from sim
+            udp_port = self.sim_ADDR[1] if udp_port is None else udp_port
+            self.UDP_recv_socket.bind(("", udp_port)) # UDP server sock for receiving from sim
 
         # IPAddr=socket.gethostbyname(socket.gethostname())
         # print(f"My IP is : {IPAddr}")
@@ -483,6 +1414,56 @@ class DataStorage:
         """Allows GUI to join simThread into another thread. It lets the GUI update the map as soon as the sim thread is done"""
         self.sim_thread.join()
 
+    def simulate_offline(self, days: float, send_freq: int = 24, empty_at: float = None, chunk_rounds: int = None,
+                         seed: int = None) -> dict:
+        """
+        Simulates 'days' days of readings for the selected table and inserts them directly into the DB, without the
+        C22-SIM sockets. Continues from the latest state of every molok, like startSim does.
+
+        Input
+        ---
+        send_freq: int - readings pr. molok pr. day
+        empty_at: float - if given, moloks are emptied right after a reading at or above this fillPct. The emptying is
+        logged as a reading of 0 one second later, like set_fillpcts_to_0 does
+        chunk_rounds: int - readings pr. molok simulated and inserted pr. transaction. Defaults to around 1 million readings
+        seed: int - defaults to the seed of the table
+
+        Output
+        ---
+        dictionary with number of 'readings' and 'emptyings' inserted and 'seconds' spent
+        """
+        start = time.time()
+        latest_state = self.fetch_latest_state("main")
+        molok_ids = latest_state["molokID"]
+        if len(molok_ids) == 0:                     # fx. a new sigfox table. There is no state to continue from
+            print(f"No readings in {self.table_name} to simulate from")
+            return {"readings": 0, "emptyings": 0, "seconds": time.time() - start}
+        seed = self.seed if seed is None else seed
+
+        readings = emptyings = 0
+        chunks = Simulation(start_listen=False).simulate_horizon(seed, latest_state["fillPct"], send_freq, latest_state["timestamp"],
+                                                                 days, chunk_rounds, empty_at)
+        for fills, timestamps, emptied in chunks:
+            chunk_ids = np.broadcast_to(molok_ids, fills.shape).ravel()
+            chunk_fills, chunk_timestamps = fills.ravel(), timestamps.ravel()
+
+            if emptied is not None and emptied.any():
+                emptied = emptied.ravel()
+                emptyings += int(emptied.sum())
+                chunk_ids = np.concatenate((chunk_ids, chunk_ids[emptied]))
+                chunk_fills = np.concatenate((chunk_fills, np.zeros(emptied.sum())))
+                chunk_timestamps = np.concatenate((chunk_timestamps, chunk_timestamps[emptied] + 1))
+
+                order = np.argsort(chunk_timestamps, kind="stable")     # IDs in time order, so an emptying is the newest row
+                chunk_ids, chunk_fills, chunk_timestamps = chunk_ids[order], chunk_fills[order], chunk_timestamps[order]
+
+            # one transaction pr. chunk. molokPos is looked up from molok_latest
+            self.insert_readings(chunk_ids, chunk_fills, chunk_timestamps)
+            readings += len(chunk_ids)
+            print(f"Simulated {readings} readings of {self.table_name} until {timestamps[-1].max()}")
+
+        return {"readings": readings, "emptyings": emptyings, "seconds": time.time() - start}
+
 
 if __name__ == "__main__":
     
@@ -0,0 +1,512 @@
+"""
+asyncio based ingest server for the C22-SIM protocol, handling many data sources at the same time.
+
+Protocol for a data source (simulation, load test, ...):
+1. connect over TCP and send one JSON line: {"table": <table name>, "expected": <number of readings, optional>,
+"version": <protocol version, optional>}
+2. server answers with one JSON line: {"session": <session ID>, "udp_port": <port>}. Each session gets its own UDP
+port, so every stream is tagged with its table
+3. send readings as UDP datagrams to udp_port from the host of the TCP connection, either as batches in the binary
+format of wireformat.py (version 2) or one pickled [molokID, fillPct, timestamp] pr. datagram (version 1). Pickled
+datagrams are only decoded for sessions that declared version 1, since unpickling runs code chosen by the sender.
+End the stream with an END datagram, a pickled "stop" or by sending "stop" over TCP
+4. server answers with a JSON line with the session's counters and closes the connection
+
+All sessions feed a shared BatchWriter thread that inserts readings into the DB in large batches.
+"""
+
+import asyncio
+import collections
+import json
+import pickle
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+import wireformat
+from datastorage import DataStorage
+
+
+END_MSG = "stop"
+
+
+class BatchWriter(threading.Thread):
+
+    def __init__(self, db_name: str, flush_rows: int = 5000, flush_interval: float = 0.1, on_commit=None) -> None:
+        """
+        Thread that owns its own DataStorage and inserts queued readings into the DB. Readings are grouped by table
+        and inserted when 'flush_rows' readings are waiting or 'flush_interval' seconds have passed.
+        on_commit(table_name, timestamps, commit_time) is called after each insert if given
+        """
+        super().__init__(name="batchWriterThread", daemon=True)
+        self.db_name = db_name
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.on_commit = on_commit
+
+        self.queue = queue.Queue()
+        self.committed = {}                     # session ID -> number of committed readings
+        self.committed_cond = threading.Condition()
+        self.total_committed = 0
+
+    def put(self, table_name: str, session_id: int, molok_ids, fill_pcts, timestamps):
+        """queues readings for insertion. Can be called from any thread"""
+        self.queue.put((table_name, session_id, molok_ids, fill_pcts, timestamps))
+
+    def stop(self):
+        """inserts what is left in the queue and stops the thread"""
+        self.queue.put(None)
+        self.join()
+
+    def wait_committed(self, session_id: int, count: int, timeout: float = 10) -> bool:
+        """blocks until 'count' readings of a session are committed. returns False on timeout"""
+        with self.committed_cond:
+            return self.committed_cond.wait_for(lambda: self.committed.get(session_id, 0) >= count, timeout)
+
+    def forget(self, session_id: int) -> int:
+        """drops the counter of an ended session. returns its number of committed readings"""
+        with self.committed_cond:
+            return self.committed.pop(session_id, 0)
+
+    def run(self):
+        ds = DataStorage(db_name=self.db_name)      # sqlite connections can't be shared between threads
+        buffers = {}                                # table_name -> list of queued items
+        buffered_rows = 0
+        last_flush = time.time()
+        running = True
+
+        while running:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+                if item is None:
+                    running = False
+                else:
+                    buffers.setdefault(item[0], []).append(item)
+                    buffered_rows += len(item[2])
+            except queue.Empty:
+                pass
+
+            if buffered_rows >= self.flush_rows or time.time() - last_flush >= self.flush_interval or not running:
+                for table_name, items in buffers.items():
+                    self.flush(ds, table_name, items)
+                buffers = {}
+                buffered_rows = 0
+                last_flush = time.time()
+
+    def flush(self, ds: DataStorage, table_name: str, items: list):
+        """Internal method. Inserts all items of a table in one transaction"""
+        molok_ids = np.concatenate([np.asarray(item[2]) for item in items])
+        fill_pcts = np.concatenate([np.asarray(item[3]) for item in items])
+        timestamps = np.concatenate([np.asarray(item[4]) for item in items])
+
+        try:
+            ds.insert_readings(molok_ids, fill_pcts, timestamps, table_name=table_name)
+        except Exception as e:
+            print(f"The following error occured in BatchWriter when inserting into {table_name}: {e}")
+            return
+
+        commit_time = time.time()
+        if self.on_commit:
+            self.on_commit(table_name, timestamps, commit_time)
+
+        with self.committed_cond:
+            for item in items:
+                self.committed[item[1]] = self.committed.get(item[1], 0) + len(item[2])
+            self.total_committed += len(molok_ids)
+            self.committed_cond.notify_all()
+
+
+class IngestSession:
+
+    def __init__(self, session_id: int, table_name: str, expected: int = None, peer=None,
+                 version: int = wireformat.PROTOCOL_VERSION) -> None:
+        """counters of a single data stream"""
+        self.session_id = session_id
+        self.table_name = table_name
+        self.expected = expected
+        self.peer = peer
+        self.version = version          # protocol version declared in the handshake
+
+        self.datagrams = 0
+        self.readings = 0
+        self.bytes = 0
+        self.malformed = 0
+        self.foreign = 0                # datagrams from another host than the TCP peer. Dropped
+        self.contiguous_seqs = 0        # binary datagrams 0 .. contiguous_seqs - 1 are all received
+        self.out_of_order_seqs = set()  # received sequence numbers above contiguous_seqs. Small unless datagrams are lost
+        self.datagrams_sent = None      # number of binary datagrams the source sent. Known from the END datagram
+
+        self.start_time = time.time()
+        self.last_datagram_time = self.start_time
+        self.end_time = None
+        self.ended = asyncio.Event()
+
+    def receive_seq(self, seq: int) -> bool:
+        """marks a binary datagram as received. returns False if it is a duplicate"""
+        if seq < self.contiguous_seqs or seq in self.out_of_order_seqs:
+            return False
+
+        if seq == self.contiguous_seqs:
+            self.contiguous_seqs += 1
+            while self.contiguous_seqs in self.out_of_order_seqs:
+                self.out_of_order_seqs.remove(self.contiguous_seqs)
+                self.contiguous_seqs += 1
+        else:
+            self.out_of_order_seqs.add(seq)
+        return True
+
+    def received_datagrams(self) -> int:
+        """number of distinct binary datagrams received"""
+        return self.contiguous_seqs + len(self.out_of_order_seqs)
+
+    def stats(self) -> dict:
+        """returns the session's counters as a dictionary"""
+        duration = (self.end_time or time.time()) - self.start_time
+        lost = max(self.expected - self.readings, 0) if self.expected is not None else None
+        datagrams_lost = self.datagrams_sent - self.received_datagrams() if self.datagrams_sent is not None else None
+        return {"session": self.session_id, "table": self.table_name, "peer": self.peer, "active": self.end_time is None,
+                "datagrams": self.datagrams, "readings": self.readings, "bytes": self.bytes, "malformed": self.malformed,
+                "foreign": self.foreign, "expected": self.expected, "lost": lost, "datagrams_lost": datagrams_lost,
+                "duration": duration, "readings_pr_sec": self.readings / duration if duration > 0 else 0}
+
+
+class SessionProtocol(asyncio.DatagramProtocol):
+    """receives the UDP stream of a single session"""
+
+    def __init__(self, server, session: IngestSession) -> None:
+        self.server = server
+        self.session = session
+
+    def datagram_received(self, data, addr):
+        if self.session.peer is not None and addr[0] != self.session.peer[0]:
+            self.session.foreign += 1
+            return
+        self.server.handle_datagram(self.session, data)
+
+
+class IngestServer:
+
+    ENDED_SESSIONS_KEPT = 100
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 12446, db_name: str = "Server\\MolokData.db",
+                 flush_rows: int = 5000, flush_interval: float = 0.1, idle_timeout: float = 20,
+                 udp_buffer_size: int = 4 * 1024 * 1024, on_commit=None, allow_pickle: bool = False) -> None:
+        """
+        Inputs:
+        ---
+        - host, port: TCP address to listen on for handshakes. port = 0 picks a free port (see self.port after start()).
+        Only listens on localhost by default, pass "0.0.0.0" to accept sources on other hosts
+        - db_name: DB to write to
+        - flush_rows, flush_interval, on_commit: passed to the BatchWriter
+        - idle_timeout: a session is ended if no datagram has been received for this many seconds
+        - udp_buffer_size: receive buffer size of each session's UDP socket in bytes
+        - allow_pickle: decode pickled datagrams of every session, not only of sessions that declared version 1.
+        Only for trusted sources
+        """
+        self.host = host
+        self.port = port
+        self.db_name = db_name
+        self.idle_timeout = idle_timeout
+        self.udp_buffer_size = udp_buffer_size
+        self.allow_pickle = allow_pickle
+
+        self.batch_writer = BatchWriter(db_name, flush_rows, flush_interval, on_commit)
+        self.sessions = {}              # session ID -> IngestSession of active sessions
+        self.ended_stats = collections.deque(maxlen=self.ENDED_SESSIONS_KEPT)  # counters of the latest ended sessions
+        self.next_session_id = 1
+
+        self.loop = None
+        self.server = None
+        self.serve_task = None
+        self.thread = None
+        self.started = threading.Event()
+
+    # --- datagram handling ---
+    def handle_datagram(self, session: IngestSession, data: bytes):
+        """Internal method. Decodes a datagram and queues its readings for the BatchWriter"""
+        session.datagrams += 1
+        session.bytes += len(data)
+        session.last_datagram_time = time.time()
+
+        if wireformat.is_binary(data):
+            self.handle_binary_datagram(session, data)
+            return
+
+        if session.version != 1 and not self.allow_pickle:
+            session.malformed += 1
+            return
+
+        try:
+            msg = pickle.loads(data)
+        except Exception:
+            session.malformed += 1
+            return
+
+        if msg == END_MSG:
+            session.ended.set()
+            return
+
+        try:
+            molok_id, fill_pct, timestamp = int(msg[0]), float(msg[1]), float(msg[2])
+        except Exception:
+            session.malformed += 1
+            return
+
+        session.readings += 1
+        self.batch_writer.put(session.table_name, session.session_id, [molok_id], [fill_pct], [timestamp])
+
+    def handle_binary_datagram(self, session: IngestSession, data: bytes):
+        """Internal method. Queues a batch of readings in the binary format. The records are queued without copying"""
+        try:
+            header, records = wireformat.unpack(data)
+        except ValueError:
+            session.malformed += 1
+            return
+
+        if header["session"] != session.session_id:
+            session.malformed += 1
+            return
+
+        if header["flags"] & wireformat.FLAG_END:
+            session.datagrams_sent = header["seq"]
+            session.ended.set()
+            return
+
+        if not session.receive_seq(header["seq"]):     # duplicate
+            return
+
+        session.readings += header["count"]
+        self.batch_writer.put(session.table_name, session.session_id,
+                              records["molokID"], records["fillPct"], records["timestamp"])
+
+    # --- TCP handshake ---
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Internal method. Runs a single session from handshake to final counters"""
+        peer = writer.get_extra_info("peername")
+        try:
+            hello = json.loads(await reader.readline())
+            table_name = hello["table"]
+            version = int(hello.get("version") or wireformat.PROTOCOL_VERSION)
+        except Exception as e:
+            writer.write(json.dumps({"error": f"invalid handshake: {e}"}).encode() + b"\n")
+            writer.close()
+            return
+
+        if table_name not in self.tablenames:
+            writer.write(json.dumps({"error": f"table {table_name} does not exist"}).encode() + b"\n")
+            writer.close()
+            return
+
+        session = IngestSession(self.next_session_id, table_name, hello.get("expected"), peer, version)
+        self.next_session_id += 1
+        self.sessions[session.session_id] = session
+
+        transport = None
+        try:
+            # each session gets its own UDP socket, which tags the stream with its table
+            transport, protocol = await self.loop.create_datagram_endpoint(lambda: SessionProtocol(self, session),
+                                                                            local_addr=(self.host, 0))
+            udp_sock = transport.get_extra_info("socket")
+            udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.udp_buffer_size)
+            udp_port = udp_sock.getsockname()[1]
+
+            writer.write(json.dumps({"session": session.session_id, "udp_port": udp_port}).encode() + b"\n")
+            await writer.drain()
+            print(f"Session {session.session_id} from {peer} started on UDP port {udp_port} for table {table_name}")
+
+            # session ends on END_MSG datagram, "stop" or EOF over TCP, or when idle for too long
+            tcp_line = asyncio.ensure_future(reader.readline())
+            end_msg = asyncio.ensure_future(session.ended.wait())
+            while not (tcp_line.done() or end_msg.done()):
+                await asyncio.wait({tcp_line, end_msg}, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+                if time.time() - session.last_datagram_time > self.idle_timeout:
+                    print(f"Session {session.session_id} timed out")
+                    break
+            tcp_line.cancel()
+            end_msg.cancel()
+
+            await asyncio.sleep(0.1)        # datagrams sent right before the end can still be in the socket buffer
+            transport.close()
+            session.end_time = time.time()
+
+            # only answer when the session's readings are in the DB
+            await self.loop.run_in_executor(None, self.batch_writer.wait_committed, session.session_id, session.readings)
+
+            stats = self.end_session(session)
+            writer.write(json.dumps(stats).encode() + b"\n")
+            await writer.drain()
+            writer.close()
+            print(f"Session {session.session_id} ended: {stats}")
+        except ConnectionError:
+            pass
+        finally:
+            # also when the connection broke or the server is stopped, so ended sessions don't pile up
+            if transport is not None:
+                transport.close()
+            if session.session_id in self.sessions:
+                self.end_session(session)
+
+    def end_session(self, session: IngestSession) -> dict:
+        """Internal method. Replaces an ended session with its final counters. returns the counters"""
+        session.end_time = session.end_time or time.time()
+        stats = session.stats()
+        stats["committed"] = self.batch_writer.forget(session.session_id)
+        self.sessions.pop(session.session_id, None)
+        self.ended_stats.append(stats)
+        return stats
+
+    # --- start and stop ---
+    async def serve(self):
+        """Internal method. Starts listening and serves until stopped"""
+        self.loop = asyncio.get_running_loop()
+        self.tablenames = set(DataStorage(db_name=self.db_name).get_tablenames())
+
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        print(f"Ingest server listening on port {self.port}")
+        self.started.set()
+
+        async with self.server:
+            await self.server.serve_forever()
+
+    def refresh_tablenames(self):
+        """looks up the tables in DB again, fx. after creating a new table"""
+        self.tablenames = set(DataStorage(db_name=self.db_name).get_tablenames())
+
+    def start(self):
+        """starts the server in a background thread and returns when it is listening"""
+        self.batch_writer.start()
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.serve_until_stopped()), name="ingestServerThread", daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    async def serve_until_stopped(self):
+        """Internal method. Like serve() but returns when the server is closed by stop()"""
+        self.serve_task = asyncio.current_task()
+        try:
+            await self.serve()
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """stops the server and the BatchWriter. Readings already received are still inserted"""
+        if self.loop and self.serve_task:
+            # asyncio.run cancels the sessions' tasks when serving returns. Cancelling every task from here could
+            # also hit the loop's own shutdown
+            self.loop.call_soon_threadsafe(self.serve_task.cancel)
+        if self.thread:
+            self.thread.join(timeout=5)
+        self.batch_writer.stop()
+
+    def session_stats(self) -> list:
+        """returns counters of the active sessions and the latest ended ones, including committed readings"""
+        stats = list(self.ended_stats)
+        for session in list(self.sessions.values()):
+            session_stats = session.stats()
+            session_stats["committed"] = self.batch_writer.committed.get(session.session_id, 0)
+            stats.append(session_stats)
+        return stats
+
+
+class IngestClient:
+
+    def __init__(self, server_addr: tuple, table_name: str, expected: int = None,
+                 protocol_version: int = wireformat.PROTOCOL_VERSION) -> None:
+        """
+        opens a session with an IngestServer at 'server_addr' (IP, PORT). Raises ValueError if the server refuses it.
+        'protocol_version' 1 lets the session send pickled readings
+        """
+        self.tcp_sock = socket.create_connection(server_addr)
+        self.tcp_file = self.tcp_sock.makefile("rwb")
+
+        hello = {"table": table_name, "expected": expected, "version": protocol_version}
+        self.tcp_file.write(json.dumps(hello).encode() + b"\n")
+        self.tcp_file.flush()
+        answer = json.loads(self.tcp_file.readline())
+        if "error" in answer:
+            self.tcp_sock.close()
+            raise ValueError(answer["error"])
+
+        self.session_id = answer["session"]
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_addr = (server_addr[0], answer["udp_port"])
+        self.next_seq = 0                   # sequence number of the next binary datagram
+
+    def send(self, molok_ids, fill_pcts, timestamps, records_pr_datagram: int = wireformat.RECORDS_PR_DATAGRAM) -> int:
+        """sends readings as binary datagrams right away. returns number of datagrams sent"""
+        datagrams = wireformat.pack_batches(self.session_id, molok_ids, fill_pcts, timestamps, records_pr_datagram, self.next_seq)
+        for datagram in datagrams:
+            self.udp_sock.sendto(datagram, self.udp_addr)
+        self.next_seq += len(datagrams)
+        return len(datagrams)
+
+    def send_datagram(self, datagram: bytes):
+        """sends an already packed datagram, fx. a pickled reading"""
+        self.udp_sock.sendto(datagram, self.udp_addr)
+
+    def close(self, end_datagram: bytes = None) -> dict:
+        """ends the session and returns its counters as sent back by the server, once its readings are committed"""
+        end_datagram = end_datagram or wireformat.pack_end(self.session_id, self.next_seq)
+        self.udp_sock.sendto(end_datagram, self.udp_addr)
+        self.tcp_file.write(END_MSG.encode() + b"\n")       # in case the END datagram is lost
+        self.tcp_file.flush()
+
+        stats = json.loads(self.tcp_file.readline())
+        self.udp_sock.close()
+        self.tcp_sock.close()
+
+        return stats
+
+
+def send_readings(server_addr: tuple, table_name: str, molok_ids, fill_pcts, timestamps, pace: float = 0,
+                  protocol_version: int = wireformat.PROTOCOL_VERSION,
+                  records_pr_datagram: int = wireformat.RECORDS_PR_DATAGRAM) -> dict:
+    """
+    Sends readings to an IngestServer at 'server_addr' (IP, PORT) as a single session.
+    protocol_version 2 sends batches of 'records_pr_datagram' readings in the binary format, 1 sends one pickled reading
+    pr. datagram. 'pace' is seconds to sleep between datagrams.
+    returns the session's counters as sent back by the server
+    """
+    client = IngestClient(server_addr, table_name, expected=len(molok_ids), protocol_version=protocol_version)
+
+    if protocol_version >= 2:
+        for first in range(0, len(molok_ids), records_pr_datagram):
+            batch = slice(first, first + records_pr_datagram)
+            client.send(molok_ids[batch], fill_pcts[batch], timestamps[batch], records_pr_datagram)
+            if pace:
+                time.sleep(pace)
+        return client.close()
+
+    for molok_id, fill_pct, timestamp in zip(molok_ids, fill_pcts, timestamps):
+        client.send_datagram(pickle.dumps([int(molok_id), float(fill_pct), float(timestamp)]))
+        if pace:
+            time.sleep(pace)
+    return client.close(pickle.dumps(END_MSG))
+
+
+if __name__ == "__main__":
+    num_sources = 8
+    readings_pr_source = 2000
+
+    server = IngestServer(port=12446)
+    server.start()
+
+    table_name = DataStorage().get_tablenames()[0]
+
+    def source(source_num):
+        rng = np.random.default_rng(source_num)
+        molok_ids = rng.integers(0, 10, readings_pr_source)
+        stats = send_readings(("127.0.0.1", server.port), table_name, molok_ids, rng.random(readings_pr_source) * 100,
+                              time.time() + np.arange(readings_pr_source), pace=0.001)
+        print(f"source {source_num}: {stats}")
+
+    threads = [threading.Thread(target=source, args=[i]) for i in range(num_sources)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    server.stop()
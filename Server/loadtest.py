@@ -0,0 +1,240 @@
+"""
+Load test of the ingestion paths. Replays synthetic fleets against a temporary DB and reports sustained throughput,
+latency percentiles, UDP loss and DB size growth, so ingestion changes can be benchmarked locally.
+
+Paths:
+- ingest: paced sources -> IngestServer -> BatchWriter. Readings are timestamped with the wall clock time they are sent,
+so latency is the time from sending a reading to it being committed
+- sim: Simulation server -> DataStorage.startSim (C22-SIM protocol), one DataStorage and table pr. source. Latency is
+the duration of each session
+- sigfox: MockSigfoxServer -> SigfoxWorker. Latency is the duration of each poll
+
+While a path is loaded, a reader polls fetch_latest_state like the GUI does, to show if reads stall during ingestion.
+"""
+
+import os
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from datastorage import DataStorage
+from Simulation import Simulation
+from ingestserver import IngestServer, IngestClient
+from sigfoxmock import MockSigfoxServer, generate_messages
+from sigfoxworker import SigfoxWorker
+
+
+def percentiles(values) -> dict:
+    """returns p50, p90, p99 and max of 'values' in seconds"""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return {"p50": None, "p90": None, "p99": None, "max": None}
+
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(values.max())}
+
+
+def db_size(db_name: str) -> int:
+    """returns size of the DB in bytes, including its journal files"""
+    return sum(os.path.getsize(db_name + suffix) for suffix in ("", "-wal", "-journal") if os.path.exists(db_name + suffix))
+
+
+class LatestStateReader(threading.Thread):
+
+    def __init__(self, db_name: str, table_name: str, interval: float = 0.2) -> None:
+        """reads the latest state of a table every 'interval' seconds, like the GUI map does, and times each read"""
+        super().__init__(name="latestStateReaderThread", daemon=True)
+        self.db_name = db_name
+        self.table_name = table_name
+        self.interval = interval
+        self.latencies = []
+        self.stopping = threading.Event()
+
+    def run(self):
+        ds = DataStorage(db_name=self.db_name)     # sqlite connections can't be shared between threads
+        ds.table_name = self.table_name
+        while not self.stopping.wait(self.interval):
+            start = time.time()
+            ds.fetch_latest_state("main")
+            self.latencies.append(time.time() - start)
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+
+def ingest_load(db_name: str, num_sources: int = 4, num_moloks: int = 1000, rate: float = 20000, duration: float = 5,
+                records_pr_datagram: int = 512) -> dict:
+    """
+    Each source sends 'rate' readings pr. second for 'duration' seconds to an IngestServer, in binary datagrams of
+    'records_pr_datagram' readings.
+    returns report with throughput, send-to-commit latency, loss, read latency and DB growth
+    """
+    setup = DataStorage(db_name=db_name)
+    table_name = setup.create_table(seed=0, num_moloks=num_moloks, table_type="sim")
+    size_before = db_size(db_name)
+
+    latencies = []      # arrays of send-to-commit latencies. Appended from the BatchWriter thread only
+    server = IngestServer(host="127.0.0.1", port=0, db_name=db_name,
+                          on_commit=lambda table, timestamps, commit_time: latencies.append(commit_time - np.asarray(timestamps)))
+    server.start()
+    reader = LatestStateReader(db_name, table_name)
+    reader.start()
+
+    readings_pr_source = int(rate * duration)
+
+    def source(source_num):
+        rng = np.random.default_rng(source_num)
+        client = IngestClient(("127.0.0.1", server.port), table_name, expected=readings_pr_source)
+
+        start = time.time()
+        sent = 0
+        while sent < readings_pr_source:
+            count = min(records_pr_datagram, readings_pr_source - sent)
+            client.send(rng.integers(0, num_moloks, count), 100 * rng.random(count), np.full(count, time.time()), records_pr_datagram)
+            sent += count
+
+            behind_schedule = start + sent / rate - time.time()       # keep the rate without drifting
+            if behind_schedule > 0:
+                time.sleep(behind_schedule)
+
+        return client.close()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=num_sources) as executor:
+        stats = list(executor.map(source, range(num_sources)))
+    elapsed = time.time() - start
+
+    reader.stop()
+    server.stop()
+
+    committed = sum(session["committed"] for session in stats)
+    return {"offered_rate": num_sources * rate, "readings": committed, "seconds": elapsed,
+            "throughput": committed / elapsed,
+            "latency": percentiles(np.concatenate(latencies) if latencies else []),
+            "lost_readings": sum(session["lost"] for session in stats),
+            "lost_datagrams": sum(session["datagrams_lost"] or 0 for session in stats),
+            "read_latency": percentiles(reader.latencies),
+            "db_growth_bytes": db_size(db_name) - size_before}
+
+
+def sim_load(db_name: str, num_sources: int = 4, num_moloks: int = 500, send_freq: int = 48) -> dict:
+    """
+    Runs 'num_sources' simulation sessions at the same time, each on its own table of 'num_moloks' moloks with
+    'send_freq' readings pr. molok.
+    returns report with throughput, session latency (from each session's own startSim until its readings are
+    inserted), UDP loss, read latency and DB growth
+    """
+    setup = DataStorage(db_name=db_name)
+    table_names = [setup.create_table(seed=seed, num_moloks=num_moloks, table_type="sim") for seed in range(num_sources)]
+    size_before = db_size(db_name)
+
+    sim = Simulation(start_listen=False, HOST="127.0.0.1")
+    port = sim.start(port=0)
+
+    data_storages = []
+    for seed, table_name in enumerate(table_names):
+        ds = DataStorage(db_name=db_name)
+        ds.select_table(table_name, seed, num_moloks)
+        data_storages.append(ds)
+
+    reader = LatestStateReader(db_name, table_names[0])
+    reader.start()
+
+    start = time.time()
+    session_starts = {}         # DataStorage -> time its own session was started
+    for ds in data_storages:
+        session_starts[ds] = time.time()
+        ds.startSim(("127.0.0.1", port), send_freq, udp_port=0)
+
+    session_latencies = []      # time from starting each session to all its readings being inserted
+    pending = list(data_storages)
+    while pending:
+        for ds in list(pending):
+            ds.sim_thread.join(timeout=0.01)
+            if not ds.sim_thread.is_alive():
+                session_latencies.append(time.time() - session_starts[ds])
+                pending.remove(ds)
+    elapsed = time.time() - start
+
+    reader.stop()
+    sim.stop()
+
+    stats = [ds.sim_stats or {} for ds in data_storages]
+    readings = sum(session.get("readings", 0) for session in stats)
+    return {"offered_readings": num_sources * num_moloks * send_freq, "readings": readings, "seconds": elapsed,
+            "throughput": readings / elapsed, "latency": percentiles(session_latencies),
+            "gaps": sum(session.get("gaps", 0) for session in stats),
+            "duplicates": sum(session.get("duplicates", 0) for session in stats),
+            "unrecovered": sum(session.get("unrecovered", 0) for session in stats),
+            "read_latency": percentiles(reader.latencies),
+            "db_growth_bytes": db_size(db_name) - size_before}
+
+
+def sigfox_load(db_name: str, num_devices: int = 200, msgs_per_device: int = 500, polls: int = 5,
+                new_msgs_pr_poll: int = 5, page_limit: int = 100, max_workers: int = 8) -> dict:
+    """
+    Ingests a backlog of 'msgs_per_device' messages from each of 'num_devices' devices on a mock sigfox API, then
+    'polls' polls with 'new_msgs_pr_poll' new messages pr. device each.
+    returns report with backlog throughput, poll latency, read latency and DB growth
+    """
+    interval = 600000                   # ms between messages of a device
+    start_time = 1681720002000
+    mock = MockSigfoxServer(generate_messages(num_devices, msgs_per_device, start_time, interval), page_limit=page_limit)
+    mock.start()
+
+    ds = DataStorage(db_name=db_name)
+    table_name = ds.create_table(seed=0, num_moloks=num_devices, table_type="sigfox")
+    ds.select_table(table_name, 0, num_devices)
+    device_ids = list(mock.messages.keys())
+    positions = [(57 + i / 10000, 10) for i in range(num_devices)]
+    ds.register_devices(device_ids, range(num_devices), [200] * num_devices, positions)
+    size_before = db_size(db_name)
+
+    worker = SigfoxWorker(ds, api_url=mock.url, page_limit=page_limit, max_workers=max_workers)
+    reader = LatestStateReader(db_name, table_name)
+    reader.start()
+
+    start = time.time()
+    readings = worker.poll_once()
+    backlog_seconds = time.time() - start
+
+    poll_latencies = []
+    for poll in range(polls):
+        poll_start_time = start_time + (msgs_per_device + poll * new_msgs_pr_poll) * interval
+        for device_id, messages in generate_messages(num_devices, new_msgs_pr_poll, poll_start_time, interval, seed=poll + 1).items():
+            mock.add_messages(device_id, messages)
+
+        poll_start = time.time()
+        readings += worker.poll_once()
+        poll_latencies.append(time.time() - poll_start)
+
+    reader.stop()
+    mock.stop()
+
+    return {"offered_readings": num_devices * (msgs_per_device + polls * new_msgs_pr_poll), "readings": readings,
+            "backlog_seconds": backlog_seconds, "backlog_throughput": num_devices * msgs_per_device / backlog_seconds,
+            "latency": percentiles(poll_latencies), "requests": worker.stats["requests"],
+            "errors": worker.stats["errors"], "read_latency": percentiles(reader.latencies),
+            "db_growth_bytes": db_size(db_name) - size_before}
+
+
+def print_report(name: str, report: dict):
+    """prints a report from one of the load functions"""
+    print(f"\n___{name}___")
+    for key, value in report.items():
+        if isinstance(value, dict):         # percentiles in seconds -> ms
+            value = ", ".join(f"{p}: {v * 1000:.1f} ms" if v is not None else f"{p}: -" for p, v in value.items())
+        elif isinstance(value, float):
+            value = f"{value:.1f}"
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print_report("IngestServer", ingest_load(os.path.join(tmp_dir, "ingest.db"), num_sources=4, rate=20000, duration=5))
+        print_report("C22-SIM", sim_load(os.path.join(tmp_dir, "sim.db"), num_sources=4, num_moloks=1000, send_freq=48))
+        print_report("Sigfox", sigfox_load(os.path.join(tmp_dir, "sigfox.db"), num_devices=200, msgs_per_device=500))
@@ -0,0 +1,119 @@
+"""
+Local mock of the sigfox API (GET /devices/{id}/messages) for testing the sigfox ingestion without the real network.
+
+Messages are replayed from a dictionary, from a recorded JSON file or generated in bulk with 'generate_messages'.
+Pages are returned newest first with a 'paging.next' url, like the real API.
+"""
+
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import numpy as np
+
+
+def generate_messages(num_devices: int, msgs_per_device: int, start_time: int = 1681720002000,
+                      interval: int = 600000, seed: int = 0, molok_depth: int = 200) -> dict:
+    """returns dictionary with device ID as key and list of messages (as returned by the API) as value.
+    Each device reports a decreasing '<distance>:cm' every 'interval' ms, starting at 'start_time' ms"""
+    rng = np.random.default_rng(seed)
+    messages = {}
+
+    for device_num in range(num_devices):
+        device_id = f"{device_num:06X}"
+        growth = rng.normal(1, 0.3, msgs_per_device).clip(0)                  # cm pr. msg
+        distances = (molok_depth - np.cumsum(growth)).clip(0).astype(int)
+
+        messages[device_id] = [{"device": device_id, "time": start_time + i * interval, "seqNumber": i,
+                                "data": f"{distance}:cm".encode().hex()} for i, distance in enumerate(distances)]
+    return messages
+
+
+class MockSigfoxServer:
+
+    def __init__(self, messages: dict = None, page_limit: int = 100, host: str = "127.0.0.1", port: int = 0) -> None:
+        """
+        messages: dictionary with device ID as key and list of messages (dicts with 'time' in ms and hex 'data') as value
+        page_limit: max number of messages returned per page, no matter the requested limit
+        port: 0 picks a free port. The actual url is in self.url after start()
+        """
+        self.messages = {device_id: sorted(msgs, key=lambda msg: msg["time"]) for device_id, msgs in (messages or {}).items()}
+        self.page_limit = page_limit
+        self.requests_served = 0
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                mock.handle_get(self)
+
+            def log_message(self, *args):       # don't print every request
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+        self.thread = None
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        """creates mock from a JSON file with device ID as key and list of recorded messages as value"""
+        with open(path) as file:
+            return cls(json.load(file), **kwargs)
+
+    def handle_get(self, request: BaseHTTPRequestHandler):
+        """Internal method. Answers GET /devices/{id}/messages?limit=&since=&before= like the sigfox API"""
+        url = urlparse(request.path)
+        parts = url.path.strip("/").split("/")
+        query = {key: int(values[0]) for key, values in parse_qs(url.query).items()}
+
+        if len(parts) < 3 or parts[-1] != "messages" or parts[-3] != "devices" or parts[-2] not in self.messages:
+            request.send_response(404)
+            request.end_headers()
+            return
+
+        device_id = parts[-2]
+        limit = min(query.get("limit", 100), self.page_limit)
+        since = query.get("since", 0)
+        before = query.get("before", None)
+
+        # newest first, like the real API
+        msgs = [msg for msg in self.messages[device_id] if msg["time"] >= since and (before is None or msg["time"] < before)]
+        page = msgs[::-1][:limit]
+
+        response = {"data": page, "paging": {}}
+        if len(msgs) > limit:       # more msgs than fits in page -> link to next (older) page
+            next_query = {"limit": limit, "since": since, "before": page[-1]["time"]}
+            response["paging"]["next"] = f"{self.url}{url.path}?{urlencode(next_query)}"
+
+        body = json.dumps(response).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+        self.requests_served += 1
+
+    def add_messages(self, device_id: str, messages: list):
+        """appends messages to a device, fx. to simulate new msgs arriving between polls"""
+        self.messages.setdefault(device_id, []).extend(messages)
+        self.messages[device_id].sort(key=lambda msg: msg["time"])
+
+    def start(self):
+        """starts serving in a background thread"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="mockSigfoxThread", daemon=True)
+        self.thread.start()
+        print(f"Mock sigfox API running on {self.url}")
+
+    def stop(self):
+        """stops serving and closes the socket"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+if __name__ == "__main__":
+    mock = MockSigfoxServer(generate_messages(num_devices=10, msgs_per_device=1000))
+    mock.start()
+    input("Press enter to stop\n")
+    mock.stop()
@@ -0,0 +1,172 @@
+"""
+Polls the sigfox API for messages from many measuring devices and logs them in the DB through DataStorage.
+Devices are mapped to moloks by the device registry of the selected table (see DataStorage.register_devices).
+
+Devices are polled concurrently in a thread pool sharing one pooled HTTP session. Each device is followed through
+all pages of the API until it is caught up. Newest message time of each device is checkpointed in the DB in the same
+transaction as the readings, so messages are never logged twice.
+
+Run sigfoxmock.py to test against a local mock of the sigfox API instead of the real network.
+"""
+
+import os
+import tempfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from datastorage import DataStorage
+
+
+class SigfoxWorker:
+
+    def __init__(self, data_storage: DataStorage, device_ids: list = None, api_url: str = DataStorage.SIGFOX_API_URL,
+                 auth: tuple = DataStorage.SIGFOX_AUTH, page_limit: int = 100, max_workers: int = 8,
+                 retries: int = 3, timeout: float = 10) -> None:
+        """
+        Inputs:
+        ---
+        - data_storage: DataStorage with the table to log to selected. Only use the worker from the thread that created it
+        - device_ids: list of sigfox device IDs to poll. Defaults to all devices in the table's device registry
+        - api_url: base url of the sigfox API. Point it to a MockSigfoxServer for testing
+        - page_limit: number of messages per page requested from the API
+        - max_workers: number of devices polled at the same time, and size of the HTTP connection pool
+        - retries: number of retries of a failed request. Waits 0.5, 1, 2... seconds between tries
+        """
+        self.ds = data_storage
+        if device_ids is None:
+            device_ids = self.ds.load_device_registry()["deviceID"].tolist()
+        self.device_ids = [str(device_id) for device_id in device_ids]
+
+        self.api_url = api_url.rstrip("/")
+        self.page_limit = page_limit
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        # one session for all threads, so connections are reused instead of opened per request
+        self.session = requests.Session()
+        self.session.auth = auth
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.stats = {"polls": 0, "requests": 0, "messages": 0, "duplicates": 0, "errors": 0}
+        self.stats_lock = threading.Lock()     # requests are counted from the worker threads
+
+    def fetch_device(self, device_id: str, since: int) -> list:
+        """
+        Get all messages from a device that are newer than 'since' (ms), following the API's pages until caught up.
+        Runs in the worker threads.
+        returns list of (device_id, time in ms, decoded data) sorted oldest first
+        """
+        url = f"{self.api_url}/devices/{device_id}/messages"
+        params = {"limit": self.page_limit, "since": since + 1}     # only msgs after (AKA > since)
+
+        messages = []
+        while url:
+            req_result = self.session.get(url, params=params, timeout=self.timeout)
+            req_result.raise_for_status()
+            with self.stats_lock:
+                self.stats["requests"] += 1
+
+            api_JSON = req_result.json()
+            for message in api_JSON["data"]:
+                data = bytes.fromhex(message["data"]).decode()
+                messages.append((device_id, int(message["time"]), data))
+
+            url = api_JSON.get("paging", {}).get("next")    # absolute url of next page, if there is one
+            params = None                                   # next url already contains the parameters
+
+        messages.sort(key=lambda message: message[1])       # msgs originally LIFO. sort to be FIFO
+        return messages
+
+    def poll_once(self) -> int:
+        """
+        Polls all devices concurrently and logs their new messages in one bulk insert.
+        returns number of logged messages
+        """
+        checkpoints = self.ds.fetch_sigfox_checkpoints()
+
+        messages = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.fetch_device, device_id, checkpoints.get(device_id, 0)): device_id
+                       for device_id in self.device_ids}
+
+            for future in as_completed(futures):
+                try:
+                    messages += future.result()
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"The following error occured when polling device {futures[future]}: {e}")
+
+        # dedupe. The API can return the same message on two pages if new messages arrive while paging
+        new_messages = []
+        seen = set()
+        new_checkpoints = {}
+        for message in messages:
+            device_id, msg_time = message[0], message[1]
+            if (device_id, msg_time) in seen or msg_time <= checkpoints.get(device_id, 0):
+                self.stats["duplicates"] += 1
+                continue
+
+            seen.add((device_id, msg_time))
+            new_messages.append(message)
+            new_checkpoints[device_id] = max(new_checkpoints.get(device_id, 0), msg_time)
+
+        logged = 0
+        if new_messages:
+            device_ids, times_ms, payloads = zip(*new_messages)
+
+            # checkpoints are committed together with the readings, which are decoded in one batch by the registry
+            self.ds.set_sigfox_checkpoints(new_checkpoints)
+            logged = self.ds.log_sigfox_messages(device_ids, times_ms, payloads)
+
+        self.stats["polls"] += 1
+        self.stats["messages"] += logged
+
+        return logged
+
+    def run(self, poll_interval: float = 60, stop_event: threading.Event = None):
+        """Polls every 'poll_interval' seconds until 'stop_event' is set. Blocks, so run it in the DataStorage's thread"""
+        stop_event = stop_event or threading.Event()
+
+        while not stop_event.is_set():
+            start = time.time()
+            logged = self.poll_once()
+            print(f"Logged {logged} sigfox messages in {time.time() - start} seconds")
+            stop_event.wait(poll_interval)
+
+
+if __name__ == "__main__":
+    from sigfoxmock import MockSigfoxServer, generate_messages
+
+    num_devices = 200
+    msgs_per_device = 500
+
+    mock = MockSigfoxServer(generate_messages(num_devices, msgs_per_device), page_limit=100)
+    mock.start()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:      # the demo writes to a temporary DB, not the real one
+        myDS = DataStorage(db_name=os.path.join(tmp_dir, "sigfox.db"))
+        table_name = myDS.create_table(seed=0, num_moloks=num_devices, table_type="sigfox")
+        myDS.select_table(table_name, 0, num_devices)
+
+        # device i measures molok i. All moloks are 200 cm deep
+        device_ids = list(mock.messages.keys())
+        positions = [(57 + i / 10000, 10) for i in range(num_devices)]
+        myDS.register_devices(device_ids, range(num_devices), [200] * num_devices, positions)
+
+        worker = SigfoxWorker(myDS, api_url=mock.url)
+
+        start = time.time()
+        print(f"logged {worker.poll_once()} msgs in {time.time() - start} seconds. Stats: {worker.stats}")
+        print(f"polling again logged {worker.poll_once()} msgs")
+
+        myDS.main_con.close()
+
+    mock.stop()
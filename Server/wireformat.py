@@ -0,0 +1,132 @@
+"""
+Binary wire format of version 2 of the C22-SIM protocol. Used by Simulation.py, datastorage.py and ingestserver.py.
+
+Each UDP datagram is a 16 byte header followed by 'count' records of 20 bytes:
+
+header: magic (2s) | version (B) | flags (B) | session ID (I) | sequence number (I) | count (H) | padding (2x)
+record: molokID (uint32) | fillPct (float64) | timestamp (float64)
+
+Header is network byte order, records are little endian so they can be read directly into a NumPy structured array
+without copying (see 'unpack'). Sequence numbers count datagrams from 0 within a session. The last datagram of a
+session has the END flag set, no records, and the number of data datagrams in the session as sequence number.
+
+Version 1 is the original format, one pickled [molokID, fillPct, timestamp] per datagram. It is still accepted.
+
+Version 3 uses the same datagrams, but the TCP connection of the handshake stays open for JSON lines in both directions:
+- receiver -> sender: {"received": <datagrams>, "highest": <seq>, "missing": [<seq>, ...]} every FEEDBACK_INTERVAL
+- sender -> receiver: {"end": <number of datagrams>} when everything has been sent once. Repeated until answered
+- receiver -> sender: {"missing": [...]} if datagrams are still missing at the end, else {"done": true, "readings": <n>}
+The sender retransmits missing datagrams and adjusts its rate: additive increase on clean feedback, halved on new loss.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+
+MAGIC = b"C2"
+PROTOCOL_VERSION = 3
+
+HEADER = struct.Struct("!2sBBIIH2x")
+RECORD_DTYPE = np.dtype([("molokID", "<u4"), ("fillPct", "<f8"), ("timestamp", "<f8")])
+
+FLAG_END = 1
+
+MAX_DATAGRAM_SIZE = 65507                                           # max payload of a UDP datagram over IPv4
+MAX_RECORDS = (MAX_DATAGRAM_SIZE - HEADER.size) // RECORD_DTYPE.itemsize
+RECORDS_PR_DATAGRAM = 512                                           # default. 10 kB datagrams
+
+FEEDBACK_INTERVAL = 0.05                                            # seconds between feedback lines of the receiver
+MAX_MISSING = 1024                                                  # max sequence numbers in a single feedback line
+
+
+def is_binary(data: bytes) -> bool:
+    """True if datagram is in the binary format, False if it is (probably) a pickle"""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def pack(session_id: int, seq: int, molok_ids, fill_pcts, timestamps, flags: int = 0) -> bytes:
+    """packs readings into a single datagram"""
+    records = np.empty(len(molok_ids), dtype=RECORD_DTYPE)
+    records["molokID"] = molok_ids
+    records["fillPct"] = fill_pcts
+    records["timestamp"] = timestamps
+
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, flags, session_id, seq, len(records)) + records.tobytes()
+
+
+def pack_batches(session_id: int, molok_ids, fill_pcts, timestamps, records_pr_datagram: int = RECORDS_PR_DATAGRAM,
+                 start_seq: int = 0) -> list:
+    """packs readings into a list of datagrams with up to 'records_pr_datagram' readings each, numbered from start_seq"""
+    records_pr_datagram = min(records_pr_datagram, MAX_RECORDS)
+
+    records = np.empty(len(molok_ids), dtype=RECORD_DTYPE)
+    records["molokID"] = molok_ids
+    records["fillPct"] = fill_pcts
+    records["timestamp"] = timestamps
+
+    datagrams = []
+    for seq, first in enumerate(range(0, len(records), records_pr_datagram), start=start_seq):
+        batch = records[first:first + records_pr_datagram]
+        datagrams.append(HEADER.pack(MAGIC, PROTOCOL_VERSION, 0, session_id, seq, len(batch)) + batch.tobytes())
+
+    return datagrams
+
+
+def pack_end(session_id: int, num_datagrams: int) -> bytes:
+    """packs the END datagram of a session that sent 'num_datagrams' data datagrams"""
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, FLAG_END, session_id, num_datagrams, 0)
+
+
+def unpack(data: bytes):
+    """
+    unpacks a binary datagram.
+    returns (header, records) where header is a dictionary with 'version', 'flags', 'session', 'seq' and 'count', and
+    records is a structured array with fields 'molokID', 'fillPct' and 'timestamp' viewing the datagram (no copy).
+    raises ValueError if the datagram is not in the binary format or is truncated
+    """
+    if len(data) < HEADER.size or not is_binary(data):
+        raise ValueError("not a C22-SIM binary datagram")
+
+    magic, version, flags, session_id, seq, count = HEADER.unpack_from(data)
+    if len(data) < HEADER.size + count * RECORD_DTYPE.itemsize:
+        raise ValueError(f"truncated datagram: expected {count} records")
+
+    header = {"version": version, "flags": flags, "session": session_id, "seq": seq, "count": count}
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+
+    return header, records
+
+
+class JSONLines:
+
+    def __init__(self, sock) -> None:
+        """sends and receives JSON objects, one pr. line, over a TCP socket. Used for the feedback of version 3"""
+        self.sock = sock
+        self.buffer = b""
+        self.closed = False
+
+    def send(self, obj):
+        """sends a JSON object. Marks the connection closed instead of raising if the other end is gone"""
+        try:
+            self.sock.sendall(json.dumps(obj).encode() + b"\n")
+        except OSError:
+            self.closed = True
+
+    def recv(self) -> list:
+        """
+        reads once from the socket. Only call it when the socket is readable (fx. by select), as it blocks otherwise.
+        returns list of the complete JSON objects received. Sets self.closed if the other end closed the connection
+        """
+        try:
+            data = self.sock.recv(65536)
+        except OSError:
+            data = b""
+        if not data:
+            self.closed = True
+            return []
+
+        self.buffer += data
+        *lines, self.buffer = self.buffer.split(b"\n")
+        return [json.loads(line) for line in lines if line.strip()]
@@ -0,0 +1,42 @@
+"""
+Shared test setup. Puts Server/ and Algorithm/ on sys.path, like the GUI does, so the tests import the modules the
+same way, and has fixtures for the planning tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("Server", "Algorithm"):
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def planner_inputs() -> dict:
+    """keyword arguments of a MasterPlanner of 30 moloks around Aalborg"""
+    num_moloks = 30
+    rng = np.random.default_rng(10)
+    return {"depot_open": 600, "depot_close": 2200,
+            "molok_pos_list": list(zip(rng.normal(57.02, 0.01, num_moloks).tolist(), rng.normal(9.95, 0.02, num_moloks).tolist())),
+            "tte_molok": 5, "fill_pcts": rng.uniform(60, 80, num_moloks).tolist(), "molok_capacity": 500,
+            "molok_est_growthrates": (rng.uniform(5, 10, num_moloks) / 86400).tolist(), "truck_range": 100,
+            "num_trucks": 5, "truck_capacity": 3000, "work_start": 600, "work_stop": 1400, "time_limit_seconds": 2,
+            "num_attempts": 2}
+
+
+@pytest.fixture
+def solved_planner(planner_inputs):
+    """MasterPlanner that has planned routes for 'planner_inputs'"""
+    from routePlanner import MasterPlanner
+
+    mp = MasterPlanner(**planner_inputs)
+    with contextlib.redirect_stdout(io.StringIO()):
+        mp.master()
+    return mp
@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+
+from datastorage import DataStorage
+
+
+@pytest.fixture
+def ds(tmp_path):
+    """DataStorage on a temporary DB"""
+    return DataStorage(db_name=str(tmp_path / "test.db"))
+
+
+def sigfox_table(ds, readings: dict, seed: int = 1):
+    """creates and selects a table without generated data, and inserts 'readings' (molokID -> list of (timestamp, fillPct))"""
+    table_name = ds.create_table(seed, len(readings), "sigfox")
+    ds.select_table(table_name, seed, len(readings))
+    for molok_id, molok_readings in readings.items():
+        timestamps, fills = zip(*molok_readings)
+        ds.insert_readings([molok_id] * len(fills), fills, timestamps, molok_pos=[str((57.0, 9.9))] * len(fills))
+    return table_name
+
+
+def test_growthrates_are_pct_pr_second(ds):
+    t0 = 1.7e9
+    sigfox_table(ds, {0: [(t0 + h * 3600, 10 + h) for h in range(12)],          # 1 % pr. hour
+                      1: [(t0 + h * 3600, 10 + 2 * h) for h in range(12)]})     # 2 % pr. hour
+
+    growthrates = ds.growthrates_over_period(t0 - 1, t0 + 86400)
+
+    assert sorted(growthrates) == [0, 1]                 # keyed by molokID
+    assert growthrates[0] == pytest.approx(1 / 3600)
+    assert growthrates[1] == pytest.approx(2 / 3600)
+
+
+def test_aux_tables_are_created_on_a_fresh_db(tmp_path):
+    db_name = str(tmp_path / "fresh.db")
+    ds = DataStorage(db_name=db_name)
+    ds.main_cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    assert set(DataStorage.AUX_TABLES) <= {row[0] for row in ds.main_cur}
+    ds.main_con.close()
+
+    # a DB deleted and created again in the same process gets them again
+    (tmp_path / "fresh.db").unlink()
+    ds = DataStorage(db_name=db_name)
+    ds.select_table(ds.create_table(1, 2, "sigfox"), 1, 2)
+    assert ds.fetch_table_version() == 0
+
+
+def test_compaction_keeps_the_section_at_the_cutoff_whole(ds, tmp_path):
+    t0 = 1.7e9
+    hours = np.arange(40 * 24)
+    sigfox_table(ds, {0: list(zip(t0 + hours * 3600, (hours % 240) * 0.4)),     # emptied every 10 days
+                      1: list(zip(t0 + hours * 3600, 10 + hours * 0.05))})      # never emptied
+    sections_before = ds.lin_reg_period(t0 - 1, t0 + 50 * 86400)
+
+    compacted = ds.compact_readings(retention_days=15, archive_dir=str(tmp_path / "archive"))   # cutoff inside day 20 - 30
+
+    assert compacted == 20 * 24                 # the first two sections of molok 0
+    sections_after = ds.lin_reg_period(t0 - 1, t0 + 50 * 86400)
+    for molok_id in (0, 1):
+        np.testing.assert_allclose([section[:4] for section in sections_after[molok_id]],
+                                   [section[:4] for section in sections_before[molok_id]], atol=1e-9)
+
+
+def test_molok_history_regresses_like_lin_reg_molok_period(ds):
+    t0 = 1.7e9
+    hours = np.arange(48)
+    readings = list(zip(t0 + hours * 3600, (hours % 24) * 2.0))
+    readings[24], readings[25] = readings[25], readings[24]     # the emptying is inserted after a newer reading
+    sigfox_table(ds, {0: readings})
+
+    history = ds.fetch_molok_history(0)
+
+    assert history["readings"] == 48
+    assert np.all(np.diff(history["timestamp"]) >= 0)
+    np.testing.assert_allclose([section[:4] for section in history["sections"]],
+                               [section[:4] for section in ds.lin_reg_molok_period(0, -np.inf, np.inf)])
+
+
+def test_most_similar_plan_is_found(ds):
+    sigfox_table(ds, {molok_id: [(1.7e9, 50)] for molok_id in range(10)})
+    routes = [["depot", 1, 2, 3, "depot"], ["depot", 4, 5, "depot"]]
+    old = ds.insert_plan(routes, [[0, 60, 120, 180, 240], [0, 60, 120, 180]], {"feasible": True}, "hash-a", created=1)
+    new = ds.insert_plan([[6, 7, 8]], [[0, 60, 120, 180, 240]], {"feasible": True}, "hash-b", created=2)
+
+    plan, similarity = ds.fetch_similar_plan([1, 2, 3, 4, 9])
+    assert plan["planID"] == old
+    assert plan["routes"] == [[1, 2, 3], [4, 5]]
+    assert similarity == 4 / 6
+
+    assert ds.fetch_similar_plan([6, 7], inputs_hash="hash-b") == (ds.fetch_plan(new), 1.0)
+    assert ds.fetch_similar_plan([0, 9]) == (None, 0)
+
+
+def test_windowed_regression_is_cached_until_a_molok_gets_new_readings(ds):
+    t0 = 1.7e9
+    table_name = sigfox_table(ds, {0: [(t0 + h * 3600, 10 + h) for h in range(10)],
+                                   1: [(t0 + h * 3600, 10 + 2 * h) for h in range(10)]})
+    window = (t0 - 1, t0 + 86400)
+
+    first = ds.lin_reg_period(*window)
+    assert [section[0] for section in first[0]] == pytest.approx([1 / 3600])
+    assert ds.lin_reg_period(*window)[0] is first[0]                    # cache hit
+
+    ds.insert_readings([0], [30], [t0 + 12 * 3600], molok_pos=[str((57.0, 9.9))], table_name=table_name)
+    second = ds.lin_reg_period(*window)
+    assert second[0] is not first[0] and second[1] is first[1]          # only molok 0 is regressed again
+    assert second[0][0][3] == t0 + 12 * 3600
+
+    # readings outside the window are not regressed
+    assert [section[2:4] for section in ds.lin_reg_period(t0 + 5 * 3600, t0 + 9 * 3600)[1]] == [(t0 + 5 * 3600, t0 + 9 * 3600)]
+
+
+def test_molok_latest_follows_the_newest_reading_of_each_molok(ds):
+    t0 = 1.7e9
+    table_name = sigfox_table(ds, {molok_id: [(t0 + h * 60, molok_id + h) for h in range(5)] for molok_id in range(3)})
+    last_id = ds.fetch_latest_state()["lastID"].max()
+
+    ds.insert_readings([2, 0, 2], [70, 80, 90], [t0 + 600, t0 + 600, t0 + 660], molok_pos=[str((57.1, 9.8))] * 3, table_name=table_name)
+    state = ds.fetch_latest_state()
+    rows = ds.show_table()
+
+    for molok_id in range(3):
+        newest = rows[rows[:, 1].astype(int) == molok_id][-1]
+        assert state["molokID"][molok_id] == molok_id
+        assert state["lastID"][molok_id] == int(newest[0])
+        assert state["fillPct"][molok_id] == float(newest[3])
+        assert state["timestamp"][molok_id] == float(newest[4])
+    assert (state["lat"][[0, 2]] == 57.1).all() and state["lat"][1] == 57.0
+
+    changes = ds.fetch_latest_changes(last_id)
+    assert changes["molokID"].tolist() == [0, 2]
+    assert changes["fillPct"].tolist() == [80, 90]
+
+
+def test_streamed_regression_matches_lin_reg_period_across_chunks(ds):
+    t0 = 1.7e9
+    fills = [10, 15, 22, 30, 0, 4, 9, 13, 20, 26, 0, 3]
+    sigfox_table(ds, {molok_id: [(t0 + h * 3600 + molok_id, fill * (molok_id + 1)) for h, fill in enumerate(fills)]
+                      for molok_id in range(3)})
+    window = (t0 - 1, t0 + 86400)
+
+    chunks = list(ds.stream_readings(chunk_size=5))
+    assert [len(chunk["ID"]) for chunk in chunks] == [5] * 7 + [1]
+    assert np.concatenate([chunk["ID"] for chunk in chunks]).tolist() == ds.show_table()[:, 0].astype(int).tolist()
+
+    expected = ds.lin_reg_period(*window)
+    for chunk_size in (1, 5, 100):
+        streamed = ds.lin_reg_stream(*window, chunk_size=chunk_size, include_rollups=False)
+        for molok_id in range(3):
+            assert len(streamed[molok_id]) == len(expected[molok_id]) == 3
+            for stream_section, section in zip(streamed[molok_id], expected[molok_id]):
+                np.testing.assert_allclose(stream_section[:4], section[:4], atol=1e-9)
+                assert stream_section[4] == (section[4][0], section[4][-1], len(section[4]))
+
+
+def test_exported_table_imports_as_an_identical_table(ds, tmp_path):
+    t0 = 1.7e9
+    sigfox_table(ds, {molok_id: [(t0 + h * 60, 5 * h) for h in range(4)] for molok_id in range(3)})
+    export_dir = str(tmp_path / "export")
+
+    assert ds.export_table(export_dir, chunk_size=5, compress=True) == 12
+    readings, latest_state = ds.show_table(), ds.fetch_latest_state()
+
+    assert ds.import_table(export_dir, table_name="imported") == "imported"
+    assert ds.import_table(export_dir, table_name="imported") is False
+    ds.select_table("imported", 1, 3)
+    assert (ds.show_table() == readings).all()
+    for column, values in ds.fetch_latest_state().items():
+        assert values.tolist() == latest_state[column].tolist()
+
+
+def test_sigfox_payloads_are_decoded_by_the_device_registry(ds):
+    table_name = ds.create_table(1, 2, "sigfox")
+    ds.select_table(table_name, 1, 2)
+    ds.register_devices(["B2", "A1"], [1, 0], [200, 100], [(57.1, 9.1), (57.0, 9.0)])
+
+    molok_ids, fill_pcts, molok_pos, known = ds.decode_sigfox_payloads(["A1", "C3", "B2", "A1"], ["25:cm", "10:cm", "50:cm", "x:cm"])
+    assert known.tolist() == [True, False, True, False]
+    assert molok_ids.tolist() == [0, 1]
+    assert fill_pcts.tolist() == [75, 75]
+    assert molok_pos == [str((57.0, 9.0)), str((57.1, 9.1))]
+
+    # moving a device is seen by the next decode
+    ds.register_devices(["A1"], [1], [200], [(57.1, 9.1)])
+    assert ds.log_sigfox_messages(["A1", "C3"], [1.7e12, 1.7e12], ["100:cm", "10:cm"]) == 1
+    assert ds.show_table()[:, 1:].tolist() == [["1", str((57.1, 9.1)), "50.0", "1700000000.0"]]
@@ -0,0 +1,31 @@
+import numpy as np
+
+from digitalTwin import DigitalTwin
+
+
+def test_planned_moloks_are_emptied_before_the_next_day():
+    twin = DigitalTwin(num_moloks=30, days=2, waste_limit=25, num_trucks=5, time_limit_seconds=2, num_attempts=2)
+    log = twin.run(seed=3)
+
+    assert all(len(values) == 2 for values in log.values())
+    assert log["planned"][0] > 0
+    assert (log["emptied"] <= log["planned"]).all()
+    assert (log["emptied"][log["planned"] > 0] > 0).all()
+    assert (log["distance_km"][log["emptied"] > 0] > 0).all()
+    assert (log["overflows"] == 0).all()
+
+    # the fleet and its growth only depend on the seed
+    again = twin.run(seed=3)
+    assert again["planned"][0] == log["planned"][0]
+
+
+def test_warm_routes_are_only_picked_from_similar_plans():
+    twin = DigitalTwin(num_moloks=10, warm_start=True, warm_start_similarity=0.5)
+    molok_pos_list = [(57.01 + i / 1000, 9.98) for i in range(10)]
+    fill_pcts = np.full(10, 90.0)
+    previous_plans = [[[0, 1], [2, 3]], [[4, 5, 6]]]
+
+    assert twin.pick_warm_routes(previous_plans, np.array([7, 8, 9]), molok_pos_list, fill_pcts) is None
+
+    warm_routes = twin.pick_warm_routes(previous_plans, np.array([0, 1, 2, 7]), molok_pos_list, fill_pcts)
+    assert sorted(molok for route in warm_routes for molok in route) == [0, 1, 2, 3]
@@ -0,0 +1,81 @@
+import functools
+import importlib.util
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from datastorage import DataStorage
+
+# the GUI module has a space in its name, so it is loaded from its path
+spec = importlib.util.spec_from_file_location("plotly_gui", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                                         "GUI", "plotly gui.py"))
+gui = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(gui)
+
+
+@pytest.fixture
+def ds(tmp_path, monkeypatch):
+    """DataStorage on a temporary DB, which the GUI callbacks use as well, with a selected sim table of 20 moloks"""
+    db_name = str(tmp_path / "gui.db")
+    monkeypatch.setattr(gui, "DataStorage", functools.partial(DataStorage, db_name=db_name))
+    monkeypatch.setattr(gui, "map_cache", {})
+    monkeypatch.setattr(gui, "version_readers", threading.local())
+
+    ds = DataStorage(db_name=db_name)
+    ds.select_table(ds.create_table(seed=7, num_moloks=20, table_type="sim"), 7, 20)
+    return ds
+
+
+def test_live_update_patches_only_the_moloks_with_new_readings(ds):
+    latest_state = ds.fetch_latest_state()
+    gui.map_cache[ds.table_name] = dict(latest_state, table=ds.table_name, clustered=False)     # as rendered by StartSim
+    live = {"table": ds.table_name, "lastID": int(latest_state["lastID"].max())}
+
+    ds.insert_readings([3, 12, 3], [40, 50, 60], [2e9, 2e9, 2e9 + 1])
+    patch, live, disabled = gui.LiveUpdate(1, live, ds.table_name, None)
+
+    colors = patch.to_plotly_json()["operations"]
+    assert [(operation["location"][-1], operation["params"]["value"]) for operation in colors] == [(3, 60), (12, 50)]
+    assert live == {"table": ds.table_name, "lastID": int(ds.fetch_latest_state()["lastID"].max())}
+    assert disabled                                 # no simulation is running
+
+    assert gui.LiveUpdate(2, live, ds.table_name, None)[0] is gui.no_update
+    assert gui.LiveUpdate(3, live, "another table", None) == (gui.no_update, None, True)
+
+
+def test_map_data_is_rendered_again_only_when_the_table_changes(ds, monkeypatch):
+    renders = []
+    monkeypatch.setattr(gui, "craft_base_figure", lambda map_data: renders.append(map_data["version"]) or "figure")
+
+    first = gui.fetch_map_data(ds.table_name)
+    assert gui.fetch_map_data(ds.table_name) is first
+    assert len(renders) == 1
+
+    ds.insert_readings([0], [99], [2e9])
+    second = gui.fetch_map_data(ds.table_name)
+    assert second is not first and second["fillPct"][0] == 99
+    assert renders == [first["version"], second["version"]] and second["version"] > first["version"]
+
+    assert gui.fetch_map_data("sim_seed1_NumM5") is None
+
+
+def test_clusters_cover_every_placed_molok():
+    rng = np.random.default_rng(0)
+    num_moloks = 3000
+    map_data = {"lat": rng.normal(57.01, 0.01, num_moloks), "lon": rng.normal(9.98, 0.02, num_moloks),
+                "fillPct": 100 * rng.random(num_moloks), "molokID": np.arange(num_moloks), "clusters": {}}
+    map_data["lat"][:10] = np.nan                   # moloks without a position
+
+    coarse = gui.cluster_markers(map_data, 10)
+    assert gui.cluster_markers(map_data, 10.2) is coarse
+    assert sum(coarse["count"]) == num_moloks - 10
+    assert max(coarse["fillPct"]) == round(map_data["fillPct"][10:].max(), 1)
+
+    fine = gui.cluster_markers(map_data, 14)
+    assert len(fine["count"]) > len(coarse["count"])
+    assert sum(fine["count"]) == num_moloks - 10
+    for count, molok_id, lat in zip(fine["count"], fine["molokID"], fine["lat"]):
+        if count == 1:                              # a single molok is drawn at its own position
+            assert lat == round(map_data["lat"][molok_id], 5)
@@ -0,0 +1,76 @@
+import pickle
+import socket
+
+import numpy as np
+import pytest
+
+import wireformat
+from datastorage import DataStorage
+from ingestserver import IngestServer, IngestSession, IngestClient, send_readings
+
+
+@pytest.fixture
+def server(tmp_path):
+    """IngestServer on a temporary DB with an empty table 'sigfox_seed1_NumM10'"""
+    db_name = str(tmp_path / "ingest.db")
+    DataStorage(db_name=db_name).create_table(1, 10, "sigfox")
+
+    server = IngestServer(port=0, db_name=db_name, idle_timeout=5)
+    server.start()
+    yield server
+    server.stop()
+
+
+def readings(n: int):
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 10, n), 100 * rng.random(n), 1.7e9 + np.arange(n, dtype=float)
+
+
+def test_binary_session_commits_all_readings(server):
+    stats = send_readings(("127.0.0.1", server.port), "sigfox_seed1_NumM10", *readings(1000), records_pr_datagram=100)
+
+    assert stats["readings"] == stats["committed"] == 1000
+    assert stats["datagrams_lost"] == 0
+
+
+def test_pickle_is_only_decoded_for_version_1_sessions(server):
+    stats = send_readings(("127.0.0.1", server.port), "sigfox_seed1_NumM10", *readings(20), protocol_version=1)
+    assert stats["committed"] == 20
+
+    client = IngestClient(("127.0.0.1", server.port), "sigfox_seed1_NumM10")
+    client.send_datagram(pickle.dumps([1, 50.0, 1.7e9]))
+    stats = client.close()
+    assert stats["readings"] == 0
+    assert stats["malformed"] == 1
+
+
+def test_datagrams_from_other_hosts_are_dropped(server):
+    client = IngestClient(("127.0.0.1", server.port), "sigfox_seed1_NumM10")
+    other_host = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    other_host.bind(("127.0.0.2", 0))
+    other_host.sendto(wireformat.pack(client.session_id, 0, *readings(5)), client.udp_addr)
+    other_host.close()
+
+    stats = client.close()
+    assert stats["readings"] == 0
+    assert stats["foreign"] == 1
+
+
+def test_ended_sessions_keep_only_their_counters(server):
+    for _ in range(3):
+        send_readings(("127.0.0.1", server.port), "sigfox_seed1_NumM10", *readings(100))
+
+    assert server.sessions == {}
+    assert server.batch_writer.committed == {}
+    assert [stats["committed"] for stats in server.session_stats()] == [100, 100, 100]
+
+
+def test_out_of_order_seqs_are_folded_into_the_contiguous_count():
+    session = IngestSession(1, "table")
+    for seq in [0, 2, 3, 1, 2, 5]:
+        session.receive_seq(seq)
+
+    assert session.contiguous_seqs == 4
+    assert session.out_of_order_seqs == {5}
+    assert session.received_datagrams() == 5
+    assert not session.receive_seq(1)
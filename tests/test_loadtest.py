@@ -0,0 +1,31 @@
+from loadtest import percentiles, ingest_load, sim_load, sigfox_load
+
+
+def test_percentiles():
+    assert percentiles([]) == {"p50": None, "p90": None, "p99": None, "max": None}
+    assert percentiles(range(101)) == {"p50": 50, "p90": 90, "p99": 99, "max": 100}
+
+
+def test_ingest_load_commits_all_offered_readings(tmp_path):
+    report = ingest_load(str(tmp_path / "ingest.db"), num_sources=2, num_moloks=100, rate=2000, duration=0.5)
+
+    assert report["readings"] == report["offered_rate"] * 0.5 == 2000
+    assert report["lost_readings"] == 0
+    assert report["latency"]["max"] >= report["latency"]["p50"] >= 0
+    assert report["db_growth_bytes"] > 0
+
+
+def test_sim_load_reports_a_latency_per_session(tmp_path):
+    report = sim_load(str(tmp_path / "sim.db"), num_sources=3, num_moloks=50, send_freq=8)
+
+    assert report["readings"] == report["offered_readings"] == 3 * 50 * 8
+    assert report["unrecovered"] == 0
+    assert report["latency"]["max"] <= report["seconds"]
+
+
+def test_sigfox_load_logs_the_backlog_and_every_poll(tmp_path):
+    report = sigfox_load(str(tmp_path / "sigfox.db"), num_devices=10, msgs_per_device=150, polls=2, new_msgs_pr_poll=3)
+
+    assert report["readings"] == report["offered_readings"] == 10 * (150 + 2 * 3)
+    assert report["errors"] == 0
+    assert report["latency"]["max"] is not None
@@ -0,0 +1,49 @@
+import time
+
+import numpy as np
+
+import support_functions as sf
+from localSearch import LocalSearch
+from routeEvaluator import RouteEvaluator
+
+
+def scattered_plan(num_moloks: int = 40, num_trucks: int = 4):
+    """evaluator with time windows, and a feasible plan with the moloks dealt out to the trucks in random order"""
+    rng = np.random.default_rng(3)
+    positions = np.column_stack((rng.normal(57.02, 0.01, num_moloks), rng.normal(9.95, 0.02, num_moloks)))
+    locations = np.concatenate(([[57.0257998, 9.9194714]], positions))
+    distance_matrix = np.round(sf.pairwise_meters(locations, locations)).astype(np.int64)
+    time_matrix = np.round(distance_matrix / (50 / 3.6)).astype(np.int64) + 300
+    time_matrix[0, :] -= 300
+    np.fill_diagonal(time_matrix, 0)
+
+    fill_pcts = rng.uniform(40, 70, num_moloks)
+    growthrates = rng.uniform(5, 30, num_moloks) / 86400
+    demands = np.concatenate(([0], np.round(fill_pcts / 100 * 500))).astype(np.int64)
+    time_windows = [[0, 8 * 3600]] + sf.molokTimeWindows(fill_pcts, growthrates, slack=0)
+
+    evaluator = RouteEvaluator(time_matrix, distance_matrix, demands, time_windows, fill_pcts, growthrates,
+                               truck_range=100000, truck_capacity=6000, max_route_time=8 * 3600)
+    routes = [[0] + (rng.permutation(np.arange(truck, num_moloks, num_trucks)) + 1).tolist() + [0] for truck in range(num_trucks)]
+    return evaluator, routes
+
+
+def test_improved_plan_stays_feasible_and_visits_every_molok():
+    evaluator, routes = scattered_plan()
+    assert evaluator.evaluate(routes)["fleet"]["feasible"]
+
+    result = LocalSearch(evaluator, deadline=time.time() + 5).improve(routes)
+
+    fleet = evaluator.evaluate(result["routes"])["fleet"]
+    assert fleet["feasible"]
+    assert result["improved"] and result["cost"] < result["initial_cost"]
+    assert sorted(node for route in result["routes"] for node in route if node != 0) == list(range(1, 41))
+    assert all(route[0] == route[-1] == 0 for route in result["routes"])
+
+
+def test_improve_accepts_final_routes_of_masterplanner():
+    evaluator, routes = scattered_plan()
+    final_routes = [["depot"] + [node - 1 for node in route[1:-1]] + ["depot"] for route in routes]
+
+    assert LocalSearch(evaluator, deadline=time.time() + 5).improve(final_routes)["routes"] == \
+           LocalSearch(evaluator, deadline=time.time() + 5).improve(routes)["routes"]
@@ -0,0 +1,35 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from molokSelection import MolokSelector
+
+
+def test_moloks_are_selected_by_predicted_fill():
+    selector = MolokSelector(horizon_hours=24, overflow_limit=100)
+    fill_pcts = [90, 50, 95]
+    growthrates = [0, 60 / 86400, np.nan]       # 90 % and not growing, 60 % pr. day, unknown
+
+    selection = selector.select(fill_pcts, growthrates)
+
+    assert selection["selected"].tolist() == [1]
+    assert selection["predicted"] == pytest.approx([90, 110, 95])
+
+
+def test_hours_to_limit_without_growth():
+    selector = MolokSelector(overflow_limit=100)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        _, hours_to_limit = selector.predict([100, 120, 40, 40], [0, 0, 0, 1 / 3600])
+
+    assert hours_to_limit.tolist() == [0, 0, np.inf, 60]
+
+
+def test_cheap_detours_near_selected_moloks():
+    selector = MolokSelector(horizon_hours=24, overflow_limit=100, detour_meters=100, detour_fill=50)
+    positions = [(57.0, 9.9), (57.0005, 9.9), (57.01, 9.9)]      # 2nd is 56 m from the 1st, 3rd is 1.1 km away
+    selection = selector.select([100, 60, 60], [0, 0, 0], positions)
+
+    assert selection["at_risk"].tolist() == [0]
+    assert selection["detours"].tolist() == [1]
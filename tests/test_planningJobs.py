@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from planningJobs import PlanningJobs
+
+
+@pytest.fixture
+def jobs():
+    jobs = PlanningJobs(max_workers=1)
+    yield jobs
+    jobs.shutdown()
+
+
+def wait_until_finished(jobs: PlanningJobs, job_id: str, timeout: float = 60) -> dict:
+    deadline = time.time() + timeout
+    while jobs.status(job_id)["state"] not in ("done", "failed", "cancelled"):
+        assert time.time() < deadline
+        time.sleep(0.1)
+    return jobs.status(job_id)
+
+
+def test_job_result_covers_the_planned_moloks(jobs, planner_inputs):
+    molok_ids = [100 + i for i in range(30)]
+    job_id = jobs.submit(molok_ids=molok_ids, **planner_inputs)
+    assert jobs.status(job_id)["state"] in ("queued", "running")
+
+    status = wait_until_finished(jobs, job_id)
+    assert status["state"] == "done"
+    assert status["attempts"] == 2
+
+    result = jobs.result(job_id)
+    planned = sorted(node for route in result["routes"] for node in route if node != "depot")
+    assert planned == sorted(set(planned)) and len(planned) > 0
+    assert str(molok_ids[planned[0]]) in result["route_string"]
+    assert jobs.status(job_id) == {"state": "unknown"}             # forgotten after its result was fetched
+
+
+def test_queued_job_is_cancelled_before_it_starts(jobs, planner_inputs):
+    running = jobs.submit(**planner_inputs)
+    queued = jobs.submit(**planner_inputs)
+
+    assert jobs.cancel(queued)
+    assert wait_until_finished(jobs, queued)["state"] == "cancelled"
+    assert jobs.result(queued) is None
+    assert wait_until_finished(jobs, running)["state"] == "done"
+    assert not jobs.cancel(running)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from routeEvaluator import RouteEvaluator
+
+
+@pytest.fixture
+def evaluator():
+    """3 moloks on a line 1 km apart, depot at 0 m"""
+    positions = np.array([0, 1000, 2000, 3000])
+    distance_matrix = np.abs(positions[:, None] - positions[None, :])
+    return RouteEvaluator(distance_matrix // 10, distance_matrix, [0, 100, 200, 300], truck_capacity=500)
+
+
+def test_route_forms_give_the_same_nodes(evaluator):
+    assert evaluator.route_nodes(["depot", 0, 2, "depot"]) == [1, 3]
+    assert evaluator.route_nodes([0, 1, 3, 0]) == [1, 3]
+    assert evaluator.route_nodes([1, 3]) == [1, 3]
+
+
+def test_index_routes_must_be_framed_by_depot(evaluator):
+    with pytest.raises(ValueError):
+        evaluator.route_nodes([0, 2, "depot"])
+
+
+def test_evaluate_totals(evaluator):
+    evaluation = evaluator.evaluate([["depot", 0, 1, "depot"], ["depot", 2, "depot"]])
+
+    assert evaluation["routes"]["distance"].tolist() == [4000, 6000]
+    assert evaluation["routes"]["load"].tolist() == [300, 300]
+    assert evaluation["fleet"]["moloks_visited"] == 3
+    assert evaluation["fleet"]["feasible"]
+
+
+def test_cumul_data_matches_the_solver(solved_planner):
+    current_best = solved_planner.current_best
+    evaluator = RouteEvaluator.from_data(solved_planner.rp.data)
+
+    visit_times, truck_loads, truck_distances = evaluator.cumul_data(current_best["routes"])
+
+    assert visit_times == current_best["visit_times"]
+    assert truck_loads == current_best["truck_loads"]
+    assert truck_distances == current_best["truck_distances"]
@@ -0,0 +1,45 @@
+import contextlib
+import gzip
+import io
+import json
+import threading
+
+import pytest
+
+from routePlanner import MasterPlanner, CHECKPOINT_VERSION
+
+
+def test_planning_resumes_from_a_checkpoint(tmp_path, planner_inputs):
+    checkpoint_path = str(tmp_path / "plan.json.gz")
+    stop = threading.Event()
+    planner_inputs["time_limit_seconds"] = 4
+
+    # the first planning stops at its first solution, like a process that is killed
+    mp = MasterPlanner(**planner_inputs, checkpoint_path=checkpoint_path, checkpoint_interval=0, cancel_event=stop,
+                       progress_callback=lambda progress: progress["objective"] is not None and stop.set(),
+                       checkpoint_meta={"molok_ids": list(range(100, 130))})
+    with contextlib.redirect_stdout(io.StringIO()):
+        mp.master()
+    assert mp.cancelled
+
+    with gzip.open(checkpoint_path, "rt") as file:
+        state = json.load(file)
+    assert state["current_best"]["routes"]
+
+    resumed = MasterPlanner.from_checkpoint(checkpoint_path)
+    assert resumed.checkpoint_meta == {"molok_ids": list(range(100, 130))}
+    assert resumed.try_num == state["try_num"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        resumed.master()
+
+    visited = sorted(molok for route in resumed.current_best["routes"] for molok in route if molok != "depot")
+    assert visited == list(range(30))
+
+
+def test_checkpoints_of_another_version_are_refused(tmp_path):
+    checkpoint_path = str(tmp_path / "old.json.gz")
+    with gzip.open(checkpoint_path, "wt") as file:
+        json.dump({"version": CHECKPOINT_VERSION + 1}, file)
+
+    with pytest.raises(ValueError):
+        MasterPlanner.from_checkpoint(checkpoint_path)
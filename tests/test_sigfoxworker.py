@@ -0,0 +1,50 @@
+import pytest
+
+from datastorage import DataStorage
+from sigfoxmock import MockSigfoxServer, generate_messages
+from sigfoxworker import SigfoxWorker
+
+
+@pytest.fixture
+def mock():
+    """MockSigfoxServer with 5 devices of 250 messages each, served in pages of 100"""
+    mock = MockSigfoxServer(generate_messages(num_devices=5, msgs_per_device=250), page_limit=100)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def worker(tmp_path, mock):
+    """SigfoxWorker logging to a temporary DB where device i measures molok i"""
+    ds = DataStorage(db_name=str(tmp_path / "sigfox.db"))
+    table_name = ds.create_table(0, 5, "sigfox")
+    ds.select_table(table_name, 0, 5)
+    ds.register_devices(list(mock.messages.keys()), range(5), [200] * 5, [(57 + i / 1000, 10) for i in range(5)])
+
+    return SigfoxWorker(ds, api_url=mock.url, max_workers=3)
+
+
+def test_all_pages_are_logged_once(worker, mock):
+    assert worker.poll_once() == 1250
+    assert worker.poll_once() == 0
+
+    readings = worker.ds.show_table()
+    assert len(readings) == 1250
+    assert len({(row[1], row[4]) for row in readings}) == 1250         # no (molok, time) twice
+    assert worker.ds.fetch_sigfox_checkpoints() == {device_id: msgs[-1]["time"] for device_id, msgs in mock.messages.items()}
+
+
+def test_only_new_messages_are_logged_on_the_next_poll(worker, mock):
+    worker.poll_once()
+
+    device_id = "000002"
+    last_time = mock.messages[device_id][-1]["time"]
+    mock.add_messages(device_id, [{"device": device_id, "time": last_time + i * 600000, "data": "10:cm".encode().hex()}
+                                  for i in range(1, 4)])
+
+    assert worker.poll_once() == 3
+    latest = worker.ds.fetch_latest_state()
+    assert latest["fillPct"][2] == 95
+    assert latest["timestamp"][2] == (last_time + 3 * 600000) / 1000
+    assert worker.stats["errors"] == 0
@@ -0,0 +1,174 @@
+import numpy as np
+import pytest
+
+from datastorage import DataStorage
+from Simulation import Simulation
+
+
+@pytest.fixture
+def sim():
+    sim = Simulation(start_listen=False, HOST="127.0.0.1")
+    sim.start(port=0)
+    yield sim
+    sim.stop()
+
+
+def sim_storage(tmp_path, num_moloks: int = 50):
+    ds = DataStorage(db_name=str(tmp_path / "sim.db"))
+    ds.select_table(ds.create_table(seed=1, num_moloks=num_moloks, table_type="sim"), 1, num_moloks)
+    return ds
+
+
+def run_sim(ds: DataStorage, sim: Simulation, send_freq: int = 4):
+    ds.startSim(("127.0.0.1", sim.PORT), send_freq, udp_port=0)
+    ds.sim_thread.join(timeout=60)
+
+
+def test_all_sim_readings_are_inserted(tmp_path, sim):
+    ds = sim_storage(tmp_path)
+    rows_before = len(ds.show_table())
+
+    run_sim(ds, sim)
+
+    assert ds.sim_stats["readings"] == 50 * 4
+    assert len(ds.show_table()) - rows_before == 50 * 4
+
+
+def test_received_readings_are_inserted_after_an_error(tmp_path, sim, monkeypatch):
+    ds = sim_storage(tmp_path)
+    rows_before = len(ds.show_table())
+
+    insert_readings = ds.insert_readings
+    calls = []
+    def failing_once(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise OSError("disk I/O error")
+        return insert_readings(*args, **kwargs)
+    monkeypatch.setattr(ds, "insert_readings", failing_once)
+
+    run_sim(ds, sim)
+
+    inserted = len(ds.show_table()) - rows_before
+    assert inserted > 0
+    assert ds.sim_stats["readings"] == inserted == ds.sim_stats["received"]
+
+
+def test_simulate_is_reproducible_by_seed():
+    sim = Simulation(start_listen=False)
+    fills, time_stamps = [10, 20, 30], [1.7e9, 1.7e9 - 8 * 3600, 1.7e9]
+    np.random.seed(0)
+    global_state = np.random.get_state()[1].copy()
+
+    first = sim.simulate(4, fills, 6, time_stamps)
+    assert first.shape == (6, 3, 2)
+    assert (sim.simulate(4, fills, 6, time_stamps) == first).all()
+    assert not (sim.simulate(5, fills, 6, time_stamps) == first).all()
+    assert (np.random.get_state()[1] == global_state).all()            # the global seed is not touched
+
+    # the molok that is 2 sendings behind catches up in its first sending
+    assert (first[0, :, 1] == 1.7e9 + 4 * 3600).all()
+    assert (np.diff(first[:, :, 1], axis=0) == 4 * 3600).all()
+
+
+def test_simulated_horizon_does_not_depend_on_chunking():
+    sim = Simulation(start_listen=False)
+    fills, time_stamps = [10, 20, 30, 40], [1.7e9] * 4
+
+    def horizon(chunk_rounds):
+        chunks = list(sim.simulate_horizon(3, fills, 24, time_stamps, days=5, chunk_rounds=chunk_rounds, empty_at=90))
+        return [np.concatenate(arrays) for arrays in zip(*chunks)]
+
+    whole, chunked = horizon(None), horizon(7)
+    for whole_array, chunked_array in zip(whole, chunked):
+        np.testing.assert_array_equal(whole_array, chunked_array)
+
+    new_fills, _, emptied = whole
+    assert emptied.any()
+    assert (emptied == (new_fills >= 90)).all()
+
+
+def test_offline_simulation_continues_from_the_latest_state(tmp_path):
+    ds = sim_storage(tmp_path, num_moloks=10)
+    start_state = ds.fetch_latest_state()
+    rows_before = len(ds.show_table())
+
+    stats = ds.simulate_offline(days=10, send_freq=4, empty_at=80, chunk_rounds=7)
+
+    assert stats["emptyings"] > 0
+    assert stats["readings"] == 10 * 10 * 4 + stats["emptyings"]
+    new_rows = ds.show_table()[rows_before:]
+    assert len(new_rows) == stats["readings"]
+
+    molok_ids, fills, timestamps = new_rows[:, 1].astype(int), new_rows[:, 3].astype(float), new_rows[:, 4].astype(float)
+    assert (timestamps > start_state["timestamp"].max()).all()
+    for molok_id in range(10):
+        molok_fills = fills[molok_ids == molok_id]
+        molok_timestamps = timestamps[molok_ids == molok_id]
+        assert (np.diff(molok_timestamps) > 0).all()
+        # each reading at or above empty_at is followed by an emptying one second later
+        full = np.flatnonzero(molok_fills[:-1] >= 80)
+        assert (molok_fills[full + 1] == 0).all()
+        assert (molok_timestamps[full + 1] - molok_timestamps[full] == 1).all()
+
+    assert ds.fetch_latest_state()["timestamp"].min() > start_state["timestamp"].max()
+
+
+def test_offline_simulation_of_a_table_without_readings(tmp_path):
+    ds = DataStorage(db_name=str(tmp_path / "sim.db"))
+    ds.select_table(ds.create_table(seed=1, num_moloks=10, table_type="sigfox"), 1, 10)
+
+    assert ds.simulate_offline(days=1)["readings"] == 0
+    assert len(ds.show_table()) == 0
+
+
+class LossySocket:
+    """UDP socket that loses the first sending of every second datagram"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sendings = 0
+        self.lost = set()
+
+    def send(self, datagram):
+        self.sendings += 1
+        if self.sendings % 2 == 0 and datagram not in self.lost:
+            self.lost.add(datagram)
+            return len(datagram)
+        return self.sock.send(datagram)
+
+
+def test_lost_sim_datagrams_are_retransmitted(tmp_path, sim, monkeypatch):
+    ds = sim_storage(tmp_path)
+    rows_before = len(ds.show_table())
+
+    sockets = []
+    send_reliable = sim.send_reliable
+    def lossy_send_reliable(UDP_data_socket, *args, **kwargs):
+        sockets.append(LossySocket(UDP_data_socket))
+        return send_reliable(sockets[-1], *args, **kwargs)
+    monkeypatch.setattr(sim, "send_reliable", lossy_send_reliable)
+
+    run_sim(ds, sim, send_freq=96)
+
+    assert len(sockets[0].lost) == 5
+    assert ds.sim_stats["readings"] == len(ds.show_table()) - rows_before == 50 * 96
+    assert ds.sim_stats["unrecovered"] == 0
+    assert ds.sim_stats["gaps"] > 0
+
+
+def test_concurrent_sim_sessions_are_all_served(tmp_path, sim):
+    storages = []
+    for i in range(4):
+        ds = DataStorage(db_name=str(tmp_path / f"sim{i}.db"))
+        ds.select_table(ds.create_table(seed=i, num_moloks=50, table_type="sim"), i, 50)
+        storages.append(ds)
+
+    for ds in storages:
+        ds.startSim(("127.0.0.1", sim.PORT), 4, udp_port=0)
+    for ds in storages:
+        ds.sim_thread.join(timeout=60)
+
+    assert [ds.sim_stats["readings"] for ds in storages] == [50 * 4] * 4
+    sim.stop()          # waits for the sessions to close
+    assert sim.sessions_served == 4 and sim.sessions_active == 0
@@ -0,0 +1,24 @@
+import numpy as np
+
+from warmStart import warm_start_routes
+
+
+def test_previous_routes_are_fitted_to_the_new_moloks_and_trucks():
+    rng = np.random.default_rng(0)
+    previous_routes = [["depot", 10, 11, 12, "depot"], ["depot", 13, 14, "depot"], ["depot", 15, "depot"]]
+    molok_ids = [10, 12, 13, 14, 15, 20]            # 11 is not planned now, 20 is new
+    positions = list(zip(rng.normal(57.02, 0.01, 6).tolist(), rng.normal(9.95, 0.02, 6).tolist()))
+
+    routes = warm_start_routes(previous_routes, molok_ids, positions, (57.0257998, 9.9194714), num_trucks=2)
+
+    assert len(routes) <= 2
+    assert sorted(i for route in routes for i in route) == list(range(6))     # every molok once, as index
+
+
+def test_new_moloks_go_to_routes_with_capacity_left():
+    positions = [(57.02, 9.95), (57.021, 9.95), (57.022, 9.95)]
+    routes = warm_start_routes([["depot", 1, 2, "depot"]], [1, 2, 3], positions, (57.0257998, 9.9194714),
+                               demands=[400, 400, 400], truck_capacity=1000, num_trucks=2)
+
+    assert routes[0] == [0, 1]
+    assert routes[1] == [2]
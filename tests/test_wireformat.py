@@ -0,0 +1,44 @@
+import pickle
+
+import numpy as np
+import pytest
+
+import wireformat
+
+
+def test_pack_unpack_round_trip():
+    molok_ids, fill_pcts, timestamps = [0, 7, 4294967295], [0.0, 55.5, 100.0], [1.7e9, 1.7e9 + 0.25, 1.7e9 + 60]
+
+    header, records = wireformat.unpack(wireformat.pack(42, 3, molok_ids, fill_pcts, timestamps))
+
+    assert header == {"version": wireformat.PROTOCOL_VERSION, "flags": 0, "session": 42, "seq": 3, "count": 3}
+    assert records["molokID"].tolist() == molok_ids
+    assert records["fillPct"].tolist() == fill_pcts
+    assert records["timestamp"].tolist() == timestamps
+
+
+def test_pack_batches_numbers_datagrams_from_start_seq():
+    n = 1000
+    datagrams = wireformat.pack_batches(1, np.arange(n), np.full(n, 50.0), np.arange(n, dtype=float), 300, start_seq=5)
+
+    unpacked = [wireformat.unpack(datagram) for datagram in datagrams]
+    assert [header["seq"] for header, _ in unpacked] == [5, 6, 7, 8]
+    assert [header["count"] for header, _ in unpacked] == [300, 300, 300, 100]
+    assert np.concatenate([records["molokID"] for _, records in unpacked]).tolist() == list(range(n))
+
+
+def test_end_datagram():
+    header, records = wireformat.unpack(wireformat.pack_end(1, 12))
+
+    assert header["flags"] & wireformat.FLAG_END
+    assert header["seq"] == 12
+    assert len(records) == 0
+
+
+def test_pickles_and_truncated_datagrams_are_rejected():
+    pickled = pickle.dumps([1, 50.0, 1.7e9])
+    assert not wireformat.is_binary(pickled)
+    with pytest.raises(ValueError):
+        wireformat.unpack(pickled)
+    with pytest.raises(ValueError):
+        wireformat.unpack(wireformat.pack(1, 0, [1, 2], [50.0, 60.0], [1.7e9, 1.7e9])[:-1])